@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+async_server.py
+
+server.py 的异步服务模式（python server.py --async），基于标准库 asyncio 的进程内 HTTP/1.1 服务器：
+- 瓦片路由在事件循环中直接处理：存储的瓦片用 loop.sendfile（底层 os.sendfile）零拷贝发送，
+  PMTiles 只发送归档中的对应字节区间；只有全在内存中的规划（server.can_plan_inline）在事件循环上执行，
+  要 stat 瓦片文件、查询 SQLite 或首次扫描拼接图目录的规划在线程池中进行
+- 转码、合成等 CPU 密集工作（TilePlan.build）交给有界线程池，超出上限的请求在事件循环中排队等待；
+  读穿代理等待上游的请求使用单独的线程池
+- 支持 keep-alive 与流水线（同一连接上的请求按顺序读取、按顺序应答）
+- 其余路由（首页、/api/*）交给 Flask 应用（WSGI），同样在线程池中执行
+- --workers N 时在建好瓦片索引后 fork 出 N 个进程共享监听套接字，索引以写时复制方式共享
+"""
+
+import asyncio
+import contextvars
+import io
+import logging
+import os
+import re
+import signal
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote
+
+import metrics
+from metrics import phase
+
+logger = logging.getLogger(__name__)
+
+KEEPALIVE_SECONDS = 15
+IO_WORKERS = 32  # 等待上游（读穿代理）的线程数，上游并发另由 UpstreamProxy 限制
+MAX_HEADER_BYTES = 64 * 1024
+TILE_ROUTE = re.compile(r'^/tiles/(\d+)/(\d+)/(\d+)(@2x)?\.(png|webp|jpg)$')
+
+
+class Headers(dict):
+    """键为小写的请求头，get 不区分大小写（与 Flask request.headers 用法一致）"""
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+
+class Request:
+    __slots__ = ('method', 'target', 'path', 'query', 'version', 'headers', 'body')
+
+    def __init__(self, method, target, version, headers, body=b''):
+        self.method = method
+        self.target = target
+        path, _, self.query = target.partition('?')
+        self.path = unquote(path)
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def args(self):
+        return {k: v[0] for k, v in parse_qs(self.query).items()}
+
+    @property
+    def keep_alive(self):
+        conn = self.headers.get('Connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return conn == 'keep-alive'
+        return conn != 'close'
+
+
+async def read_request(reader):
+    """读取一个请求；连接关闭返回 None"""
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_SECONDS)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+        return None
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ', 2)
+    headers = Headers()
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    body = b''
+    length = int(headers.get('Content-Length') or 0)
+    if length:
+        body = await reader.readexactly(length)
+    return Request(method, target, version, headers, body)
+
+
+def response_head(status, headers, length=None, keep_alive=True):
+    lines = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}']
+    for name, value in headers:
+        lines.append(f'{name}: {value}')
+    if length is not None:
+        lines.append(f'Content-Length: {length}')
+    else:
+        lines.append('Transfer-Encoding: chunked')
+    lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+class AsyncTileServer:
+    def __init__(self, srv, convert_workers):
+        """srv 为已完成命令行配置的 server 模块（以 __main__ 运行时不能重新 import）"""
+        self.srv = srv
+        self.executor = ThreadPoolExecutor(max_workers=convert_workers, thread_name_prefix='convert')
+        self.io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='upstream')
+        self.slots = None
+        self.convert_workers = convert_workers
+
+    async def run_blocking(self, fn, *args, io=False):
+        """
+        在有界线程池中执行；在途任务超过上限时在事件循环里排队，不堆积到线程池队列。
+        io 为真（等待上游）时使用单独的线程池，不占用转码名额。
+        在当前上下文中执行，线程里的阶段计时计入发起它的请求。
+        """
+        ctx = contextvars.copy_context()
+        if io:
+            return await asyncio.get_running_loop().run_in_executor(self.io_executor, ctx.run, fn, *args)
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, ctx.run, fn, *args)
+
+    async def handle(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            # 响应头与 sendfile 分两次发出，关闭 Nagle 避免与延迟 ACK 叠加出 40ms 停顿
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                try:
+                    req = await read_request(reader)
+                except (ValueError, asyncio.LimitOverrunError):
+                    writer.write(response_head(400, [], 0, False))
+                    break
+                if req is None:
+                    break
+                match = TILE_ROUTE.match(req.path) if req.method in ('GET', 'HEAD') else None
+                if match:
+                    await self.serve_tile(req, writer, *match.groups())
+                else:
+                    await self.serve_wsgi(req, writer)
+                await writer.drain()
+                if not req.keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            logger.error(f'处理连接出错: {e}', exc_info=True)
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    async def serve_tile(self, req, writer, z, x, y, retina, want):
+        """处理瓦片请求并记录指标；路由标签与 Flask 路由一致"""
+        route = '/tiles/{z}/{x}/{y}@2x.{ext}' if retina else f'/tiles/{{z}}/{{x}}/{{y}}.{want}'
+        timer = metrics.begin_request(route, req.path)
+        status, length = 200, None
+        try:
+            status, length = await self.send_tile(req, writer, int(z), int(x), int(y), retina, want)
+        finally:
+            metrics.end_request(timer, status, None if req.method == 'HEAD' else length)
+
+    async def send_tile(self, req, writer, z, x, y, retina, want):
+        """返回 (状态码, 响应体长度)"""
+        srv = self.srv
+        head_only = req.method == 'HEAD'
+        head_sent = False
+        try:
+            args = req.args
+            if retina:
+                plan_args = (srv.plan_retina, z, x, y, want, req.headers, args)
+            else:
+                plan_args = (srv.plan_tile, z, x, y, want, want == 'png', req.headers, args)
+            with phase('lookup'):
+                # 只有全在内存中的规划在事件循环上执行，要 stat、查 SQLite 或扫描目录的在线程池中进行
+                if srv.can_plan_inline():
+                    plan = plan_args[0](*plan_args[1:])
+                else:
+                    plan = await self.run_blocking(*plan_args, io=True)
+            if not retina:
+                srv.prefetcher.schedule(z, x, y, want, want == 'png', req.headers.get('Accept', ''), args)
+            headers = list(plan.headers.items()) + [('Access-Control-Allow-Origin', '*')]
+            if plan.status == 304:
+                writer.write(response_head(304, headers, 0, req.keep_alive))
+                return 304, 0
+            if plan.body is not None or plan.build is not None:
+                body, mimetype = plan.body, plan.mimetype
+                if body is None:
+                    try:
+                        body, mimetype = await self.run_blocking(plan.build, io=plan.io)
+                    except srv.UpstreamError as e:
+                        plan = srv.upstream_error_plan(e.status)
+                        body, mimetype = plan.body, plan.mimetype
+                        headers = list(plan.headers.items()) + [('Access-Control-Allow-Origin', '*')]
+                headers.append(('Content-Type', mimetype))
+                writer.write(response_head(plan.status, headers, len(body), req.keep_alive))
+                if not head_only:
+                    writer.write(body)
+                return plan.status, len(body)
+            headers.append(('Content-Type', plan.mimetype))
+            tile = plan.tile
+            if tile.path is None:
+                with phase('read'):
+                    body = srv.tile_source.read(tile)
+                writer.write(response_head(200, headers, len(body), req.keep_alive))
+                if not head_only:
+                    writer.write(body)
+                return 200, len(body)
+            with phase('read'), open(tile.path, 'rb') as fh:
+                length = os.fstat(fh.fileno()).st_size if tile.whole_file else tile.length
+                writer.write(response_head(200, headers, length, req.keep_alive))
+                head_sent = True
+                # 空文件不走 sendfile（count 为 0 时 loop.sendfile 会报错）
+                if not head_only and length:
+                    await writer.drain()
+                    # 套接字传输支持时为 os.sendfile，否则退回读写拷贝
+                    await asyncio.get_running_loop().sendfile(writer.transport, fh, tile.offset, length)
+            return 200, length
+        except ConnectionError:
+            raise
+        except Exception as e:
+            if head_sent:
+                # 响应头已发出，不能再写第二个响应；由 handle 关闭连接
+                raise
+            logger.error(f'Error reading/converting tile {z}/{x}/{y}: {e}', exc_info=True)
+            plan = srv.error_tile()
+            headers = list(plan.headers.items()) + [('Content-Type', plan.mimetype)]
+            writer.write(response_head(200, headers, len(plan.body), req.keep_alive))
+            writer.write(plan.body)
+            return 200, len(plan.body)
+
+    def wsgi_environ(self, req, writer):
+        host, port = (writer.get_extra_info('sockname') or ('127.0.0.1', 0))[:2]
+        peer = writer.get_extra_info('peername') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': req.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': req.path,
+            'QUERY_STRING': req.query,
+            'SERVER_NAME': str(host),
+            'SERVER_PORT': str(port),
+            'SERVER_PROTOCOL': req.version,
+            'REMOTE_ADDR': peer[0],
+            'CONTENT_TYPE': req.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(req.body)) if req.body else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(req.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in req.headers.items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ['HTTP_' + key] = value
+        return environ
+
+    async def serve_wsgi(self, req, writer):
+        """在线程池中调用 Flask 应用；没有 Content-Length 的响应（流式）以 chunked 编码逐段发送"""
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        def call():
+            result = self.srv.app(self.wsgi_environ(req, writer), start_response)
+            return result, iter(result)
+
+        result, chunks = await self.run_blocking(call)
+        try:
+            headers = [(k, v) for k, v in started['headers'] if k.lower() not in ('connection', 'transfer-encoding')]
+            length = next((v for k, v in headers if k.lower() == 'content-length'), None)
+            headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+            chunked = length is None and req.method != 'HEAD' and started['status'] not in (204, 304)
+            if length is None and not chunked:
+                length = 0
+            writer.write(response_head(started['status'], headers, None if chunked else int(length), req.keep_alive))
+            sentinel = object()
+            while True:
+                chunk = await self.run_blocking(next, chunks, sentinel)
+                if chunk is sentinel:
+                    break
+                if not chunk or req.method == 'HEAD':
+                    continue
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def serve(self, sock):
+        self.slots = asyncio.Semaphore(self.convert_workers * 2)
+        server = await asyncio.start_server(self.handle, sock=sock, limit=MAX_HEADER_BYTES)
+        async with server:
+            await server.serve_forever()
+
+
+def listen(host, port):
+    sock = socket.create_server((host, port), backlog=1024)
+    sock.setblocking(False)
+    return sock
+
+
+def run_worker(srv, sock, convert_workers, on_start=None):
+    if on_start is not None:
+        on_start()
+    try:
+        asyncio.run(AsyncTileServer(srv, convert_workers).serve(sock))
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(srv, host='127.0.0.1', port=5000, workers=1, convert_workers=None, on_worker_start=None):
+    """
+    启动异步服务。workers > 1 时父进程只负责监听套接字与子进程管理；
+    on_worker_start 在每个工作进程（fork 之后）中调用，用于启动各自的索引轮询线程等。
+    """
+    convert_workers = convert_workers or (os.cpu_count() or 1)
+    sock = listen(host, port)
+    if workers <= 1 or not hasattr(os, 'fork'):
+        run_worker(srv, sock, convert_workers, on_worker_start)
+        return
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            run_worker(srv, sock, convert_workers, on_worker_start)
+            os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        stop(None, None)
+        for pid in children:
+            os.waitpid(pid, 0)
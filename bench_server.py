@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+"""
+bench_server.py
+
+server.py 的本地压测：
+- 生成合成瓦片目录（PNG/WebP/JPG 按比例混合，层级与范围可配）
+- 按 Leaflet 的加载方式生成浏览轨迹（平移、缩放，视口外扩一圈缓冲，由中心向外加载，会话内不重复请求）
+- 以不同服务模式（Flask、--async、多进程）启动 server.py，在多个并发度下回放轨迹
+- 报告吞吐、p50/p95/p99 延迟与每请求服务端 CPU 时间；可保存结果并与基线比较，退化超出容差时返回非零
+
+用法：
+    python bench_server.py                                   # 临时合成目录 + 默认模式与并发度
+    python bench_server.py --make-tree /tmp/bench_out --zoom 10-14 --span 8
+    python bench_server.py --tiles-dir /tmp/bench_out --modes flask,async,async-4w --concurrency 1,16,64
+    python bench_server.py --tiles-dir /tmp/bench_out --save base.json
+    python bench_server.py --tiles-dir /tmp/bench_out --baseline base.json --tolerance 0.15
+"""
+
+import argparse
+import http.client
+import io
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from coverage_manifest import scan_column, summarize_zoom
+from tile_sources import lonlat_to_tile
+
+SERVER = Path(__file__).resolve().parent / 'server.py'
+
+# 模式名 → server.py 参数
+MODES = {
+    'flask': [],
+    'async': ['--async'],
+    'async-4w': ['--async', '--workers', '4'],
+}
+DEFAULT_MODES = 'flask,async'
+DEFAULT_CONCURRENCY = '1,16,64'
+# Chrome 请求图片时的 Accept
+BROWSER_ACCEPT = 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8'
+PIL_FORMATS = {'png': 'PNG', 'webp': 'WEBP', 'jpg': 'JPEG'}
+PROTOTYPES = 16  # 每种格式预先编码的不同瓦片数，写目录时随机复用
+
+
+def parse_zooms(text):
+    lo, _, hi = text.partition('-')
+    return list(range(int(lo), int(hi or lo) + 1))
+
+
+def parse_mix(text):
+    """png=0.4,webp=0.4,jpg=0.2 → {ext: 权重}"""
+    mix = {}
+    for part in text.split(','):
+        ext, _, weight = part.partition('=')
+        ext = ext.strip().lower()
+        if ext not in PIL_FORMATS:
+            raise ValueError(f'不支持的格式: {ext}')
+        mix[ext] = float(weight or 1)
+    return mix
+
+
+# ---------------------------------------------------------------------------
+# 合成瓦片目录
+# ---------------------------------------------------------------------------
+
+def synthetic_tile(rng):
+    """接近真实地图瓦片的压缩体积：底色 + 色块与线条 + 轻微噪声"""
+    base = tuple(rng.randrange(160, 240) for _ in range(3))
+    im = Image.new('RGB', (256, 256), base)
+    draw = ImageDraw.Draw(im)
+    for _ in range(rng.randrange(6, 14)):
+        x0, y0 = rng.randrange(-64, 256), rng.randrange(-64, 256)
+        w, h = rng.randrange(16, 160), rng.randrange(16, 160)
+        color = tuple(rng.randrange(60, 250) for _ in range(3))
+        draw.rectangle((x0, y0, x0 + w, y0 + h), fill=color)
+    for _ in range(rng.randrange(4, 12)):
+        pts = [(rng.randrange(256), rng.randrange(256)) for _ in range(rng.randrange(2, 5))]
+        draw.line(pts, fill=(255, 255, 255), width=rng.randrange(2, 7))
+    noise = Image.effect_noise((256, 256), rng.uniform(4, 12)).convert('RGB')
+    im = Image.blend(im.filter(ImageFilter.SMOOTH), noise, 0.08)
+    return im
+
+
+def make_prototypes(mix, seed):
+    rng = random.Random(seed)
+    out = {}
+    for ext in mix:
+        blobs = []
+        for _ in range(PROTOTYPES):
+            buf = io.BytesIO()
+            synthetic_tile(rng).save(buf, PIL_FORMATS[ext], quality=85)
+            blobs.append(buf.getvalue())
+        out[ext] = blobs
+    return out
+
+
+def make_tree(root, zooms, span=8, center=(116.39, 39.91), mix=None, seed=1):
+    """
+    在 root 下生成 {z}/{x}/{y}.{ext}：最低层级以 center 为中心 span×span 个瓦片，
+    更高层级覆盖同一地理范围（每级瓦片数 ×4）。返回写出的瓦片数。
+    """
+    mix = mix or {'png': 0.4, 'webp': 0.4, 'jpg': 0.2}
+    root = Path(root)
+    rng = random.Random(seed)
+    prototypes = make_prototypes(mix, seed)
+    exts, weights = list(mix), list(mix.values())
+    z0 = zooms[0]
+    cx, cy = lonlat_to_tile(*center, z0)
+    x0, y0 = cx - span // 2, cy - span // 2
+    count = 0
+    for z in zooms:
+        k = 1 << (z - z0)
+        for x in range(x0 * k, (x0 + span) * k):
+            col = root / str(z) / str(x)
+            col.mkdir(parents=True, exist_ok=True)
+            for y in range(y0 * k, (y0 + span) * k):
+                ext = rng.choices(exts, weights)[0]
+                (col / f'{y}.{ext}').write_bytes(rng.choice(prototypes[ext]))
+                count += 1
+    return count
+
+
+def tree_ranges(root):
+    """扫描瓦片目录（只读）→ {z: (x_min, x_max, y_min, y_max)}"""
+    ranges = {}
+    root = Path(root)
+    for z_dir in root.iterdir():
+        if not z_dir.name.isdigit() or not z_dir.is_dir():
+            continue
+        columns = {c.name: scan_column(c) for c in z_dir.iterdir() if c.name.isdigit() and c.is_dir()}
+        summary = summarize_zoom(int(z_dir.name), columns)
+        if summary['tile_range']:
+            ranges[int(z_dir.name)] = tuple(summary['tile_range'])
+    return ranges
+
+
+# ---------------------------------------------------------------------------
+# Leaflet 风格的浏览轨迹
+# ---------------------------------------------------------------------------
+
+def visible_tiles(z, cx, cy, viewport, buffer=1):
+    """视口（中心为世界像素坐标 cx, cy）内及外扩 buffer 圈的瓦片，按到中心的距离排序"""
+    w, h = viewport
+    n = 1 << z
+    x_lo, x_hi = math.floor((cx - w / 2) / 256) - buffer, math.floor((cx + w / 2) / 256) + buffer
+    y_lo, y_hi = math.floor((cy - h / 2) / 256) - buffer, math.floor((cy + h / 2) / 256) + buffer
+    tiles = [(x % n, y) for x in range(x_lo, x_hi + 1) for y in range(max(0, y_lo), min(n - 1, y_hi) + 1)]
+    tiles.sort(key=lambda t: (t[0] * 256 + 128 - cx) ** 2 + (t[1] * 256 + 128 - cy) ** 2)
+    return tiles
+
+
+def leaflet_trace(rng, ranges, steps=40, viewport=(1280, 800)):
+    """
+    一次浏览会话的请求序列 [(z, x, y)]：从随机层级与位置开始，每步平移（60%）、放大或缩小；
+    中心限制在该层级的瓦片范围内。已加载过的瓦片由浏览器缓存提供，不再请求。
+    """
+    zooms = sorted(ranges)
+    z = rng.choice(zooms[:max(1, len(zooms) // 2)])
+    x_min, x_max, y_min, y_max = ranges[z]
+    cx = rng.uniform(x_min, x_max + 1) * 256
+    cy = rng.uniform(y_min, y_max + 1) * 256
+    seen, out = set(), []
+    for _ in range(steps):
+        for x, y in visible_tiles(z, cx, cy, viewport):
+            if (z, x, y) not in seen:
+                seen.add((z, x, y))
+                out.append((z, x, y))
+        action = rng.random()
+        if action < 0.6:
+            cx += rng.gauss(0, viewport[0] / 3)
+            cy += rng.gauss(0, viewport[1] / 3)
+        elif action < 0.8 and z + 1 in ranges:
+            z, cx, cy = z + 1, cx * 2, cy * 2
+        elif z - 1 in ranges:
+            z, cx, cy = z - 1, cx / 2, cy / 2
+        x_min, x_max, y_min, y_max = ranges[z]
+        cx = min(max(cx, x_min * 256), (x_max + 1) * 256)
+        cy = min(max(cy, y_min * 256), (y_max + 1) * 256)
+    return out
+
+
+def make_traces(ranges, users, sessions, seed, ext='png'):
+    """每个虚拟用户一串会话，展开为 URL 列表"""
+    traces = []
+    for i in range(users):
+        rng = random.Random(seed * 100003 + i)
+        urls = []
+        for _ in range(sessions):
+            urls += [f'/tiles/{z}/{x}/{y}.{ext}' for z, x, y in leaflet_trace(rng, ranges)]
+        traces.append(urls)
+    return traces
+
+
+# ---------------------------------------------------------------------------
+# 负载回放（多进程 × 多线程，每个虚拟用户一个 keep-alive 连接）
+# ---------------------------------------------------------------------------
+
+def run_user(host, port, urls, accept, record_from, stop_at, out):
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    i = 0
+    while True:
+        now = time.time()
+        if now >= stop_at:
+            break
+        url = urls[i % len(urls)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            conn.request('GET', url, headers={'Accept': accept})
+            resp = conn.getresponse()
+            body = resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+            status, body = 0, b''
+        elapsed = time.perf_counter() - started
+        if now >= record_from:
+            out['latencies'].append(elapsed)
+            out['bytes'] += len(body)
+            if status != 200:
+                out['errors'] += 1
+    conn.close()
+
+
+def run_client(host, port, traces, accept, record_from, stop_at):
+    """一个客户端进程：每条轨迹一个线程；返回汇总的延迟与计数"""
+    parts = [{'latencies': [], 'bytes': 0, 'errors': 0} for _ in traces]
+    threads = [threading.Thread(target=run_user, args=(host, port, urls, accept, record_from, stop_at, part))
+               for urls, part in zip(traces, parts)]
+    cpu = time.process_time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {
+        'latencies': [v for p in parts for v in p['latencies']],
+        'bytes': sum(p['bytes'] for p in parts),
+        'errors': sum(p['errors'] for p in parts),
+        'client_cpu': time.process_time() - cpu,
+    }
+
+
+def process_tree_cpu(pid):
+    """pid 及其全部子进程（多进程模式的工作进程）已用的 user+sys CPU 秒数；非 Linux 返回 None"""
+    if not os.path.isdir('/proc'):
+        return None
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as f:
+                fields = f.read().rsplit(b')', 1)[1].split()
+        except OSError:
+            continue
+        stats[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+    tree, frontier = {pid}, [pid]
+    while frontier:
+        parent = frontier.pop()
+        for child, (ppid, _) in stats.items():
+            if ppid == parent and child not in tree:
+                tree.add(child)
+                frontier.append(child)
+    return sum(stats[p][1] for p in tree if p in stats) / os.sysconf('SC_CLK_TCK')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode_args, tiles_dir, port, extra_args, log_path):
+    cmd = [sys.executable, str(SERVER), '--tiles-dir', str(tiles_dir), '--port', str(port),
+           '--no-mosaics'] + mode_args + extra_args
+    log = open(log_path, 'ab')
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=log)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'服务启动失败（退出码 {proc.returncode}），日志见 {log_path}')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/api/cache-stats')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    stop_server(proc)
+    raise RuntimeError(f'服务 60 秒内未就绪，日志见 {log_path}')
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * q
+    lo = math.floor(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def run_load(proc, port, traces, accept, duration, warmup, client_procs):
+    """回放一轮负载，返回结果字典"""
+    groups = [traces[i::client_procs] for i in range(client_procs)]
+    groups = [g for g in groups if g]
+    start = time.time() + 1.0
+    record_from, stop_at = start + warmup, start + warmup + duration
+    with ProcessPoolExecutor(max_workers=len(groups)) as pool:
+        futures = [pool.submit(run_client, '127.0.0.1', port, g, accept, record_from, stop_at) for g in groups]
+        time.sleep(max(0.0, record_from - time.time()))
+        cpu_before = process_tree_cpu(proc.pid)
+        time.sleep(max(0.0, stop_at - time.time()))
+        cpu_after = process_tree_cpu(proc.pid)
+        parts = [f.result() for f in futures]
+
+    latencies = sorted(v for p in parts for v in p['latencies'])
+    n = len(latencies)
+    server_cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return {
+        'requests': n,
+        'errors': sum(p['errors'] for p in parts),
+        'throughput': n / duration,
+        'mb_per_s': sum(p['bytes'] for p in parts) / duration / 1e6,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'cpu_ms_per_req': server_cpu * 1000 / n if server_cpu is not None and n else None,
+        'server_cpu_util': server_cpu / duration if server_cpu is not None else None,
+        'client_cpu_util': sum(p['client_cpu'] for p in parts) / (duration + warmup + 1.0),
+    }
+
+
+# ---------------------------------------------------------------------------
+# 报告与基线比较
+# ---------------------------------------------------------------------------
+
+def print_table(results):
+    header = f"{'模式':<12}{'并发':>6}{'请求':>9}{'错误':>6}{'req/s':>10}{'MB/s':>8}" \
+             f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'CPU ms/req':>12}{'服务CPU':>9}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        cpu = f"{r['cpu_ms_per_req']:.2f}" if r['cpu_ms_per_req'] is not None else '-'
+        util = f"{r['server_cpu_util'] * 100:.0f}%" if r['server_cpu_util'] is not None else '-'
+        print(f"{r['mode']:<12}{r['concurrency']:>6}{r['requests']:>9}{r['errors']:>6}{r['throughput']:>10.1f}"
+              f"{r['mb_per_s']:>8.1f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}{cpu:>12}{util:>9}")
+
+
+def compare(results, baseline, tolerance):
+    """与基线逐项比较（同模式、同并发度）；返回退化描述列表"""
+    base = {(r['mode'], r['concurrency']): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        b = base.get((r['mode'], r['concurrency']))
+        if b is None:
+            continue
+        name = f"{r['mode']} ×{r['concurrency']}"
+        if r['throughput'] < b['throughput'] * (1 - tolerance):
+            regressions.append(f"{name}: 吞吐 {b['throughput']:.1f} → {r['throughput']:.1f} req/s")
+        if r['p99_ms'] > b['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {b['p99_ms']:.2f} → {r['p99_ms']:.2f} ms")
+        if r['cpu_ms_per_req'] and b.get('cpu_ms_per_req') and \
+                r['cpu_ms_per_req'] > b['cpu_ms_per_req'] * (1 + tolerance):
+            regressions.append(f"{name}: CPU {b['cpu_ms_per_req']:.2f} → {r['cpu_ms_per_req']:.2f} ms/req")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='server.py 本地压测：合成瓦片目录 + Leaflet 浏览轨迹回放')
+    parser.add_argument('--make-tree', metavar='DIR', help='只生成合成瓦片目录后退出')
+    parser.add_argument('--tiles-dir', help='压测使用的瓦片目录（默认生成临时合成目录，结束后删除）')
+    parser.add_argument('--zoom', default='10-13', help='合成目录的层级范围，如 10-13')
+    parser.add_argument('--span', type=int, default=8, help='合成目录最低层级的边长（瓦片数），每高一级 ×2')
+    parser.add_argument('--center', default='116.39,39.91', help='合成目录中心 lon,lat')
+    parser.add_argument('--mix', default='png=0.4,webp=0.4,jpg=0.2', help='合成目录的格式比例')
+    parser.add_argument('--modes', default=DEFAULT_MODES,
+                        help=f"服务模式，逗号分隔：{', '.join(MODES)}，或 名称=参数（如 'async-2w=--async --workers 2'）")
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY, help='并发虚拟用户数，逗号分隔')
+    parser.add_argument('--duration', type=float, default=10.0, help='每轮计时时长（秒）')
+    parser.add_argument('--warmup', type=float, default=2.0, help='每轮计时前的预热时长（秒，不计入结果）')
+    parser.add_argument('--sessions', type=int, default=20, help='每个虚拟用户的会话数（轨迹循环回放）')
+    parser.add_argument('--ext', default='png', choices=['png', 'webp', 'jpg'], help='请求的瓦片扩展名')
+    parser.add_argument('--accept', default=BROWSER_ACCEPT, help='请求的 Accept 头（默认与 Chrome 一致）')
+    parser.add_argument('--client-procs', type=int, default=min(4, os.cpu_count() or 1), help='负载生成进程数')
+    parser.add_argument('--server-args', default='', help='附加给 server.py 的参数（所有模式）')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='把结果保存为 JSON')
+    parser.add_argument('--baseline', help='与之前 --save 的结果比较，退化超出容差时退出码为 1')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='基线比较的相对容差')
+    args = parser.parse_args()
+
+    zooms = parse_zooms(args.zoom)
+    mix = parse_mix(args.mix)
+    center = tuple(float(v) for v in args.center.split(','))
+
+    if args.make_tree:
+        started = time.time()
+        n = make_tree(args.make_tree, zooms, args.span, center, mix, args.seed)
+        print(f"✅ 生成 {n} 个瓦片 → {args.make_tree}（{time.time() - started:.1f}s）")
+        return
+
+    tmp = None
+    tiles_dir = args.tiles_dir
+    if not tiles_dir:
+        tmp = tempfile.mkdtemp(prefix='bench-tiles-')
+        tiles_dir = tmp
+        n = make_tree(tiles_dir, zooms, args.span, center, mix, args.seed)
+        print(f"🧪 合成瓦片目录：{n} 个瓦片（z{zooms[0]}-{zooms[-1]}）→ {tiles_dir}")
+
+    modes = []
+    for spec in args.modes.split(','):
+        name, eq, extra = spec.partition('=')
+        if eq:
+            modes.append((name.strip(), extra.split()))
+        elif name.strip() in MODES:
+            modes.append((name.strip(), MODES[name.strip()]))
+        else:
+            parser.error(f'未知模式: {name}')
+    levels = [int(c) for c in args.concurrency.split(',')]
+
+    results = []
+    log_path = Path(tempfile.gettempdir()) / 'bench_server.log'
+    try:
+        ranges = tree_ranges(tiles_dir)
+        if not ranges:
+            parser.error(f'{tiles_dir} 中没有瓦片')
+        traces = make_traces(ranges, max(levels), args.sessions, args.seed, args.ext)
+        print(f"🧭 轨迹：{max(levels)} 个虚拟用户，平均每人 {sum(map(len, traces)) // len(traces)} 个请求")
+        for name, mode_args in modes:
+            for c in levels:
+                port = free_port()
+                # 每轮重启服务，各轮的缓存状态一致
+                proc = start_server(mode_args, tiles_dir, port, args.server_args.split(), log_path)
+                try:
+                    print(f"▶ {name} ×{c} …", flush=True)
+                    r = run_load(proc, port, traces[:c], args.accept, args.duration, args.warmup,
+                                 min(args.client_procs, c))
+                finally:
+                    stop_server(proc)
+                r.update({'mode': name, 'args': mode_args, 'concurrency': c})
+                if r['client_cpu_util'] > 0.9 * min(args.client_procs, c):
+                    print(f"⚠️  负载生成端 CPU 接近饱和（{r['client_cpu_util']:.1f} 核），结果可能受客户端限制")
+                results.append(r)
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print()
+    print_table(results)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'params': vars(args), 'results': results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\n💾 结果已保存：{args.save}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n❌ 相对基线退化（容差 {args.tolerance:.0%}）：")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print(f"\n✅ 未发现超出 {args.tolerance:.0%} 的退化")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+canvas.py
+
+stitch() 的画布后端：
+- ImageCanvas：内存中的 PIL Image（默认，与原有行为一致）
+- MemmapCanvas：磁盘上的 NumPy memmap 原始 RGBA 数组，用于超过内存的大图；
+  瓦片以数组切片写入，alpha 掩码合成向量化完成，编码时按行带顺序读取
+
+两者都提供 size / paste / crop / as_image / close，write_cog 与 encoders 只依赖这些接口。
+- TileStripCanvas：只读画布，按行带读取时才解码对应的一行瓦片，供流式编码器直接输出（服务端导出）
+"""
+
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from PIL import Image
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HAVE_NUMPY = np is not None
+
+
+class ImageCanvas:
+    """内存画布"""
+
+    def __init__(self, size):
+        self.image = Image.new('RGBA', size, (0, 0, 0, 0))
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def paste(self, im, pos):
+        self.image.paste(im, pos, im)
+
+    def crop(self, box):
+        return self.image.crop(box)
+
+    def as_image(self):
+        return self.image
+
+    def close(self):
+        self.image = None
+
+
+class MemmapCanvas:
+    """
+    memmap 画布：形状 (height, width, 4) 的 uint8 数组，存放在 workdir 下的临时文件中，
+    close() 时删除。概览层（reduced）同样落盘。
+    """
+
+    def __init__(self, size, workdir=None):
+        if np is None:
+            raise RuntimeError('memmap 画布需要 numpy：pip install numpy')
+        w, h = size
+        workdir = Path(workdir) if workdir else None
+        if workdir:
+            workdir.mkdir(parents=True, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix='.canvas-', suffix='.raw', dir=workdir)
+        os.close(fd)
+        self.workdir = workdir
+        self.array = np.memmap(self.path, dtype=np.uint8, mode='w+', shape=(h, w, 4))
+
+    @property
+    def size(self):
+        return self.array.shape[1], self.array.shape[0]
+
+    def _clip(self, left, top, right, bottom):
+        w, h = self.size
+        return max(0, left), max(0, top), min(w, right), min(h, bottom)
+
+    def paste(self, im, pos):
+        """
+        以 im 自身 alpha 为掩码合成，逐通道 dst = src·m + dst·(1-m)，
+        与 Image.paste(im, pos, im) 结果一致；不透明瓦片直接切片赋值。
+        """
+        left, top = pos
+        iw, ih = im.size
+        l, t, r, b = self._clip(left, top, left + iw, top + ih)
+        if r <= l or b <= t:
+            return
+        src = np.asarray(im.convert('RGBA'))[t - top:b - top, l - left:r - left]
+        dst = self.array[t:b, l:r]
+        mask = src[..., 3]
+        if mask.min() == 255:
+            dst[...] = src
+            return
+        if mask.max() == 0:
+            return
+        m = mask.astype(np.uint32)[..., None]
+        # 与 Pillow 相同的 /255 整数近似：(v + 128 + ((v + 128) >> 8)) >> 8
+        v = src.astype(np.uint32) * m + dst.astype(np.uint32) * (255 - m) + 128
+        dst[...] = ((v + (v >> 8)) >> 8).astype(np.uint8)
+
+    def rows(self, top, bottom):
+        """按行带读取的原始数组视图（供流式编码器使用）"""
+        return self.array[top:bottom]
+
+    def crop(self, box):
+        """与 PIL crop 一致：超出画布的部分以透明填充"""
+        left, top, right, bottom = box
+        l, t, r, b = self._clip(left, top, right, bottom)
+        if (l, t, r, b) == (left, top, right, bottom):
+            return Image.fromarray(np.ascontiguousarray(self.array[t:b, l:r]), 'RGBA')
+        out = np.zeros((bottom - top, right - left, 4), dtype=np.uint8)
+        if r > l and b > t:
+            out[t - top:b - top, l - left:r - left] = self.array[t:b, l:r]
+        return Image.fromarray(out, 'RGBA')
+
+    def reduced(self, band=1024):
+        """按 2 倍缩小为新的 MemmapCanvas（预乘 alpha 平均），按行带处理"""
+        w, h = self.size
+        out = MemmapCanvas(((w + 1) // 2, (h + 1) // 2), self.workdir)
+        band -= band % 2
+        for top in range(0, h, band):
+            strip = self.crop((0, top, w, min(h, top + band)))
+            half = strip.convert('RGBa').reduce(2).convert('RGBA')
+            out.array[top // 2:top // 2 + half.size[1]] = np.asarray(half)
+        return out
+
+    def as_image(self):
+        # 图像直接引用 memmap，由操作系统按需换页
+        return Image.fromarray(self.array, 'RGBA')
+
+    def close(self):
+        if self.array is not None:
+            # 释放引用后映射随之解除；Linux 下删除仍被映射的文件也是安全的
+            self.array = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class TileStripCanvas:
+    """
+    按需渲染的只读画布：cols×rows 个瓦片，fetch(col, row) 返回 PIL Image 或 None（透明）。
+    rows() 只解码覆盖所需行的瓦片行（条带），最近 cache_strips 个条带留在内存中，
+    内存占用只与宽度有关，与总行数无关。条带渲染持锁进行，可被并行编码的多个线程调用。
+    """
+
+    def __init__(self, cols, rows, fetch, tile_size=256, cache_strips=3):
+        if np is None:
+            raise RuntimeError('条带画布需要 numpy：pip install numpy')
+        self.cols, self.nrows = cols, rows
+        self.fetch = fetch
+        self.tile_size = tile_size
+        self.cache_strips = cache_strips
+        self._strips = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self.cols * self.tile_size, self.nrows * self.tile_size
+
+    def _render(self, row):
+        ts = self.tile_size
+        strip = np.zeros((ts, self.cols * ts, 4), dtype=np.uint8)
+        for col in range(self.cols):
+            im = self.fetch(col, row)
+            if im is None:
+                continue
+            im = im.convert('RGBA')
+            if im.size != (ts, ts):
+                im = im.resize((ts, ts), Image.LANCZOS)
+            strip[:, col * ts:(col + 1) * ts] = np.asarray(im)
+        return strip
+
+    def strip(self, row):
+        with self._lock:
+            strip = self._strips.get(row)
+            if strip is None:
+                strip = self._strips[row] = self._render(row)
+                while len(self._strips) > self.cache_strips:
+                    self._strips.popitem(last=False)
+            else:
+                self._strips.move_to_end(row)
+            return strip
+
+    def rows(self, top, bottom):
+        ts = self.tile_size
+        first, last = top // ts, (bottom - 1) // ts
+        if first == last:
+            return self.strip(first)[top - first * ts:bottom - first * ts]
+        parts = [self.strip(r) for r in range(first, last + 1)]
+        return np.concatenate(parts)[top - first * ts:bottom - first * ts]
+
+    def crop(self, box):
+        left, top, right, bottom = box
+        w, h = self.size
+        out = np.zeros((bottom - top, right - left, 4), dtype=np.uint8)
+        l, t, r, b = max(0, left), max(0, top), min(w, right), min(h, bottom)
+        if r > l and b > t:
+            out[t - top:b - top, l - left:r - left] = self.rows(t, b)[:, l:r]
+        return Image.fromarray(out, 'RGBA')
+
+    def as_image(self):
+        return self.crop((0, 0) + self.size)
+
+    def close(self):
+        with self._lock:
+            self._strips.clear()
+
+
+CANVAS_BACKENDS = {'memory': ImageCanvas, 'memmap': MemmapCanvas}
+
+
+def new_canvas(backend, size, workdir=None):
+    if backend not in CANVAS_BACKENDS:
+        raise ValueError(f'未知的画布后端: {backend}')
+    if backend == 'memmap':
+        return MemmapCanvas(size, workdir)
+    return ImageCanvas(size)
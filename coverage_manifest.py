@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+coverage_manifest.py
+
+瓦片覆盖清单：{outdir}/coverage.json，按 zoom 记录范围、瓦片数、字节数与格式分布。
+- 清单以列（out/{z}/{x}）为单位保存统计与列目录 mtime，写入方只需重扫自己动过的列
+- 爬虫每个任务结束后调用 update_columns；服务端读取清单并在过期时调用 refresh 增量重扫
+- 两者可能同时写入：读-改-写在 {outdir}/coverage.json.lock 文件锁内进行，每次都以磁盘上的最新清单为基础
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
+
+MANIFEST_NAME = 'coverage.json'
+MANIFEST_VERSION = 1
+
+_thread_lock = threading.Lock()
+
+
+def manifest_path(outdir) -> Path:
+    return Path(outdir) / MANIFEST_NAME
+
+
+def _tile_lonlat(x, y, z):
+    n = 2.0 ** z
+    lon = x / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lon, lat
+
+
+def tile_range_bounds(z, x_min, x_max, y_min, y_max):
+    """瓦片范围（含两端）→ [west, south, east, north]"""
+    west, north = _tile_lonlat(x_min, y_min, z)
+    east, south = _tile_lonlat(x_max + 1, y_max + 1, z)
+    return [west, south, east, north]
+
+
+def scan_column(col_path):
+    """统计一个列目录：瓦片数、字节数、y 范围、格式分布"""
+    count = size = 0
+    y_min = y_max = None
+    formats = {}
+    seen = set()
+    with os.scandir(col_path) as it:
+        for entry in it:
+            stem, dot, ext = entry.name.partition('.')
+            if not dot or not stem.isdigit() or ext.endswith('part'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            ext = ext.lower()
+            formats[ext] = formats.get(ext, 0) + 1
+            size += st.st_size
+            y = int(stem)
+            if y in seen:
+                continue  # 同一瓦片多种格式只计一次
+            seen.add(y)
+            count += 1
+            y_min = y if y_min is None else min(y_min, y)
+            y_max = y if y_max is None else max(y_max, y)
+    return {'count': count, 'bytes': size, 'y_min': y_min, 'y_max': y_max, 'formats': formats}
+
+
+def summarize_zoom(z, columns):
+    """由各列统计汇总出 zoom 级的范围与计数"""
+    count = size = 0
+    formats = {}
+    xs, y_mins, y_maxs = [], [], []
+    for x, col in columns.items():
+        if not col['count']:
+            continue
+        count += col['count']
+        size += col['bytes']
+        for ext, n in col['formats'].items():
+            formats[ext] = formats.get(ext, 0) + n
+        xs.append(int(x))
+        y_mins.append(col['y_min'])
+        y_maxs.append(col['y_max'])
+    summary = {'count': count, 'bytes': size, 'formats': formats, 'bounds': None, 'tile_range': None}
+    if xs:
+        x_min, x_max, y_min, y_max = min(xs), max(xs), min(y_mins), max(y_maxs)
+        summary['tile_range'] = [x_min, x_max, y_min, y_max]
+        summary['bounds'] = tile_range_bounds(z, x_min, x_max, y_min, y_max)
+    return summary
+
+
+def load(outdir):
+    """读取清单；不存在或版本不符返回 None"""
+    try:
+        with open(manifest_path(outdir), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('version') != MANIFEST_VERSION:
+        return None
+    return data
+
+
+@contextmanager
+def locked(outdir):
+    """清单读-改-写的互斥：进程内的线程锁加跨进程的文件锁（爬虫与服务端可能同时写入）"""
+    path = manifest_path(outdir).with_name(MANIFEST_NAME + '.lock')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with _thread_lock, open(path, 'a+b') as fh:
+        if fcntl is not None:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def save(outdir, data):
+    """原子写入清单；临时文件名带进程与线程号，并发写入方互不覆盖"""
+    data['version'] = MANIFEST_VERSION
+    data['updated_ns'] = time.time_ns()
+    path = manifest_path(outdir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.part')
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def _empty():
+    return {'version': MANIFEST_VERSION, 'zooms': {}}
+
+
+def update_columns(outdir, z, xs):
+    """
+    写入方调用：重扫 z 级的 xs 列并更新清单中的汇总。
+    只触碰这些列目录，代价与本次写入的范围成正比。
+    """
+    with locked(outdir):
+        data = load(outdir) or _empty()
+        zoom = data['zooms'].setdefault(str(z), {'columns': {}})
+        columns = zoom['columns']
+        z_path = Path(outdir) / str(z)
+        for x in xs:
+            col_path = z_path / str(x)
+            try:
+                mtime = col_path.stat().st_mtime_ns
+                col = scan_column(col_path)
+            except OSError:
+                columns.pop(str(x), None)
+                continue
+            col['mtime_ns'] = mtime
+            columns[str(x)] = col
+        zoom.update(summarize_zoom(z, columns))
+        save(outdir, data)
+    return data
+
+
+def refresh(outdir, data=None):
+    """
+    按列目录 mtime 增量重扫整个 outdir（服务端在清单过期时于后台调用）。
+    mtime 未变的列沿用旧统计；返回并保存新的清单。
+    以磁盘上的清单为基础（其他写入方可能刚更新过），没有时才用调用方持有的 data。
+    """
+    with locked(outdir):
+        return _refresh(outdir, load(outdir) or data or _empty())
+
+
+def _refresh(outdir, data):
+    old_zooms = data.get('zooms', {})
+    zooms = {}
+    try:
+        z_entries = [e for e in os.scandir(outdir) if e.name.isdigit() and e.is_dir()]
+    except OSError:
+        z_entries = []
+    for z_entry in z_entries:
+        old_cols = old_zooms.get(z_entry.name, {}).get('columns', {})
+        columns = {}
+        for entry in os.scandir(z_entry.path):
+            if not entry.name.isdigit() or not entry.is_dir():
+                continue
+            mtime = entry.stat().st_mtime_ns
+            old = old_cols.get(entry.name)
+            if old is not None and old.get('mtime_ns') == mtime:
+                columns[entry.name] = old
+                continue
+            try:
+                col = scan_column(entry.path)
+            except OSError:
+                continue
+            col['mtime_ns'] = mtime
+            columns[entry.name] = col
+        zoom = {'columns': columns}
+        zoom.update(summarize_zoom(int(z_entry.name), columns))
+        zooms[z_entry.name] = zoom
+    data = {'zooms': zooms}
+    save(outdir, data)
+    return data
+
+
+def summary(data):
+    """去掉逐列明细的简要视图：{z: {count, bytes, formats, bounds, tile_range}}"""
+    if not data:
+        return {}
+    return {z: {k: v for k, v in zoom.items() if k != 'columns'}
+            for z, zoom in sorted(data.get('zooms', {}).items(), key=lambda kv: int(kv[0]))}
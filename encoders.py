@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+encoders.py
+
+大图编码器：按行带顺序读取画布（PIL Image 或 canvas 中的画布），
+不需要把整张图一次性交给 Pillow。
+- write_png：流式 PNG，逐行自适应选择滤波器（None/Sub/Up/Average/Paeth）；
+  workers > 1 时各行带独立 deflate 并行压缩，再拼接为一个 zlib 流
+- save_sheets：WebP/JPEG 超出格式尺寸上限时切成若干张并行编码
+- save_image：按格式选择上述编码路径
+"""
+
+import math
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import numpy as np
+except ImportError:  # 仅流式 PNG 需要 numpy
+    np = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+ADLER_BASE = 65521
+
+# 单张图片的最大边长
+FORMAT_MAX_SIDE = {'WEBP': 16383, 'JPEG': 65500}
+# 流式 PNG 每个行带的原始字节预算：行数随宽度缩小，单个行带编码时的峰值不超过其 PNG_FILTER_PEAK 倍
+PNG_BAND_BYTES = 4 * 1024 * 1024
+PNG_FILTER_PEAK = 16  # 单个行带读取、滤波与压缩的峰值内存 / 行带原始字节（tests/test_encoders.py 校验）
+SHEET_EXTS = {'WEBP': '.webp', 'JPEG': '.jpg'}
+# 磁盘画布编码 WebP/JPEG 时每张的原始 RGBA 字节上限（Pillow 只能整张编码，超出即切片）
+SHEET_MAX_BYTES = 64 * 1024 * 1024
+
+
+def png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data
+            + struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+
+def _band_array(src, top, bottom):
+    w = src.size[0]
+    if hasattr(src, 'rows'):
+        return src.rows(top, bottom)
+    return np.asarray(src.crop((0, top, w, bottom)))
+
+
+def png_band_rows(width, band_bytes=None, bpp=4):
+    """按字节预算换算每个行带的行数：越宽的图行带越矮，至少 1 行"""
+    band_bytes = PNG_BAND_BYTES if band_bytes is None else band_bytes
+    return max(1, band_bytes // (width * bpp))
+
+
+def filter_rows(band, prev_row, bpp=4):
+    """
+    对一段连续行做 PNG 滤波，返回每行前缀了滤波类型字节的 (rows, width*bpp+1) uint8 数组（可直接交给 zlib）。
+    band: (rows, width*bpp) uint8；prev_row: 段前一行（首段为全 0）。
+    滤波只依赖原始像素，因此可整段向量化计算；按“绝对值和最小”逐行选择。
+    五种候选逐个计算并与当前最优比较，不同时保留，峰值约为行带的 13 倍。
+    """
+    rows = band.shape[0]
+    up = np.empty_like(band)
+    up[0] = prev_row
+    up[1:] = band[:-1]
+    left = np.zeros_like(band)
+    left[:, bpp:] = band[:, :-bpp]
+    upleft = np.zeros_like(band)
+    upleft[:, bpp:] = up[:, :-bpp]
+
+    out = np.empty((rows, band.shape[1] + 1), dtype=np.uint8)
+    out[:, 0] = 0
+    out[:, 1:] = band
+    best = _filter_cost(band)
+
+    def consider(kind, predictor):
+        nonlocal best
+        candidate = band - predictor  # uint8 按模 256 回绕，与 PNG 定义一致
+        cost = _filter_cost(candidate)
+        better = cost < best  # 严格小于：并列时保留编号小的滤波器
+        if better.any():
+            out[better, 0] = kind
+            out[better, 1:] = candidate[better]
+            best = np.minimum(best, cost)
+
+    consider(1, left)
+    consider(2, up)
+    consider(3, (left >> 1) + (up >> 1) + (left & up & 1))  # floor((left + up) / 2)，不溢出
+    consider(4, _paeth(left, up, upleft))
+    return out
+
+
+# 有符号字节的绝对值（-128 记为 128），作为压缩性估计
+_ABS_INT8 = None if np is None else \
+    np.abs(np.arange(256, dtype=np.uint8).view(np.int8).astype(np.int16)).astype(np.uint8)
+
+
+def _filter_cost(candidate):
+    return _ABS_INT8[candidate].sum(axis=1, dtype=np.int64)
+
+
+def _paeth(left, up, upleft):
+    """Paeth 预测：p = left + up - upleft，取 left/up/upleft 中最接近 p 者"""
+    pa = up.astype(np.int16)
+    pa -= upleft                  # p - left
+    pb = left.astype(np.int16)
+    pb -= upleft                  # p - up
+    pc = pa + pb                  # p - upleft
+    np.abs(pa, out=pa)
+    np.abs(pb, out=pb)
+    np.abs(pc, out=pc)
+    pred = np.where(pb <= pc, up, upleft)
+    np.copyto(pred, left, where=(pa <= pb) & (pa <= pc))
+    return pred
+
+
+def adler32_combine(adler1, adler2, len2):
+    """合并两段数据的 adler32（zlib 的 adler32_combine）"""
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % ADLER_BASE
+    sum1 += (adler2 & 0xFFFF) + ADLER_BASE - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - rem
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum2 >= ADLER_BASE << 1:
+        sum2 -= ADLER_BASE << 1
+    if sum2 >= ADLER_BASE:
+        sum2 -= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+def _png_band(src, top, bottom, stride, level, last):
+    """读取并滤波 [top, bottom) 行，压缩为原始 deflate 片段；返回 (压缩数据, adler32, 原始长度)"""
+    start = max(0, top - 1)
+    rows = _band_array(src, start, bottom).reshape(-1, stride)
+    prev = rows[0] if top else np.zeros(stride, dtype=np.uint8)
+    raw = filter_rows(rows[1:] if top else rows, prev)
+    del rows, prev  # 压缩期间只保留滤波结果
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    # 非末段以 sync flush 结束（字节对齐、不带结束标记），可以直接拼接
+    data = comp.compress(raw) + comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return data, zlib.adler32(raw), raw.nbytes
+
+
+def ordered_map(pool, fn, items, window):
+    """按提交顺序产出结果，同时最多 window 个任务在途（限制内存）"""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, *item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_png(src, level=6, band=None, workers=1, band_bytes=None):
+    """
+    逐段产出 PNG 字节流，可直接写文件或作为 HTTP 响应体。
+    行带高度默认按 band_bytes（PNG_BAND_BYTES）换算，band 可直接指定行数。
+    workers > 1 时各行带在线程池中并行滤波与压缩（numpy 与 zlib 均释放 GIL）；
+    峰值内存约为 workers × 行带字节 × PNG_FILTER_PEAK，与图像宽高无关。
+    """
+    if np is None:
+        raise RuntimeError('流式 PNG 编码需要 numpy：pip install numpy')
+    w, h = src.size
+    stride = w * 4
+    band = band or png_band_rows(w, band_bytes)
+    yield PNG_SIGNATURE
+    yield png_chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 6, 0, 0, 0))
+
+    bands = [(src, top, min(h, top + band), stride, level, top + band >= h)
+             for top in range(0, h, band)]
+    adler, first = 1, True
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for data, band_adler, raw_len in ordered_map(pool, _png_band, bands, 2 * max(1, workers)):
+            if first:
+                data = b'\x78\x9c' + data  # zlib 头
+                first = False
+            adler = adler32_combine(adler, band_adler, raw_len)
+            yield png_chunk(b'IDAT', data)
+    yield png_chunk(b'IDAT', struct.pack('>I', adler))
+    yield png_chunk(b'IEND', b'')
+
+
+def write_png(src, output, level=6, band=None, workers=1, band_bytes=None):
+    """将 RGBA 画布流式写为 PNG；内存占用只与行带字节预算和 workers 有关"""
+    with open(output, 'wb') as fh:
+        for part in iter_png(src, level, band, workers, band_bytes):
+            fh.write(part)
+    return output
+
+
+def sheet_side(max_bytes=None):
+    """每张不超过 max_bytes（RGBA）的正方形切片边长，取 256 的倍数"""
+    max_bytes = SHEET_MAX_BYTES if max_bytes is None else max_bytes
+    side = math.isqrt(max_bytes // 4)
+    return max(256, side - side % 256)
+
+
+def save_sheets(image, output, output_format, max_side, workers=1, **params):
+    """
+    将 image（PIL Image 或画布，只需 .size/.crop）切成不超过 max_side 的若干张，在线程池中并行编码，
+    文件名为 {stem}_r{行}_c{列}{ext}。返回 [(路径, (left, top, right, bottom)), ...]。
+    """
+    output = Path(output)
+    w, h = image.size
+    ext = SHEET_EXTS.get(output_format.upper(), output.suffix)
+    jobs = []
+    for r, top in enumerate(range(0, h, max_side)):
+        for c, left in enumerate(range(0, w, max_side)):
+            box = (left, top, min(w, left + max_side), min(h, top + max_side))
+            jobs.append((output.with_name(f'{output.stem}_r{r}_c{c}{ext}'), box))
+
+    def encode(path, box):
+        sheet = image.crop(box)
+        if output_format.upper() == 'JPEG':
+            sheet = sheet.convert('RGB')
+        sheet.save(path, format=output_format, **params)
+        return path, box
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(lambda j: encode(*j), jobs))
+
+
+def save_image(canvas, output, output_format, level=6, workers=1, quality=90):
+    """
+    按格式选择编码路径：
+    - PNG：流式/并行 PNG（workers > 1 或 memmap 画布）；否则交给 Pillow
+    - WEBP/JPEG：超出单图尺寸上限时切片并行编码；level 映射为 WebP method。
+      磁盘画布（memmap）不整图物化：超过 SHEET_MAX_BYTES 即按该预算切片，每片从画布裁出后编码，
+      峰值约为 workers × 2 × SHEET_MAX_BYTES
+    - 其他：Pillow（整图编码，峰值与图幅成正比）
+    返回实际写出的文件列表。
+    """
+    fmt = output_format.upper()
+    if fmt == 'PNG' and np is not None and (workers > 1 or hasattr(canvas, 'rows')):
+        write_png(canvas, output, level=level, workers=workers)
+        return [output]
+
+    params = {}
+    if fmt == 'PNG':
+        params['compress_level'] = level
+    elif fmt in ('WEBP', 'JPEG'):
+        params['quality'] = quality
+        if fmt == 'WEBP':
+            params['method'] = round(level * 6 / 9)
+    max_side = FORMAT_MAX_SIDE.get(fmt)
+    if max_side and hasattr(canvas, 'rows'):
+        max_side = min(max_side, sheet_side())
+    if max_side and max(canvas.size) > max_side:
+        return [p for p, _ in save_sheets(canvas, output, fmt, max_side, workers, **params)]
+    image = canvas.as_image()
+    if fmt == 'JPEG':
+        image = image.convert('RGB')
+    image.save(output, format=output_format, **params)
+    return [output]
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+geotiff.py
+
+Cloud-Optimized GeoTIFF（COG）写出，仅依赖 Pillow 与标准库。
+- 内部分块（256/512），每块独立 deflate 压缩
+- 预计算概览层（overview），逐级 2 倍缩小直到单块可容纳
+- Web Mercator（EPSG:3857）地理参考，由瓦片范围推导
+- 所有 IFD 位于文件头部，块数据按从小到大的分辨率排列，
+  便于 QGIS/GDAL 通过 HTTP Range 只读取所需的块与层级
+- TiledTiff：按块读取/原地替换块（增量拼接时只重写变化的块）
+"""
+
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from PIL import Image
+from encoders import ordered_map
+
+WEB_MERCATOR_HALF = 20037508.342789244
+
+COMPRESSION_CODES = {'none': 1, 'deflate': 8}
+CLASSIC_MAX_OFFSET = 0xFFFFFFFF   # 经典 TIFF 的偏移为 32 位
+BIGTIFF_THRESHOLD = 0xF0000000    # 数据量超过此值时改用 BigTIFF（留出 IFD 与修补的余量）
+HAVE_PREAD = hasattr(os, 'pread')
+
+# TIFF 字段类型
+BYTE, ASCII, SHORT, LONG, DOUBLE, LONG8 = 1, 2, 3, 4, 12, 16
+_TYPE_FMT = {BYTE: 'B', ASCII: 's', SHORT: 'H', LONG: 'I', DOUBLE: 'd', LONG8: 'Q'}
+
+
+def tile_range_geotransform(z, x_min, y_min, tile_size=256):
+    """返回 (ulx, uly, res)：左上角 EPSG:3857 坐标与像元大小（米）"""
+    span = 2 * WEB_MERCATOR_HALF / (2 ** z)
+    ulx = -WEB_MERCATOR_HALF + x_min * span
+    uly = WEB_MERCATOR_HALF - y_min * span
+    return ulx, uly, span / tile_size
+
+
+def downsample(src, band=1024):
+    """按 2 倍缩小 src（需支持 .size / .crop），按行带处理以限制峰值内存"""
+    w, h = src.size
+    out = Image.new('RGBA', ((w + 1) // 2, (h + 1) // 2), (0, 0, 0, 0))
+    band -= band % 2
+    for top in range(0, h, band):
+        strip = src.crop((0, top, w, min(h, top + band)))
+        # 预乘 alpha 后再平均，避免透明边缘发黑
+        half = strip.convert('RGBa').reduce(2).convert('RGBA')
+        out.paste(half, (0, top // 2))
+    return out
+
+
+def build_overviews(src, block_size):
+    """返回 [src, 1/2, 1/4, ...]，直到最小层级可放进单个块；画布自带 reduced() 时用其落盘缩小"""
+    levels = [src]
+    while max(levels[-1].size) > block_size:
+        prev = levels[-1]
+        reduced = getattr(prev, 'reduced', None)
+        levels.append(reduced() if reduced else downsample(prev))
+    return levels
+
+
+def _geokeys():
+    # GeoKeyDirectory: 版本头 + (key, location, count, value)
+    keys = [
+        (1024, 0, 1, 1),     # GTModelType = Projected
+        (1025, 0, 1, 1),     # GTRasterType = PixelIsArea
+        (3072, 0, 1, 3857),  # ProjectedCSType = WGS 84 / Pseudo-Mercator
+        (3076, 0, 1, 9001),  # ProjLinearUnits = metre
+    ]
+    out = [1, 1, 0, len(keys)]
+    for k in keys:
+        out.extend(k)
+    return out
+
+
+class _IFD:
+    """单个 IFD 的标签集合及其在文件中的布局"""
+
+    def __init__(self, entries, bigtiff):
+        self.entries = sorted(entries, key=lambda e: e[0])
+        self.bigtiff = bigtiff
+        self.offset = 0
+
+    @property
+    def _inline(self):
+        return 8 if self.bigtiff else 4
+
+    def _payload(self, typ, values):
+        if typ == ASCII:
+            return values[0].encode('latin-1') + b'\0'
+        return struct.pack('<%d%s' % (len(values), _TYPE_FMT[typ]), *values)
+
+    def size(self):
+        n = len(self.entries)
+        if self.bigtiff:
+            head = 8 + 20 * n + 8
+        else:
+            head = 2 + 12 * n + 4
+        extra = 0
+        for tag, typ, values in self.entries:
+            nbytes = len(self._payload(typ, values))
+            if nbytes > self._inline:
+                extra += nbytes + (nbytes & 1)
+        return head + extra
+
+    def set(self, tag, values):
+        for i, (t, typ, _) in enumerate(self.entries):
+            if t == tag:
+                self.entries[i] = (t, typ, list(values))
+                return
+        raise KeyError(tag)
+
+    def pack(self, next_offset):
+        n = len(self.entries)
+        if self.bigtiff:
+            head = struct.pack('<Q', n)
+            data_pos = self.offset + 8 + 20 * n + 8
+        else:
+            head = struct.pack('<H', n)
+            data_pos = self.offset + 2 + 12 * n + 4
+        body, extra = [head], []
+        for tag, typ, values in self.entries:
+            payload = self._payload(typ, values)
+            count = len(payload) if typ == ASCII else len(values)
+            if len(payload) <= self._inline:
+                value = payload.ljust(self._inline, b'\0')
+            else:
+                value = struct.pack('<Q' if self.bigtiff else '<I', data_pos)
+                if len(payload) & 1:
+                    payload += b'\0'
+                extra.append(payload)
+                data_pos += len(payload)
+            if self.bigtiff:
+                body.append(struct.pack('<HHQ', tag, typ, count) + value)
+            else:
+                body.append(struct.pack('<HHI', tag, typ, count) + value)
+        body.append(struct.pack('<Q' if self.bigtiff else '<I', next_offset))
+        return b''.join(body + extra)
+
+
+def _level_entries(width, height, block_size, compression, overview, bigtiff):
+    ntiles = -(-width // block_size) * -(-height // block_size)
+    off_type = LONG8 if bigtiff else LONG
+    return [
+        (254, LONG, [1 if overview else 0]),   # NewSubfileType
+        (256, LONG, [width]),
+        (257, LONG, [height]),
+        (258, SHORT, [8, 8, 8, 8]),            # BitsPerSample
+        (259, SHORT, [COMPRESSION_CODES[compression]]),
+        (262, SHORT, [2]),                     # Photometric = RGB
+        (277, SHORT, [4]),                     # SamplesPerPixel
+        (284, SHORT, [1]),                     # PlanarConfig = contig
+        (322, LONG, [block_size]),             # TileWidth
+        (323, LONG, [block_size]),             # TileLength
+        (324, off_type, [0] * ntiles),         # TileOffsets
+        (325, off_type, [0] * ntiles),         # TileByteCounts
+        (338, SHORT, [2]),                     # ExtraSamples = unassociated alpha
+        (339, SHORT, [1, 1, 1, 1]),            # SampleFormat = uint
+    ]
+
+
+def _encode_block(img, compression, level):
+    raw = img.tobytes()
+    if compression == 'deflate':
+        return zlib.compress(raw, level)
+    return raw
+
+
+def iter_blocks(width, height, block_size):
+    """按行优先顺序返回每个块的像素框 (left, top, right, bottom)"""
+    for top in range(0, height, block_size):
+        for left in range(0, width, block_size):
+            yield left, top, left + block_size, top + block_size
+
+
+def _crop_encode(src, box, compression, level):
+    return _encode_block(src.crop(box), compression, level)
+
+
+def _layout_ifds(ifds, bigtiff):
+    """IFD 紧接文件头依次排列，返回块数据的起始位置"""
+    pos = 16 if bigtiff else 8
+    for ifd in ifds:
+        ifd.offset = pos
+        pos += ifd.size()
+        pos += pos & 1
+    return pos
+
+
+def _write_ifds(fh, ifds, bigtiff):
+    """写文件头与全部 IFD（块偏移已填好）"""
+    fh.seek(0)
+    if bigtiff:
+        fh.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, ifds[0].offset))
+    else:
+        fh.write(b'II' + struct.pack('<HI', 42, ifds[0].offset))
+    for i, ifd in enumerate(ifds):
+        nxt = ifds[i + 1].offset if i + 1 < len(ifds) else 0
+        fh.seek(ifd.offset)
+        fh.write(ifd.pack(nxt))
+
+
+def write_cog(src, output, z, x_min, y_min, tile_size=256, block_size=512,
+              compression='deflate', level=6, workers=1):
+    """
+    将 src（PIL Image 或支持 .size/.crop 的画布）写为 COG。
+    z/x_min/y_min/tile_size 用于推导 EPSG:3857 地理参考。
+    workers > 1 时各块在线程池中并行裁剪与压缩，按顺序写出。
+    """
+    if block_size % 16:
+        raise ValueError('block_size 必须为 16 的倍数')
+    if compression not in COMPRESSION_CODES:
+        raise ValueError(f'不支持的压缩方式: {compression}')
+
+    levels = build_overviews(src, block_size)
+    sizes = [l.size for l in levels]
+
+    # 原始数据量接近 4GB 时改用 BigTIFF
+    raw_bytes = sum(-(-l.size[0] // block_size) * -(-l.size[1] // block_size) for l in levels)
+    raw_bytes *= block_size * block_size * 4
+    bigtiff = raw_bytes > BIGTIFF_THRESHOLD
+
+    ifds = []
+    for i, lvl in enumerate(levels):
+        w, h = lvl.size
+        entries = _level_entries(w, h, block_size, compression, i > 0, bigtiff)
+        if i == 0:
+            ulx, uly, res = tile_range_geotransform(z, x_min, y_min, tile_size)
+            entries += [
+                (33550, DOUBLE, [res, res, 0.0]),                    # ModelPixelScale
+                (33922, DOUBLE, [0.0, 0.0, 0.0, ulx, uly, 0.0]),     # ModelTiepoint
+                (34735, SHORT, _geokeys()),                          # GeoKeyDirectory
+            ]
+        ifds.append(_IFD(entries, bigtiff))
+
+    pos = _layout_ifds(ifds, bigtiff)
+
+    output = Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    workers = max(1, workers)
+    with open(output, 'wb') as fh, ThreadPoolExecutor(max_workers=workers) as pool:
+        fh.write(b'\0' * pos)
+        # 块数据：最小概览在前，全分辨率在后
+        for ifd, lvl in reversed(list(zip(ifds, levels))):
+            w, h = lvl.size
+            offsets, counts = [], []
+            jobs = ((lvl, box, compression, level) for box in iter_blocks(w, h, block_size))
+            for data in ordered_map(pool, _crop_encode, jobs, 4 * workers):
+                offsets.append(fh.tell())
+                counts.append(len(data))
+                fh.write(data)
+            ifd.set(324, offsets)
+            ifd.set(325, counts)
+            if lvl is not src and hasattr(lvl, 'close'):
+                lvl.close()
+        _write_ifds(fh, ifds, bigtiff)
+
+    return {'output': str(output), 'levels': sizes,
+            'block_size': block_size, 'bigtiff': bigtiff}
+
+
+class TiledLevel:
+    """TiledTiff 中的一个分辨率层级（一个 IFD）"""
+
+    def __init__(self, tags):
+        self.tags = tags
+        self.width = tags[256][2][0]
+        self.height = tags[257][2][0]
+        self.block_w = tags[322][2][0]
+        self.block_h = tags[323][2][0]
+        self.compression = tags.get(259, (0, 0, [1]))[2][0]
+        self.samples = tags.get(277, (0, 0, [1]))[2][0]
+        self.offsets = list(tags[324][2])
+        self.counts = list(tags[325][2])
+        self.across = -(-self.width // self.block_w)
+        self.down = -(-self.height // self.block_h)
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+
+class TiledTiff:
+    """
+    分块 TIFF 的按块访问（8 位 RGB/RGBA，无压缩或 deflate）。
+    读取使用 os.pread，可被多线程共享；没有 os.pread 的平台（Windows）退回加锁的 seek + read。
+    writable=True 时 write_block 替换块：新数据不大于原块时原地覆盖，否则追加到文件末尾，
+    并原地更新 TileOffsets/TileByteCounts。被替换的字节成为空洞，见 wasted_bytes() 与 compact_tiff()。
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = Path(path)
+        self._fh = open(self.path, 'r+b' if writable else 'rb')
+        self._fd = self._fh.fileno()
+        self._io_lock = threading.Lock()
+        self.levels = []
+        self.geo = {}
+        self._meta_end = 0  # 文件头与 IFD（含标签值）占用的末尾位置
+        self._parse()
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read(self, offset, size):
+        if HAVE_PREAD:
+            return os.pread(self._fd, size, offset)
+        with self._io_lock:
+            self._fh.seek(offset)
+            return self._fh.read(size)
+
+    def _parse(self):
+        head = self._read(0, 16)
+        bo = {b'II': '<', b'MM': '>'}.get(head[:2])
+        if bo is None:
+            raise ValueError(f'不是 TIFF 文件: {self.path}')
+        self._bo = bo
+        magic = struct.unpack(bo + 'H', head[2:4])[0]
+        self.bigtiff = magic == 43
+        if self.bigtiff:
+            offset = struct.unpack(bo + 'Q', head[8:16])[0]
+        elif magic == 42:
+            offset = struct.unpack(bo + 'I', head[4:8])[0]
+        else:
+            raise ValueError(f'不是 TIFF 文件: {self.path}')
+
+        while offset:
+            tags, offset = self._parse_ifd(offset)
+            if 322 not in tags:
+                raise ValueError(f'不是分块 TIFF: {self.path}')
+            self.levels.append(TiledLevel(tags))
+            if len(self.levels) == 1:
+                for tag in (33550, 33922):
+                    if tag in tags:
+                        self.geo[tag] = tags[tag][2]
+
+    def _parse_ifd(self, offset):
+        bo = self._bo
+        if self.bigtiff:
+            n = struct.unpack(bo + 'Q', self._read(offset, 8))[0]
+            entry_size, pos, inline = 20, offset + 8, 8
+        else:
+            n = struct.unpack(bo + 'H', self._read(offset, 2))[0]
+            entry_size, pos, inline = 12, offset + 2, 4
+        raw = self._read(pos, n * entry_size + inline)
+        self._meta_end = max(self._meta_end, pos + n * entry_size + inline)
+        tags = {}
+        for i in range(n):
+            e = raw[i * entry_size:(i + 1) * entry_size]
+            if self.bigtiff:
+                tag, typ, count = struct.unpack(bo + 'HHQ', e[:12])
+                field, field_pos = e[12:20], pos + i * entry_size + 12
+            else:
+                tag, typ, count = struct.unpack(bo + 'HHI', e[:8])
+                field, field_pos = e[8:12], pos + i * entry_size + 8
+            fmt = _TYPE_FMT.get(typ)
+            if fmt is None:
+                continue
+            nbytes = count * struct.calcsize(fmt)
+            if nbytes <= inline:
+                data, values_pos = field[:nbytes], field_pos
+            else:
+                values_pos = struct.unpack(bo + ('Q' if self.bigtiff else 'I'), field)[0]
+                data = self._read(values_pos, nbytes)
+                self._meta_end = max(self._meta_end, values_pos + nbytes)
+            if typ == ASCII:
+                values = [data.rstrip(b'\0').decode('latin-1')]
+            else:
+                values = list(struct.unpack('%s%d%s' % (bo, count, fmt), data))
+            tags[tag] = (typ, values_pos, values)
+        next_offset = struct.unpack(bo + ('Q' if self.bigtiff else 'I'), raw[n * entry_size:])[0]
+        return tags, next_offset
+
+    def read_block(self, level, bx, by):
+        """读取一个块并返回 RGBA 图像（空块返回全透明）"""
+        lvl = self.levels[level]
+        i = by * lvl.across + bx
+        size = (lvl.block_w, lvl.block_h)
+        if not lvl.counts[i]:
+            return Image.new('RGBA', size, (0, 0, 0, 0))
+        data = self._read(lvl.offsets[i], lvl.counts[i])
+        if lvl.compression in (8, 32946):
+            data = zlib.decompress(data)
+        elif lvl.compression != 1:
+            raise ValueError(f'不支持的 TIFF 压缩: {lvl.compression}')
+        mode = {3: 'RGB', 4: 'RGBA'}.get(lvl.samples)
+        if mode is None:
+            raise ValueError(f'不支持的通道数: {lvl.samples}')
+        im = Image.frombytes(mode, size, data)
+        return im if mode == 'RGBA' else im.convert('RGBA')
+
+    def write_block(self, level, bx, by, img, level_deflate=6):
+        """
+        替换一个块并更新其偏移与字节数：放得下时写回原位置，否则追加到文件末尾（旧数据成为空洞）。
+        经典 TIFF 追加后偏移会超出 32 位时抛出 OverflowError，文件不变，可先 compact_tiff(bigtiff=True)。
+        """
+        lvl = self.levels[level]
+        if lvl.samples != 4:
+            raise ValueError('仅支持写入 RGBA 分块 TIFF')
+        i = by * lvl.across + bx
+        compression = 'deflate' if lvl.compression in (8, 32946) else 'none'
+        data = _encode_block(img, compression, level_deflate)
+        with self._io_lock:
+            if lvl.counts[i] and len(data) <= lvl.counts[i]:
+                pos = lvl.offsets[i]
+                self._fh.seek(pos)
+            else:
+                self._fh.seek(0, os.SEEK_END)
+                pos = self._fh.tell()
+                if not self.bigtiff and pos + len(data) > CLASSIC_MAX_OFFSET:
+                    raise OverflowError(f'{self.path} 超出经典 TIFF 的 4GB 偏移上限')
+            self._fh.write(data)
+            for tag, value, store in ((324, pos, lvl.offsets), (325, len(data), lvl.counts)):
+                typ, values_pos, _ = lvl.tags[tag]
+                fmt = self._bo + _TYPE_FMT[typ]
+                self._fh.seek(values_pos + i * struct.calcsize(fmt))
+                self._fh.write(struct.pack(fmt, value))
+                store[i] = value
+            # 之后的 os.pread 直接读文件描述符，不经过缓冲
+            self._fh.flush()
+
+    def data_bytes(self):
+        """全部块的有效数据字节数"""
+        return sum(sum(lvl.counts) for lvl in self.levels)
+
+    def wasted_bytes(self):
+        """
+        块数据区中不属于任何块的字节（被替换的旧块、原地写入后剩余的尾部）。
+        按 COG 布局计算：IFD 在文件头部，其后全部是块数据。
+        """
+        with self._io_lock:
+            size = os.fstat(self._fd).st_size
+        start = self._meta_end + (self._meta_end & 1)  # IFD 之后按偶数对齐
+        return max(0, size - start - self.data_bytes())
+
+
+def compact_tiff(path, bigtiff=None):
+    """
+    按 COG 布局重写分块 TIFF：IFD 全部在文件头部，块数据从最小概览到全分辨率依次排列，
+    去掉增量修补留下的空洞。块按压缩后的原始字节复制，不重新编码。
+    bigtiff 为 None 时保持原格式，数据量超过 BIGTIFF_THRESHOLD 时升级为 BigTIFF。
+    """
+    path = Path(path)
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.part')
+    with TiledTiff(path) as src:
+        if bigtiff is None:
+            bigtiff = src.bigtiff or src.data_bytes() > BIGTIFF_THRESHOLD
+        off_type = LONG8 if bigtiff else LONG
+        ifds = []
+        for lvl in src.levels:
+            entries = [(tag, off_type if tag in (324, 325) else typ, values)
+                       for tag, (typ, _, values) in lvl.tags.items()]
+            ifds.append(_IFD(entries, bigtiff))
+        pos = _layout_ifds(ifds, bigtiff)
+        try:
+            with open(tmp, 'wb') as fh:
+                fh.write(b'\0' * pos)
+                for ifd, lvl in reversed(list(zip(ifds, src.levels))):
+                    offsets = []
+                    for offset, count in zip(lvl.offsets, lvl.counts):
+                        offsets.append(fh.tell() if count else 0)
+                        if count:
+                            fh.write(src._read(offset, count))
+                    ifd.set(324, offsets)
+                    ifd.set(325, lvl.counts)
+                _write_ifds(fh, ifds, bigtiff)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+    os.replace(tmp, path)
+    return path
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+metrics.py
+
+server.py 的运行指标，以 Prometheus 文本格式导出（/api/metrics），只依赖标准库：
+- Counter / Histogram：带标签、线程安全；GaugeFunc 在抓取时取值（缓存统计等）
+- 请求级阶段计时：begin_request() 把本次请求的计时器放进 contextvar，phase('read') 等
+  把独占耗时累加到当前请求（嵌套阶段只计入最内层），end_request() 按路由写入各阶段直方图
+- 慢请求与抽样访问日志，替代逐请求日志
+
+多进程（--workers）时每个进程各自计数，抓取到的是处理该请求的进程的数据。
+"""
+
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('server.access')
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PHASES = ('lookup', 'read', 'convert', 'encode')
+SLOW_REQUEST_SECONDS = 0.5  # 超过此耗时的请求记 WARNING 日志
+ACCESS_LOG_SAMPLE = 0.01    # 其余请求按此比例抽样记 INFO 日志（0 关闭）
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, '') for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in items]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # 标签 → [各桶计数（非累计）, 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, '') for n in self.labelnames)
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(e[0]), e[1], e[2])) for key, e in self._values.items())
+        out = []
+        for key, (counts, total, n) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                out.append((self.name + '_bucket',
+                            _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))]), cumulative))
+            out.append((self.name + '_sum', _format_labels(self.labelnames, key), total))
+            out.append((self.name + '_count', _format_labels(self.labelnames, key), n))
+        return out
+
+
+class GaugeFunc:
+    """抓取时调用 fn() 取值：返回数值，或 {标签值元组: 数值}"""
+
+    def __init__(self, name, help, fn, labelnames=(), kind='gauge'):
+        self.name, self.help, self.fn, self.labelnames, self.kind = name, help, fn, tuple(labelnames), kind
+
+    def samples(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [(self.name, _format_labels(self.labelnames, key), v) for key, v in sorted(value.items())]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+requests_total = registry.register(Counter(
+    'tile_server_requests_total', '按路由与状态码的请求数', ('route', 'status')))
+request_seconds = registry.register(Histogram(
+    'tile_server_request_duration_seconds', '请求总耗时（流式响应计到响应头）', ('route',)))
+phase_seconds = registry.register(Histogram(
+    'tile_server_request_phase_seconds', '请求各阶段的独占耗时：lookup 查找与判断、read 读取、convert 解码与合成、encode 编码',
+    ('route', 'phase')))
+response_bytes = registry.register(Counter(
+    'tile_server_response_bytes_total', '已知长度的响应体字节数', ('route',)))
+tile_misses = registry.register(Counter(
+    'tile_server_tile_misses_total', '请求的瓦片不存在的次数，按补救方式', ('fallback',)))
+conversions = registry.register(Counter(
+    'tile_server_conversions_total', '实际执行的转码与合成次数（不含缓存命中，含预取）', ('kind',)))
+
+_current = contextvars.ContextVar('tile_server_request', default=None)
+
+
+class RequestTimer:
+    __slots__ = ('route', 'path', 'started', 'phases', 'stack')
+
+    def __init__(self, route, path):
+        self.route, self.path = route, path
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.stack = []  # [阶段名, 本段开始时间]
+
+
+def begin_request(route, path=''):
+    timer = RequestTimer(route, path)
+    _current.set(timer)
+    return timer
+
+
+def in_request():
+    return _current.get() is not None
+
+
+@contextmanager
+def phase(name):
+    """把代码块的耗时累加到当前请求的 name 阶段；嵌套时外层阶段暂停计时"""
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    now = time.perf_counter()
+    if timer.stack:
+        outer = timer.stack[-1]
+        timer.phases[outer[0]] += now - outer[1]
+    entry = [name, now]
+    timer.stack.append(entry)
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        timer.phases[name] += now - entry[1]
+        timer.stack.pop()
+        if timer.stack:
+            timer.stack[-1][1] = now
+
+
+def record_miss(fallback):
+    """只统计真实请求（预取等后台查找不计）"""
+    if in_request():
+        tile_misses.inc(fallback=fallback)
+
+
+def end_request(timer, status, nbytes=None):
+    _current.set(None)
+    elapsed = time.perf_counter() - timer.started
+    requests_total.inc(route=timer.route, status=str(status))
+    request_seconds.observe(elapsed, route=timer.route)
+    for name, seconds in timer.phases.items():
+        if seconds:
+            phase_seconds.observe(seconds, route=timer.route, phase=name)
+    if nbytes:
+        response_bytes.inc(nbytes, route=timer.route)
+    if elapsed >= SLOW_REQUEST_SECONDS or (ACCESS_LOG_SAMPLE and random.random() < ACCESS_LOG_SAMPLE):
+        phases = ' '.join(f'{k}={v * 1000:.1f}ms' for k, v in timer.phases.items() if v)
+        message = f'{timer.path or timer.route} {status} {elapsed * 1000:.1f}ms {nbytes or 0}B {phases}'
+        if elapsed >= SLOW_REQUEST_SECONDS:
+            logger.warning(f'慢请求 {message}')
+        else:
+            logger.info(message)
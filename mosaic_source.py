@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+mosaic_source.py
+
+从 map/ 中的拼接大图按需切出 XYZ 瓦片，server.py 在本地缺失瓦片时使用：
+- 分块 TIFF/COG 通过 geotiff.TiledTiff 按块读取，只解压请求窗口覆盖的块，缩小时选用最接近的概览层
+- PNG/JPEG/WebP（以及非分块 TIFF）整图解码（限像素数）后按窗口裁剪；解码结果放在按字节限额的
+  整图 LRU 中（MOSAIC_IMAGE_CACHE_MB），不随拼接图对象常驻
+- 地理参考依次取：GeoTIFF 标签、world file（.pgw/.jgw/.tfw…，拼接输出会写出）、文件名约定：
+  README 中的 {minLon}_{minLat}_{maxLon}_{maxLat}_z{z}.*（按 stitch_tiles 的方式换算为瓦片范围），
+  或 *_z{z}_{x_min}-{x_max}_{y_min}-{y_max}.*（/api/export 的下载文件名）
+- 解码后的块放在按字节限额的 LRU 中（与 stitch_tiles 共用 DecodedTileCache），热点窗口不重复解压
+- 目录在后台线程中按间隔重新扫描（start_watcher），请求路径上只在首次使用时同步扫描一次
+"""
+
+import logging
+import math
+import re
+import threading
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from geotiff import WEB_MERCATOR_HALF, TiledTiff, tile_range_geotransform
+from stitch_tiles import DecodedTileCache, bbox_to_tile_range, world_file_path
+from tile_sources import file_stamp
+
+logger = logging.getLogger(__name__)
+
+MOSAIC_EXTS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.webp')
+_NUM = r'(-?\d+(?:\.\d+)?)'
+MOSAIC_BBOX_NAME = re.compile(rf'(?:^|_){_NUM}_{_NUM}_{_NUM}_{_NUM}_z(\d+)$')
+MOSAIC_NAME = re.compile(r'_z(\d+)_(\d+)-(\d+)_(\d+)-(\d+)$')
+MOSAIC_POLL_SECONDS = 5.0
+MOSAIC_CACHE_MB = 128
+MOSAIC_MAX_PIXELS = 64 * 1024 * 1024  # 非分块图片整图解码的像素数上限
+MOSAIC_IMAGE_CACHE_MB = 512           # 整图解码结果的 LRU 上限，至少能放下一张最大的图（64M 像素 × 4 字节）
+MOSAIC_MAX_WINDOW = 4096              # 单个瓦片最多从多大的窗口（像素）缩小，更低的 zoom 不切
+TILE_SIZE = 256
+
+
+def read_world_file(path):
+    """world file → (ulx, uly, res)；不存在、带旋转或格式不对返回 None"""
+    try:
+        a, d, b, e, c, f = [float(v) for v in Path(path).read_text(encoding='ascii').split()[:6]]
+    except (OSError, ValueError):
+        return None
+    if d or b or a <= 0 or abs(a + e) > a * 1e-6:
+        return None
+    # world file 记录的是左上像元中心
+    return c - a / 2, f + a / 2, a
+
+
+def name_tile_range(stem):
+    """由文件名约定得到 (z, x_min, x_max, y_min, y_max) 或 None"""
+    m = MOSAIC_BBOX_NAME.search(stem)
+    if m:
+        min_lon, min_lat, max_lon, max_lat = map(float, m.groups()[:4])
+        z = int(m.group(5))
+        if -180 <= min_lon < max_lon <= 180 and -90 <= min_lat < max_lat <= 90:
+            return (z,) + bbox_to_tile_range(min_lon, min_lat, max_lon, max_lat, z)
+    m = MOSAIC_NAME.search(stem)
+    if m:
+        return tuple(map(int, m.groups()))
+    return None
+
+
+def georeference(path, size, tiff=None):
+    """按 GeoTIFF 标签、world file、文件名约定的顺序取地理参考 → (ulx, uly, res) 或 None"""
+    if tiff is not None and 33550 in tiff.geo and 33922 in tiff.geo:
+        res = tiff.geo[33550][0]
+        i, j, _, x, y, _ = tiff.geo[33922][:6]
+        return x - i * res, y + j * res, res
+    geo = read_world_file(world_file_path(path))
+    if geo is not None:
+        return geo
+    found = name_tile_range(path.stem)
+    if found is None:
+        return None
+    z, x_min, x_max, y_min, y_max = found
+    cell = size[0] / (x_max - x_min + 1)
+    # 缩小输出按瓦片边长取整，高度允许 1 像素误差；对不上说明图片不是按该范围拼接的
+    if abs((y_max - y_min + 1) * cell - size[1]) > 1:
+        return None
+    return tile_range_geotransform(z, x_min, y_min, cell)
+
+
+class Mosaic:
+    """
+    一张拼接图：EPSG:3857 左上角 (ulx, uly)、像元大小 res。
+    levels 为各分辨率层级的 (宽, 高, 相对全分辨率的缩小倍数)。
+    """
+
+    def __init__(self, path, stamp, ulx, uly, res, size, tiff=None):
+        self.path = path
+        self.ulx, self.uly, self.res = ulx, uly, res
+        self.size = size
+        self.tiff = tiff
+        self.mtime = stamp[3]
+        self.tag = '{:x}-{:x}-{:x}'.format(*stamp[:3])
+        if tiff is not None:
+            self.levels = [(lvl.width, lvl.height, size[0] / lvl.width) for lvl in tiff.levels]
+        else:
+            self.levels = [(size[0], size[1], 1.0)]
+        # 像元大小对应的 zoom（256 像素瓦片）
+        self.native_zoom = round(math.log2(2 * WEB_MERCATOR_HALF / (res * TILE_SIZE)))
+        self.bounds = (ulx, uly - size[1] * res, ulx + size[0] * res, uly)
+
+    def window(self, z, x, y):
+        """(z, x, y) 在全分辨率像素坐标中的窗口 (left, top, 边长)；与图片不相交返回 None"""
+        span = 2 * WEB_MERCATOR_HALF / (1 << z)
+        west, north = -WEB_MERCATOR_HALF + x * span, WEB_MERCATOR_HALF - y * span
+        min_x, min_y, max_x, max_y = self.bounds
+        if west >= max_x or west + span <= min_x or north <= min_y or north - span >= max_y:
+            return None
+        return (west - self.ulx) / self.res, (self.uly - north) / self.res, span / self.res
+
+    def choose_level(self, side):
+        """选缩小倍数不超过 side / 256 的最粗层级，保证取到的窗口不少于 256 像素"""
+        best = 0
+        for i, (_, _, factor) in enumerate(self.levels):
+            if factor <= max(1.0, side / TILE_SIZE) + 1e-9:
+                best = i if factor >= self.levels[best][2] else best
+        return best
+
+    @property
+    def image_key(self):
+        return self.tag, 'image'
+
+    def close(self):
+        """释放文件句柄（重新扫描时替换或移除的拼接图）"""
+        if self.tiff is not None:
+            self.tiff.close()
+
+    def _decode(self):
+        with Image.open(self.path) as im:
+            return im.convert('RGBA')
+
+    def image(self, images):
+        """非分块图片的整图：从 images（DecodedTileCache）取，未命中时解码，同一张图只解码一次"""
+        return images.get_or_decode(self.image_key, self._decode)
+
+    def region(self, level, left, top, right, bottom, cache, images=None):
+        """
+        层级 level 中 [left, right) × [top, bottom) 的像素，超出图片的部分透明。
+        cache 存放分块 TIFF 的块，images 存放非分块图片的整图（默认同 cache）。
+        """
+        if self.tiff is None:
+            return self.image(images if images is not None else cache).crop((left, top, right, bottom))
+        w, h, _ = self.levels[level]
+        lvl = self.tiff.levels[level]
+        bw, bh = lvl.block_w, lvl.block_h
+        out = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+        for by in range(max(0, top) // bh, (min(h, bottom) - 1) // bh + 1):
+            for bx in range(max(0, left) // bw, (min(w, right) - 1) // bw + 1):
+                key = (self.tag, level, bx, by)
+                block = cache.get(key)
+                if block is None:
+                    block = self.tiff.read_block(level, bx, by)
+                    # 边缘块只保留图片范围内的部分
+                    block = block.crop((0, 0, min(bw, w - bx * bw), min(bh, h - by * bh)))
+                    cache.put(key, block)
+                out.paste(block, (bx * bw - left, by * bh - top))
+        return out
+
+    def render(self, z, x, y, cache, images=None):
+        """切出 256×256 的 RGBA 瓦片；与图片不相交返回 None"""
+        win = self.window(z, x, y)
+        if win is None:
+            return None
+        left, top, side = win
+        level = self.choose_level(side)
+        factor = self.levels[level][2]
+        left, top, side = left / factor, top / factor, side / factor
+        l, t = math.floor(left), math.floor(top)
+        r, b = math.ceil(left + side), math.ceil(top + side)
+        region = self.region(level, l, t, r, b, cache, images)
+        box = (left - l, top - t, left - l + side, top - t + side)
+        return region.resize((TILE_SIZE, TILE_SIZE), Image.LANCZOS if side > TILE_SIZE else Image.BICUBIC, box=box)
+
+
+def open_mosaic(path):
+    """打开一张拼接图；没有地理参考或无法读取时返回 None"""
+    path = Path(path)
+    stamp = file_stamp(path)
+    tiff = None
+    if path.suffix.lower() in ('.tif', '.tiff'):
+        try:
+            tiff = TiledTiff(path)
+        except (OSError, ValueError):
+            tiff = None  # 非分块 TIFF 退回整图解码
+    if tiff is not None:
+        size = tiff.levels[0].size
+    else:
+        with Image.open(path) as im:
+            size = im.size
+        if size[0] * size[1] > MOSAIC_MAX_PIXELS:
+            logger.warning(f"{path.name} 过大（{size[0]}×{size[1]}）且不是分块 TIFF，跳过；请用 --format COG 重新拼接")
+            return None
+    geo = georeference(path, size, tiff)
+    if geo is None:
+        logger.info(f"{path.name} 没有地理参考（GeoTIFF 标签、world file 或 "
+                    f"{{minLon}}_{{minLat}}_{{maxLon}}_{{maxLat}}_z{{z}} 文件名），跳过")
+        if tiff is not None:
+            tiff.close()
+        return None
+    return Mosaic(path, stamp, *geo, size, tiff)
+
+
+class MosaicSource:
+    """
+    目录中的全部拼接图。首次使用时扫描一次，之后由后台线程（start_watcher）按间隔比对文件身份并重新扫描；
+    查找按分辨率从细到粗，取第一张覆盖该瓦片且在可切 zoom 范围内的图。
+    overzoom 为超过图片自身 zoom 后最多再放大几级。
+    """
+
+    def __init__(self, root, poll=MOSAIC_POLL_SECONDS, overzoom=4, cache_mb=MOSAIC_CACHE_MB,
+                 image_cache_mb=MOSAIC_IMAGE_CACHE_MB):
+        self.root = Path(root)
+        self.poll = poll
+        self.overzoom = overzoom
+        self.cache = DecodedTileCache(cache_mb * 1024 * 1024)
+        self.images = DecodedTileCache(image_cache_mb * 1024 * 1024)
+        self.mosaics = []
+        self.rendered = 0
+        self.loaded = False
+        self._stamps = None
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def _scan_stamps(self):
+        stamps = {}
+        if not self.root.is_dir():
+            return stamps
+        for path in self.root.rglob('*'):
+            if path.suffix.lower() in MOSAIC_EXTS and not path.name.startswith('.'):
+                try:
+                    stamps[path] = file_stamp(path)
+                except OSError:
+                    continue
+        return stamps
+
+    def _close(self, mosaic):
+        mosaic.close()
+        self.images.discard(mosaic.image_key)
+
+    def rescan(self):
+        """比对文件身份，有变化时重新打开；返回是否有变化"""
+        with self._lock:
+            stamps = self._scan_stamps()
+            self.loaded = True
+            if self._stamps is not None and {p: s[:3] for p, s in stamps.items()} == \
+                    {p: s[:3] for p, s in self._stamps.items()}:
+                return False
+            # 未变化的文件沿用已打开的拼接图，被替换或删除的关闭文件句柄并丢弃解码的整图
+            previous = {m.path: m for m in self.mosaics}
+            old_stamps = self._stamps or {}
+            mosaics = []
+            for path in sorted(stamps):
+                mosaic = previous.pop(path, None)
+                if mosaic is not None and old_stamps.get(path, ())[:3] == stamps[path][:3]:
+                    mosaics.append(mosaic)
+                    continue
+                if mosaic is not None:
+                    self._close(mosaic)
+                try:
+                    mosaic = open_mosaic(path)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"无法打开拼接图 {path}: {e}")
+                    continue
+                if mosaic is not None:
+                    mosaics.append(mosaic)
+            # 同等分辨率时优先分块 TIFF（按块读取，不必整图解码）
+            mosaics.sort(key=lambda m: (m.res, m.tiff is None))
+            self.mosaics = mosaics
+            self._stamps = stamps
+            for stale in previous.values():
+                self._close(stale)
+            if mosaics:
+                logger.info(f"拼接图来源: {len(mosaics)} 张（{self.root}）")
+            return True
+
+    def ensure_loaded(self):
+        """首次使用时同步扫描；之后的变化由 start_watcher 的后台线程发现"""
+        if not self.loaded:
+            self.rescan()
+
+    def start_watcher(self, interval=None):
+        """后台按间隔重新扫描目录，rglob 与 stat 不在请求路径上进行"""
+        interval = self.poll if interval is None else interval
+        if self._watcher is not None or interval <= 0:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.rescan()
+                except Exception as e:
+                    logger.warning(f"重新扫描拼接图失败: {e}")
+                time.sleep(interval)
+
+        self._watcher = threading.Thread(target=loop, name='mosaic-watcher', daemon=True)
+        self._watcher.start()
+
+    def find(self, z, x, y):
+        """覆盖 (z, x, y) 的拼接图或 None"""
+        self.ensure_loaded()
+        for mosaic in self.mosaics:
+            if z > mosaic.native_zoom + self.overzoom:
+                continue
+            win = mosaic.window(z, x, y)
+            if win is None:
+                continue
+            factor = mosaic.levels[mosaic.choose_level(win[2])][2]
+            if win[2] / factor > MOSAIC_MAX_WINDOW:
+                continue
+            return mosaic
+        return None
+
+    def render(self, mosaic, z, x, y):
+        self.rendered += 1
+        return mosaic.render(z, x, y, self.cache, self.images)
+
+    def stats(self):
+        return {
+            'mosaics': [{'path': str(m.path), 'size': list(m.size), 'zoom': m.native_zoom,
+                         'levels': len(m.levels)} for m in self.mosaics],
+            'rendered': self.rendered,
+            'block_cache': self.cache.stats(),
+            'image_cache': self.images.stats(),
+        }
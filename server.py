@@ -4,29 +4,255 @@ server.py
 
 Flask Web 服务器，发布瓦片服务。
 - 从与本脚本同目录的 out/ 读取瓦片（结构：out/{z}/{x}/{y}.xxx）
-- 提供 /tiles/{z}/{x}/{y}.png 接口（CORS 支持）
+- 提供 /tiles/{z}/{x}/{y}.png 接口（CORS 支持）；按 Accept 头协商，浏览器支持时直接返回原始 WebP/JPEG
+- 提供 /tiles/{z}/{x}/{y}.webp、.jpg 接口，格式一致时原样返回存储字节
 - 首页自动估算瓦片覆盖范围并居中显示
+- 启动时建立 out/ 的内存索引（每列一个 bytearray），后台轮询目录 mtime 跟进爬虫新写入的瓦片，
+  查找与未命中都不产生文件系统调用
+- 首页范围与 /api/tile-stats 读取爬虫维护的覆盖清单 out/coverage.json，过期时后台增量重扫
+- 瓦片响应带强 ETag（inode/mtime/大小/格式）与 Last-Modified，条件请求在打开或转码文件之前返回 304；
+  --immutable 时带版本号（?v=）的瓦片 URL 返回 immutable 长缓存
+- --async 时改用 async_server.py 的异步服务（sendfile 零拷贝、有界转码线程池、keep-alive/流水线、多进程）
+- 缺失的高层级瓦片由最近的祖先瓦片裁剪放大合成（overzoom，--overzoom 设置最多向上几级）
+- 缺失的低层级瓦片由 2×2 子瓦片拼合缩小（underzoom，--underzoom 设置递归深度），结果持久缓存在 out/.underzoom/
+- --proxy 时作为上游的读穿缓存代理：缺失瓦片按 config.json 的模板请求、写入 out/ 后返回，
+  同一瓦片的并发请求合并，每个上游主机限制并发
+- 瓦片来源可插拔：默认 out/ 目录，--source 可指定 MBTiles / PMTiles 单文件（见 tile_sources.py）
+- 转码后的瓦片响应体缓存在按字节限额的 LRU 中，并发未命中合并为一次转码（/api/cache-stats）
 """
 
-from flask import Flask, send_file, render_template_string, jsonify, make_response
+from flask import Flask, Response, g, request, send_file, render_template_string, jsonify, make_response
 from flask_cors import CORS
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Callable, NamedTuple, Optional
+from urllib.parse import urlsplit
+from PIL import Image
+from werkzeug.http import http_date, parse_date
+import argparse
+import functools
+import hashlib
+import io
 import os
 import logging
 import math
+import re
+import struct
+import sys
+import tarfile
+import threading
+import time
+
+import coverage_manifest
+import metrics
+from canvas import HAVE_NUMPY, TileStripCanvas
+from metrics import phase, record_miss
+from mosaic_source import MosaicSource
+from encoders import PNG_FILTER_PEAK, iter_png, png_band_rows
+from stitch_tiles import bbox_to_tile_range
+from tile_sources import Tile, open_archive
 
 app = Flask(__name__)
 CORS(app)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# 逐请求的访问日志由 metrics 的慢请求/抽样日志代替
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
 # 瓦片目录：与 server.py 同目录下的 out/
 TILES_DIR = Path(__file__).resolve().parent / 'out'
-MAPS_DIR = Path(__file__).resolve().parent / 'map'  # 保留但未使用
+MAPS_DIR = Path(__file__).resolve().parent / 'map'  # 拼接大图目录，缺失瓦片可由其中的大图切出
 
 PREFERRED_EXTS = ['png', 'webp', 'jpg', 'jpeg']
 
+RESPONSE_CACHE_MB = 256
+INDEX_POLL_SECONDS = 5.0
+COVERAGE_REFRESH_SECONDS = 30.0
+TILE_MAX_AGE = 86400
+IMMUTABLE_MAX_AGE = 31536000
+IMMUTABLE_TILES = False  # --immutable：?v= 与当前瓦片集版本一致时返回 immutable 长缓存
+OVERZOOM_LEVELS = 4      # 缺失瓦片最多向上找几级祖先裁剪放大（0 关闭）
+UNDERZOOM_DEPTH = 2      # 缺失瓦片最多向下几级由子瓦片拼合缩小（0 关闭）
+UNDERZOOM_CACHE_DIR = TILES_DIR / '.underzoom'  # 拼合结果的磁盘缓存（非数字目录名，不进入索引）
+PROXY_CONCURRENCY = 4       # 读穿代理每个上游主机的最大并发
+PROXY_RETRY_SECONDS = 60.0  # 上游请求失败的瓦片在此时间内不再请求
+PROXY_FAILED_MAX = 65536    # 失败记录的条数上限（扫描大片缺失区域时不无限增长）
+PROXY_MAX_AGE = 60          # 代理请求结果（可能是失败后的占位图）的浏览器缓存时间
+EXPORT_CONCURRENCY = 2      # 同时进行的导出数，超出返回 503
+EXPORT_MEMORY_MB = 256      # 单个导出的峰值内存预算（条带缓存 + 编码行带），总量约为其 EXPORT_CONCURRENCY 倍
+EXPORT_STRIPS = 3           # 导出条带画布缓存的瓦片行数
+EXPORT_ENCODE_WORKERS = 2   # 导出 PNG 的编码线程数
+EXPORT_MAX_TILES = 65536    # 导出瓦片总数上限
+EXPORT_MAX_PIXELS = 16 * 1024 * 1024  # JPEG/WebP 需整图编码，像素数上限
+EXPORT_CACHE_DIR = TILES_DIR / '.exports'  # 最近导出结果的磁盘缓存
+EXPORT_CACHE_MB = 1024
+BATCH_MAX_TILES = 65536     # 批量接口单次请求的瓦片数上限
+PREFETCH_WORKERS = 1        # 邻居预取线程数（0 关闭）
+PREFETCH_QUEUE = 256        # 预取队列上限，满了丢弃最旧的任务
+PREFETCH_BUDGET = 0.25      # 预取后尚未被请求的条目最多占响应缓存的比例
+
+# 扩展名 → (Pillow 格式, MIME 类型)
+TILE_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+
+
+class _Flight:
+    """一次进行中的构建；同键的并发请求等待其结果"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """
+    响应体 LRU 缓存，按字节数限额。
+    get_or_build 对同一键的并发未命中做 single-flight：只有第一个请求执行构建，其余等待并复用结果。
+    在 speculative() 中写入的条目（预取）单独记账，被真实请求命中后才转为普通条目；
+    预取自身的查找不计入命中统计，也不刷新 LRU 顺序。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.speculative_bytes = 0
+        self.prefetch_hits = 0
+        self.prefetch_wasted = 0
+        self._items = OrderedDict()
+        self._speculative = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def speculative(self):
+        """在此上下文中（当前线程）的查找与写入视为预取"""
+        self._local.speculative = True
+        try:
+            yield
+        finally:
+            self._local.speculative = False
+
+    def _is_speculative(self):
+        return getattr(self._local, 'speculative', False)
+
+    def _hit(self, key):
+        """持锁调用：真实请求命中时刷新 LRU 并把预取条目转为普通条目"""
+        self._items.move_to_end(key)
+        self.hits += 1
+        size = self._speculative.pop(key, None)
+        if size is not None:
+            self.speculative_bytes -= size
+            self.prefetch_hits += 1
+
+    def _forget(self, key, value):
+        """持锁调用：条目被替换或淘汰"""
+        self.bytes -= len(value[0])
+        size = self._speculative.pop(key, None)
+        if size is not None:
+            self.speculative_bytes -= size
+            return True
+        return False
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key):
+        speculative = self._is_speculative()
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None and not speculative:
+                self._hit(key)
+            return value
+
+    def put(self, key, value):
+        body = value[0]
+        if len(body) > self.max_bytes:
+            return
+        speculative = self._is_speculative()
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+            self._items[key] = value
+            self.bytes += len(body)
+            if speculative:
+                self._speculative[key] = len(body)
+                self.speculative_bytes += len(body)
+            while self.bytes > self.max_bytes:
+                evicted_key, evicted = self._items.popitem(last=False)
+                if self._forget(evicted_key, evicted):
+                    self.prefetch_wasted += 1
+                self.evictions += 1
+
+    def get_or_build(self, key, build):
+        """返回 (body, mimetype)；未命中时调用 build() 构建并缓存"""
+        speculative = self._is_speculative()
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                if not speculative:
+                    self._hit(key)
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                if not speculative:
+                    self.misses += 1
+            elif not speculative:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = build()
+            self.put(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._items),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'hit_ratio': round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+                'speculative_bytes': self.speculative_bytes,
+                'prefetch_hits': self.prefetch_hits,
+                'prefetch_wasted': self.prefetch_wasted,
+            }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_MB * 1024 * 1024)
+
 
 def tile_xy_to_latlon(x, y, z):
     """将瓦片坐标 (x, y, z) 转换为经纬度 (lat, lon)"""
@@ -39,56 +265,299 @@ def tile_xy_to_latlon(x, y, z):
 
 def estimate_bbox_from_tiles():
     """
-    扫描 TILES_DIR，估算已有瓦片的大致地理范围。
+    由覆盖清单估算已有瓦片的地理范围（取最高 zoom，通常细节最丰富）。
     返回 (min_lon, min_lat, max_lon, max_lat, zoom_used) 或 None
     """
     try:
-        z_dirs = [d for d in TILES_DIR.iterdir() if d.is_dir() and d.name.isdigit()]
-        if not z_dirs:
+        zooms = tile_source.summary()
+        zooms = [(int(z), info) for z, info in zooms.items() if info.get('count') and info.get('bounds')]
+        if not zooms:
             return None
+        z, info = max(zooms, key=lambda item: item[0])
+        min_lon, min_lat, max_lon, max_lat = info['bounds']
+        return min_lon, min_lat, max_lon, max_lat, z
+
+    except Exception as e:
+        logger.warning(f"估算瓦片范围失败: {e}")
+        return None
+
+
+class CoverageCache:
+    """
+    读取并缓存覆盖清单。清单文件变化（爬虫写入）时重新加载；
+    清单生成时间早于瓦片目录的最新修改时视为过期，在后台线程增量重扫（最短间隔 COVERAGE_REFRESH_SECONDS）。
+    没有清单时同步生成一次。
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.data = None
+        self._stamp = None
+        self._refreshing = False
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def _newest_tile_mtime(self):
+        if USE_TILE_INDEX and tile_index.loaded:
+            return tile_index.newest_mtime
+        newest = 0
+        try:
+            for entry in os.scandir(self.root):
+                if entry.name.isdigit() and entry.is_dir():
+                    newest = max(newest, entry.stat().st_mtime_ns)
+        except OSError:
+            pass
+        return newest
 
-        # 选择最高 zoom（通常细节最丰富）
-        z_dir = max(z_dirs, key=lambda d: int(d.name))
-        z = int(z_dir.name)
+    def _reload(self):
+        try:
+            st = os.stat(coverage_manifest.manifest_path(self.root))
+        except OSError:
+            return
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp != self._stamp:
+            data = coverage_manifest.load(self.root)
+            if data is not None:
+                self.data, self._stamp = data, stamp
 
-        all_x = []
-        all_y = []
+    def _refresh(self):
+        try:
+            started = time.time()
+            self.data = coverage_manifest.refresh(self.root, self.data)
+            self._stamp = None
+            logger.info(f"覆盖清单已重扫，用时 {time.time() - started:.2f}s")
+        except Exception as e:
+            logger.warning(f"重扫覆盖清单失败: {e}")
+        finally:
+            self._last_refresh = time.time()
+            self._refreshing = False
 
-        for x_dir in z_dir.iterdir():
-            if x_dir.is_dir() and x_dir.name.isdigit():
-                x = int(x_dir.name)
-                all_x.append(x)
-                for y_file in x_dir.glob('*.*'):
-                    if y_file.stem.isdigit():
-                        y = int(y_file.stem)
-                        all_y.append(y)
+    def get(self):
+        self._reload()
+        if self.data is None:
+            with self._lock:
+                if self.data is None:
+                    self._refreshing = True
+                    self._refresh()
+            return self.data
+        stale = self.data.get('updated_ns', 0) < self._newest_tile_mtime()
+        if stale and not self._refreshing and time.time() - self._last_refresh > COVERAGE_REFRESH_SECONDS:
+            with self._lock:
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh, name='coverage-refresh', daemon=True).start()
+        return self.data
 
-        if not all_x or not all_y:
+
+class TileIndex:
+    """
+    out/ 目录的内存索引。
+    每个 zoom 为 {x: (列目录 mtime_ns, y0, bytearray)}，bytearray[y - y0] 为扩展名编码（0 表示无瓦片），
+    每个瓦片只占 1 字节；查找为两次字典/数组访问，不触碰文件系统。
+    后台线程按间隔比较 zoom/列目录的 mtime，只重扫发生变化的列。
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.exts = [''] + PREFERRED_EXTS  # 编码 → 扩展名，编码越小优先级越高
+        self.zooms = {}                    # z → (zoom 目录 mtime_ns, {x: 列})
+        self.version = 0                   # 每次内容变化递增
+        self.newest_mtime = 0              # 所有 zoom/列目录中最新的 mtime_ns
+        self.loaded = False
+        self._lock = threading.RLock()         # zooms 的替换、exts 的追加与 add() 在锁内进行
+        self._refresh_lock = threading.Lock()  # 重扫（首次加载与轮询线程）串行进行
+        self._pending = None                   # 重扫期间 add() 登记的瓦片，替换 zooms 后重放
+        self._watcher = None
+
+    def _ext_code(self, ext):
+        try:
+            return self.exts.index(ext)
+        except ValueError:
+            pass
+        with self._lock:
+            if ext in self.exts:
+                return self.exts.index(ext)
+            if len(self.exts) >= 255:
+                return 0
+            self.exts.append(ext)
+            return len(self.exts) - 1
+
+    def _scan_column(self, path, mtime):
+        ys = {}
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    stem, dot, ext = entry.name.partition('.')
+                    if not dot or not stem.isdigit() or ext.endswith('part'):
+                        continue
+                    code = self._ext_code(ext.lower())
+                    y = int(stem)
+                    if code and (y not in ys or code < ys[y]):
+                        ys[y] = code
+        except OSError:
             return None
+        if not ys:
+            return mtime, 0, bytearray()
+        y0 = min(ys)
+        codes = bytearray(max(ys) - y0 + 1)
+        for y, code in ys.items():
+            codes[y - y0] = code
+        return mtime, y0, codes
 
-        x_min, x_max = min(all_x), max(all_x)
-        y_min, y_max = min(all_y), max(all_y)
+    def _scan_zoom(self, z_path, old_cols):
+        """重扫一个 zoom：列目录 mtime 未变的列直接复用"""
+        cols = {}
+        changed = False
+        try:
+            entries = list(os.scandir(z_path))
+        except OSError:
+            return {}, True
+        # 最近 2 秒内变化过的列总是重扫，避免粗粒度 mtime 的文件系统漏掉同一时刻的写入
+        recent = time.time_ns() - 2_000_000_000
+        for entry in entries:
+            if not entry.name.isdigit() or not entry.is_dir():
+                continue
+            x = int(entry.name)
+            mtime = entry.stat().st_mtime_ns
+            old = old_cols.get(x)
+            if old is not None and old[0] == mtime and mtime < recent:
+                cols[x] = old
+                continue
+            col = self._scan_column(entry.path, mtime)
+            if col is not None:
+                cols[x] = col
+                changed = True
+        return cols, changed or len(cols) != len(old_cols)
 
-        # 注意：Slippy map 的 y 增加方向是向下，所以：
-        # 左上角 = (x_min, y_min) → 对应 (max_lat, min_lon)
-        # 右下角 = (x_max, y_max) → 对应 (min_lat, max_lon)
-        lat_ne, lon_nw = tile_xy_to_latlon(x_min, y_min, z)   # 左上
-        lat_sw, lon_se = tile_xy_to_latlon(x_max, y_max, z)   # 右下
+    def refresh(self):
+        """比较目录 mtime 并重扫变化部分；返回是否有变化"""
+        with self._refresh_lock:
+            return self._refresh()
 
-        min_lat = min(lat_sw, lat_ne)
-        max_lat = max(lat_sw, lat_ne)
-        min_lon = min(lon_nw, lon_se)
-        max_lon = max(lon_nw, lon_se)
+    def _refresh(self):
+        # 扫描在锁外进行（查找与 add() 不等待），期间 add() 登记的瓦片在替换后重放
+        with self._lock:
+            self._pending = []
+        changed = False
+        zooms = {}
+        try:
+            z_entries = [e for e in os.scandir(self.root) if e.name.isdigit() and e.is_dir()]
+        except OSError:
+            z_entries = []
+        for entry in z_entries:
+            z = int(entry.name)
+            old_mtime, old_cols = self.zooms.get(z, (None, {}))
+            mtime = entry.stat().st_mtime_ns
+            # 新瓦片写入列目录只改变列目录 mtime，因此即便 zoom 目录未变也要检查各列
+            cols, col_changed = self._scan_zoom(entry.path, old_cols)
+            zooms[z] = (mtime, cols)
+            changed = changed or col_changed or old_mtime != mtime
+        with self._lock:
+            if set(zooms) != set(self.zooms):
+                changed = True
+            self.zooms = zooms
+            self.newest_mtime = max([m for m, _ in zooms.values()]
+                                    + [col[0] for _, cols in zooms.values() for col in cols.values()] + [0])
+            pending, self._pending = self._pending, None
+            for tile in pending:
+                self._add(*tile)
+            if changed or pending:
+                self.version += 1
+        return changed
 
-        return min_lon, min_lat, max_lon, max_lat, z
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        with self._refresh_lock:
+            if not self.loaded:
+                started = time.time()
+                self._refresh()
+                self.loaded = True
+                logger.info(f"瓦片索引完成: {self.count()} 个瓦片，用时 {time.time() - started:.2f}s")
+
+    def start_watcher(self, interval=INDEX_POLL_SECONDS):
+        """后台轮询目录 mtime，爬虫写入中也能及时看到新瓦片"""
+        if self._watcher is not None or interval <= 0:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.refresh():
+                        logger.debug(f"瓦片索引已更新（版本 {self.version}）")
+                except Exception as e:
+                    logger.warning(f"刷新瓦片索引失败: {e}")
+
+        self._watcher = threading.Thread(target=loop, name='tile-index-watcher', daemon=True)
+        self._watcher.start()
+
+    def lookup_ext(self, z, x, y):
+        """返回扩展名或 None"""
+        zoom = self.zooms.get(z)
+        if zoom is None:
+            return None
+        col = zoom[1].get(x)
+        if col is None:
+            return None
+        i = y - col[1]
+        if i < 0 or i >= len(col[2]):
+            return None
+        code = col[2][i]
+        return self.exts[code] if code else None
+
+    def lookup(self, z, x, y):
+        ext = self.lookup_ext(z, x, y)
+        if ext is None:
+            return None
+        return self.root / str(z) / str(x) / f'{y}.{ext}'
+
+    def add(self, z, x, y, ext):
+        """登记刚写入的瓦片（读穿代理使用），不必等下一次轮询；列 mtime 置 0 使下次轮询重扫该列"""
+        with self._lock:
+            self._add(z, x, y, ext)
+            if self._pending is not None:
+                self._pending.append((z, x, y, ext))
+            self.version += 1
+
+    def _add(self, z, x, y, ext):
+        # 调用方持有 self._lock
+        cols = self.zooms.setdefault(z, (0, {}))[1]
+        code = self._ext_code(ext)
+        _, y0, codes = cols.get(x, (0, y, bytearray()))
+        lo = min(y0, y) if codes else y
+        hi = max(y0 + len(codes) - 1, y) if codes else y
+        new = bytearray(hi - lo + 1)
+        new[y0 - lo:y0 - lo + len(codes)] = codes
+        if not new[y - lo] or code < new[y - lo]:
+            new[y - lo] = code
+        cols[x] = (0, lo, new)  # 整体替换，无锁读取的查找看到的要么是旧列要么是新列
+        self.newest_mtime = max(self.newest_mtime, time.time_ns())
+
+    def count(self, z=None):
+        zooms = [z] if z is not None else list(self.zooms)
+        total = 0
+        for zz in zooms:
+            for col in self.zooms.get(zz, (0, {}))[1].values():
+                total += len(col[2]) - col[2].count(0)
+        return total
 
-    except Exception as e:
-        logger.warning(f"估算瓦片范围失败: {e}")
-        return None
+
+tile_index = TileIndex(TILES_DIR)
+USE_TILE_INDEX = True
+coverage = CoverageCache(TILES_DIR)
 
 
 def find_tile_file(z: int, x: int, y: int):
-    """查找瓦片文件，优先返回 PNG"""
+    """查找瓦片文件，优先返回 PNG；启用索引时在内存中完成（轮询线程由 main / on_worker_start 按 --index-poll 启动）"""
+    if USE_TILE_INDEX:
+        tile_index.ensure_loaded()
+        return tile_index.lookup(z, x, y)
+    return probe_tile_file(z, x, y)
+
+
+def probe_tile_file(z: int, x: int, y: int):
+    """逐个扩展名探测文件系统（未启用索引时使用）"""
     tile_dir = TILES_DIR / str(z) / str(x)
     tile_base = tile_dir / str(y)
 
@@ -112,6 +581,154 @@ def find_tile_file(z: int, x: int, y: int):
     return None
 
 
+class DirectorySource:
+    """out/ 松散文件目录（默认来源）；查找走内存索引或文件系统探测"""
+
+    kind = 'directory'
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def lookup(self, z, x, y):
+        tile_path = find_tile_file(z, x, y)
+        if tile_path is None:
+            return None
+        st = tile_path.stat()
+        tag = f'{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}'
+        return Tile(tile_path.suffix.lower().lstrip('.'), st.st_mtime, tag, tile_path, 0, st.st_size)
+
+    def read(self, tile):
+        return tile.path.read_bytes()
+
+    def version(self):
+        """
+        瓦片集版本：所有 zoom/列目录中最新的 mtime（写入、替换、删除瓦片都会改变列目录 mtime）。
+        不使用内存索引时退回覆盖清单的生成时间。
+        """
+        if USE_TILE_INDEX:
+            tile_index.ensure_loaded()
+            return format(tile_index.newest_mtime, 'x')
+        return format((coverage.get() or {}).get('updated_ns', 0), 'x')
+
+    def summary(self):
+        return coverage_manifest.summary(coverage.get())
+
+
+tile_source = DirectorySource(TILES_DIR)
+
+
+class UpstreamProxy:
+    """
+    读穿代理：本地缺失的瓦片按 config.json 的模板向上游请求，写入 out/ 后返回。
+    - 请求头、tokens、代理与下载沿用 tile_crawler（request_options / download_tile）
+    - 同一瓦片的并发请求合并为一次上游请求
+    - 每个上游主机一个信号量限制并发，排队超时的请求直接放弃；失败的瓦片在 retry_after 秒内不再请求，
+      失败记录按时间先后存放，过期或超过 max_failed 条时丢弃最早的
+    - 上游没有该瓦片（404）或请求失败（其余错误，按 502 处理）时不写入任何文件
+    """
+
+    def __init__(self, template, headers, tokens, proxies, outdir, concurrency=4, timeout=15, retries=1,
+                 retry_after=PROXY_RETRY_SECONDS, max_failed=PROXY_FAILED_MAX):
+        import tile_crawler  # 依赖 requests，仅代理模式需要
+        self.crawler = tile_crawler
+        self.template = template
+        self.headers = headers
+        self.tokens = tokens
+        self.session = tile_crawler.make_session(proxies)
+        self.outdir = Path(outdir)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_after = retry_after
+        self.max_failed = max_failed
+        self.fetched = self.failures = self.coalesced = self.skipped = 0
+        self._limits = {}
+        self._failed = OrderedDict()  # (z, x, y) → (失败时间, 状态码)，按失败时间排序
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            sem = self._limits.get(host)
+            if sem is None:
+                sem = self._limits[host] = threading.BoundedSemaphore(self.concurrency)
+            return sem
+
+    def recently_failed(self, z, x, y):
+        """retry_after 秒内失败过时返回当时的状态码（404 或 502），否则 None"""
+        failed = self._failed.get((z, x, y))
+        if failed is None or time.monotonic() - failed[0] >= self.retry_after:
+            return None
+        return failed[1]
+
+    def _record_failure(self, key, status):
+        now = time.monotonic()
+        with self._lock:
+            failed = self._failed
+            failed.pop(key, None)
+            failed[key] = (now, status)
+            while failed:
+                oldest = next(iter(failed.values()))[0]
+                if len(failed) <= self.max_failed and now - oldest < self.retry_after:
+                    break
+                failed.popitem(last=False)
+
+    def fetch(self, z, x, y):
+        """请求并保存瓦片；成功返回 200，否则返回 404（上游没有）、502（上游出错）或 503（排队超时）"""
+        key = (z, x, y)
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            return flight.value
+
+        try:
+            flight.value = self._download(z, x, y)
+            return flight.value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def _download(self, z, x, y):
+        url = self.crawler.format_tile_url(self.template, z, x, y, self.tokens)
+        sem = self._limit(url)
+        if not sem.acquire(timeout=self.timeout):
+            # 本地排队超时不是上游的问题，不记入失败
+            self.skipped += 1
+            return 503
+        try:
+            out_base = os.path.join(str(self.outdir), str(z), str(x), str(y))
+            res, status = self.crawler.fetch_tile(self.session, url, out_base, timeout=self.timeout,
+                                                  retries=self.retries, headers=self.headers, skip_existing=False)
+        finally:
+            sem.release()
+        if not res:
+            self.failures += 1
+            status = 404 if status == 404 else 502
+            self._record_failure((z, x, y), status)
+            return status
+        self.fetched += 1
+        with self._lock:
+            self._failed.pop((z, x, y), None)
+        tile_index.add(z, x, y, os.path.splitext(res)[1].lstrip('.').lower())
+        return 200
+
+    def stats(self):
+        return {'fetched': self.fetched, 'failures': self.failures, 'coalesced': self.coalesced,
+                'skipped': self.skipped, 'concurrency': self.concurrency, 'failed_entries': len(self._failed)}
+
+
+upstream = None  # --proxy 时为 UpstreamProxy
+mosaics = MosaicSource(MAPS_DIR, overzoom=OVERZOOM_LEVELS)  # --no-mosaics 时为 None
+
+
 @app.route('/')
 def index():
     bbox_info = estimate_bbox_from_tiles()
@@ -127,6 +744,8 @@ def index():
         center_lat, center_lon, init_zoom = 0.0, 0.0, 2
         coverage_text = "未检测到瓦片（请检查 out/ 目录）"
 
+    tile_query = f'?v={tile_set_version()}' if IMMUTABLE_TILES else ''
+
     html = f'''
 <!DOCTYPE html>
 <html>
@@ -168,7 +787,12 @@ def index():
     <script>
         const map = L.map('map').setView([{center_lat}, {center_lon}], {init_zoom});
 
-        const tileLayer = L.tileLayer('/tiles/{{z}}/{{x}}/{{y}}.png', {{
+        // 高分屏使用 512px 的 @2x 瓦片（由下一级 2×2 瓦片拼成），同样清晰度下请求数为 1/4；
+        // 不设 detectRetina，否则 Leaflet 会把 tileSize 减半并抵消 zoomOffset
+        const retina = window.devicePixelRatio > 1;
+        const tileLayer = L.tileLayer(retina ? '/tiles/{{z}}/{{x}}/{{y}}@2x.png{tile_query}' : '/tiles/{{z}}/{{x}}/{{y}}.png{tile_query}', {{
+            tileSize: retina ? 512 : 256,
+            zoomOffset: retina ? -1 : 0,
             attribution: '本地瓦片服务',
             minZoom: 7,
             maxZoom: 14,
@@ -195,75 +819,1043 @@ def index():
     return render_template_string(html)
 
 
-@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
-def get_tile(z, x, y):
-    tile_path = find_tile_file(z, x, y)
+def encode_png(img):
+    """RGBA PNG 字节"""
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+    img_io = io.BytesIO()
+    img.save(img_io, 'PNG')
+    return img_io.getvalue()
+
 
-    if tile_path is None:
-        logger.debug(f"Tile not found: {z}/{x}/{y}")
-        from PIL import Image
-        import io
-        img = Image.new('RGBA', (256, 256), (0, 0, 0, 0))
+def encode_image(img, ext):
+    """按扩展名编码（png/webp/jpg），JPEG 去掉 alpha"""
+    pil_format, mimetype = TILE_FORMATS[ext]
+    with phase('encode'):
+        if pil_format == 'PNG':
+            return encode_png(img), mimetype
+        img = img.convert('RGB' if pil_format == 'JPEG' else 'RGBA')
         img_io = io.BytesIO()
-        img.save(img_io, 'PNG')
-        img_io.seek(0)
-        resp = make_response(send_file(img_io, mimetype='image/png'))
-        resp.headers['Cache-Control'] = 'public, max-age=3600'
-        return resp
+        img.save(img_io, pil_format, quality=90)
+        return img_io.getvalue(), mimetype
+
+
+def load_tile_image(tile):
+    """读取并解码瓦片为 RGBA（分别计入 read 与 convert 阶段）"""
+    with phase('read'):
+        data = tile.path.read_bytes() if tile.whole_file else tile_source.read(tile)
+    with phase('convert'), Image.open(io.BytesIO(data)) as img:
+        return img.convert('RGBA')
+
+
+def accepts(mimetype, headers=None):
+    """请求的 Accept 头是否明确接受该图片类型（image/* 也算，裸 */* 不算）"""
+    headers = request.headers if headers is None else headers
+    for item in headers.get('Accept', '').split(','):
+        media, _, params = item.strip().partition(';')
+        if media.strip() in (mimetype, 'image/*'):
+            q = params.strip()
+            if q.startswith('q='):
+                try:
+                    return float(q[2:]) > 0
+                except ValueError:
+                    return True
+            return True
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def blank_tile(color=(0, 0, 0, 0)):
+    """纯色占位瓦片（常驻；并发的首次请求各自编码，不在 single-flight 上等待，事件循环上也可直接调用）"""
+    return encode_png(Image.new('RGBA', (256, 256), color)), 'image/png'
+
+
+def convert_tile(tile, ext='png'):
+    """将瓦片转为 ext 指定的格式，返回 (body, mimetype)"""
+    metrics.conversions.inc(kind='convert')
+    return encode_image(load_tile_image(tile), ext)
+
+
+def tile_response(body, mimetype, max_age):
+    resp = Response(body, mimetype=mimetype)
+    resp.headers['Cache-Control'] = f'public, max-age={max_age}'
+    return resp
+
+
+def tile_set_version():
+    """瓦片集版本：目录来源为最新的列目录 mtime，单文件来源为文件身份"""
+    return tile_source.version()
+
+
+def tile_cache_control(args=None):
+    """带版本号且与当前版本一致的 URL 内容不会再变，可以 immutable 长缓存"""
+    args = request.args if args is None else args
+    if IMMUTABLE_TILES and args.get('v') == tile_set_version():
+        return f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return f'public, max-age={TILE_MAX_AGE}'
+
+
+def tile_etag(tile, variant):
+    """由瓦片身份（文件 inode、mtime、大小或归档内位置）与返回格式组成的强 ETag，无需读取内容"""
+    return f'"{tile.tag}-{variant}"'
+
+
+def not_modified(etag, mtime=None, headers=None):
+    """按 If-None-Match（优先）或 If-Modified-Since 判断客户端缓存是否仍然有效"""
+    headers = request.headers if headers is None else headers
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        return '*' in tags or etag in tags or f'W/{etag}' in tags
+    since = parse_date(headers.get('If-Modified-Since'))
+    if since is not None and mtime is not None:
+        return int(mtime) <= since.timestamp()
+    return False
+
+
+def validator_headers(etag, mtime, cache_control, negotiate):
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if mtime is not None:
+        headers['Last-Modified'] = http_date(mtime)
+    if negotiate:
+        headers['Vary'] = 'Accept'
+    return headers
+
+
+class TilePlan(NamedTuple):
+    """
+    plan_tile 的结果，Flask 路由与 async_server 共用：
+    body 非空时直接返回；build 非空时调用它生成 (body, mimetype)（转码、合成等 CPU 密集工作，
+    io 为真时是等待上游的网络 I/O）；否则原样发送 tile（304 时都不用）。
+    """
+    status: int
+    headers: dict
+    mimetype: Optional[str] = None
+    body: Optional[bytes] = None
+    tile: Optional[Tile] = None
+    build: Optional[Callable] = None
+    io: bool = False
+
+
+def plan_tile(z, x, y, want, negotiate, headers, args):
+    """
+    决定如何返回 want 格式（png/webp/jpg）的瓦片，只做查找与头部判断，不读取也不转码瓦片。
+    存储格式与 want 一致，或 negotiate 时客户端 Accept 接受存储格式，则原样发送；否则转码。
+    """
+    tile = tile_source.lookup(z, x, y)
+
+    if tile is None:
+        return plan_missing(z, x, y, want, negotiate, headers, args)
+
+    stored_mime = TILE_FORMATS.get(tile.ext, (None, None))[1]
+    send_stored = stored_mime and (stored_mime == TILE_FORMATS[want][1] or (negotiate and accepts(stored_mime, headers)))
+    etag = tile_etag(tile, tile.ext if send_stored else want)
+    tile_headers = validator_headers(etag, tile.mtime, tile_cache_control(args), negotiate)
+    if not_modified(etag, tile.mtime, headers):
+        return TilePlan(304, tile_headers, tile=tile)
+    if send_stored:
+        # 预取过的瓦片直接从内存返回（与转码键一样带坐标，归档内不同瓦片的 tag 可能相同）
+        cached = response_cache.get(('stored', z, x, y, tile.tag))
+        if cached is not None:
+            return TilePlan(200, tile_headers, stored_mime, body=cached[0], tile=tile)
+        return TilePlan(200, tile_headers, stored_mime, tile=tile)
+    # 以 (z, x, y, 瓦片身份, 格式) 为键缓存转码结果，瓦片被重新下载后自动失效
+    key = (z, x, y, tile.tag, want)
+    return TilePlan(200, tile_headers, TILE_FORMATS[want][1], tile=tile,
+                    build=lambda: response_cache.get_or_build(key, lambda: convert_tile(tile, want)))
+
+
+def can_plan_inline():
+    """
+    异步服务能否在事件循环上直接规划：只有规划全在内存中完成时——mmap 的 PMTiles 且文件身份由后台线程检查，
+    拼接图目录已扫描过。松散目录的查找要 stat 瓦片文件，MBTiles 要查 SQLite，都在线程池中规划。
+    """
+    return (tile_source.kind == 'pmtiles' and tile_source.watching
+            and (mosaics is None or mosaics.loaded))
+
+
+def find_ancestor(z, x, y, levels):
+    """向上最多 levels 级查找存在的祖先瓦片 → (级差, Tile) 或 None"""
+    for dz in range(1, min(levels, z) + 1):
+        tile = tile_source.lookup(z - dz, x >> dz, y >> dz)
+        if tile is not None:
+            return dz, tile
+    return None
+
+
+def overzoom_tile(x, y, dz, ancestor, want):
+    """从 dz 级之上的祖先瓦片中裁出 (x, y) 对应的子区域并放大为 256×256"""
+    metrics.conversions.inc(kind='overzoom')
+    img = load_tile_image(ancestor)
+    with phase('convert'):
+        step = img.size[0] / (1 << dz)
+        left = (x & ((1 << dz) - 1)) * step
+        top = (y & ((1 << dz) - 1)) * step
+        out = img.resize((256, 256), Image.BICUBIC, box=(left, top, left + step, top + step))
+    return encode_image(out, want)
+
+
+def find_descendants(z, x, y, depth):
+    """
+    (z, x, y) 的 2×2 子瓦片（左上、右上、左下、右下），缺失的子瓦片继续向下查找，最多 depth 级。
+    每项为 Tile、同样结构的子列表或 None；全部缺失时返回 None。
+    """
+    if depth <= 0:
+        return None
+    children = []
+    for dy in (0, 1):
+        for dx in (0, 1):
+            cz, cx, cy = z + 1, 2 * x + dx, 2 * y + dy
+            child = tile_source.lookup(cz, cx, cy)
+            if child is None:
+                child = find_descendants(cz, cx, cy, depth - 1)
+            children.append(child)
+    return children if any(c is not None for c in children) else None
+
+
+def descendants_signature(children):
+    """参与拼合的全部瓦片身份的摘要 → (签名, 最新 mtime)；任一瓦片变化签名随之改变"""
+    digest = hashlib.blake2b(digest_size=12)
+    newest = 0.0
+
+    def walk(items):
+        nonlocal newest
+        for child in items:
+            if child is None:
+                digest.update(b'-')
+            elif isinstance(child, list):
+                digest.update(b'(')
+                walk(child)
+                digest.update(b')')
+            else:
+                digest.update(child.tag.encode() + b';')
+                newest = max(newest, child.mtime)
 
+    walk(children)
+    return digest.hexdigest(), newest
+
+
+def compose_children(children):
+    """把 2×2 子瓦片拼成 512×512 后按预乘 alpha 缩小为 256×256"""
+    canvas = Image.new('RGBA', (512, 512), (0, 0, 0, 0))
+    for i, child in enumerate(children):
+        if child is None:
+            continue
+        if isinstance(child, list):
+            im = compose_children(child)
+        else:
+            im = load_tile_image(child)
+        with phase('convert'):
+            if im.size != (256, 256):
+                im = im.resize((256, 256), Image.LANCZOS)
+            canvas.paste(im, ((i % 2) * 256, (i // 2) * 256))
+    with phase('convert'):
+        return canvas.convert('RGBa').reduce(2).convert('RGBA')
+
+
+def underzoom_tile(z, x, y, children, sig, want):
+    """读取或生成拼合瓦片；磁盘缓存文件名带签名，子瓦片变化后旧文件在重建时删除"""
+    cache_dir = UNDERZOOM_CACHE_DIR / str(z) / str(x)
+    path = cache_dir / f'{y}-{sig}.{want}'
+    try:
+        with phase('read'):
+            return path.read_bytes(), TILE_FORMATS[want][1]
+    except OSError:
+        pass
+    metrics.conversions.inc(kind='underzoom')
+    body, mimetype = encode_image(compose_children(children), want)
     try:
-        logger.info(f"Serving tile: {z}/{x}/{y} from {tile_path}")
-
-        if tile_path.suffix.lower() == '.png':
-            resp = make_response(send_file(str(tile_path), mimetype='image/png'))
-            resp.headers['Cache-Control'] = 'public, max-age=86400'
-            return resp
-
-        from PIL import Image
-        import io
-        with Image.open(str(tile_path)) as img:
-            if img.mode != 'RGBA':
-                img = img.convert('RGBA')
-            img_io = io.BytesIO()
-            img.save(img_io, 'PNG')
-            img_io.seek(0)
-            resp = make_response(send_file(img_io, mimetype='image/png'))
-            resp.headers['Cache-Control'] = 'public, max-age=86400'
-            return resp
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        for stale in cache_dir.glob(f'{y}-*.{want}'):
+            stale.unlink(missing_ok=True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.part')
+        tmp.write_bytes(body)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"写入拼合瓦片缓存失败 {path}: {e}")
+    return body, mimetype
+
+
+def plan_image(plan):
+    """执行计划并解码为 RGBA：原样发送的瓦片直接读文件，其余取构建结果"""
+    if plan.tile is not None and plan.body is None and plan.build is None:
+        return load_tile_image(plan.tile)
+    body, _ = plan_body(plan)
+    with phase('convert'), Image.open(io.BytesIO(body)) as img:
+        return img.convert('RGBA')
+
+
+def retina_tile(children, want):
+    """把 z+1 级的 2×2 子瓦片计划（左上、右上、左下、右下，None 为空白）拼成 512×512"""
+    metrics.conversions.inc(kind='retina')
+    canvas = Image.new('RGBA', (512, 512), (0, 0, 0, 0))
+    for i, child in enumerate(children):
+        if child is None:
+            continue
+        try:
+            im = plan_image(child)
+        except UpstreamError:
+            continue  # 上游没有的子瓦片留空
+        with phase('convert'):
+            if im.size != (256, 256):
+                im = im.resize((256, 256), Image.LANCZOS)
+            canvas.paste(im, ((i % 2) * 256, (i // 2) * 256))
+    return encode_image(canvas, want)
+
+
+def plan_retina(z, x, y, want, headers, args):
+    """
+    @2x：512×512 的瓦片，由 z+1 级的 4 个子瓦片拼成，客户端以 tileSize: 512, zoomOffset: -1 使用，
+    同样清晰度下请求数减为 1/4。每个子瓦片按 plan_tile 的正常路径取得，缺失时同样依次尝试
+    拼接图、读穿代理、underzoom 与 overzoom；四个都只能得到占位图时返回占位图。
+    """
+    children = []
+    errors = []
+    for dy in (0, 1):
+        for dx in (0, 1):
+            # Accept image/* 让任意存储格式原样取出，拼合时统一解码
+            plan = plan_tile(z + 1, 2 * x + dx, 2 * y + dy, 'png', True, {'Accept': 'image/*'}, args)
+            children.append(plan if plan.tile is not None or plan.build is not None else None)
+            if plan.status >= 400:
+                errors.append(plan.status)
+    if not any(children):
+        if errors:
+            return upstream_error_plan(max(errors))
+        blank_headers = validator_headers('"blank"', None, 'public, max-age=3600', False)
+        if not_modified('"blank"', headers=headers):
+            return TilePlan(304, blank_headers)
+        body, mimetype = blank_tile()
+        return TilePlan(200, blank_headers, mimetype, body)
+
+    mimetype = TILE_FORMATS[want][1]
+    etags = [child.headers.get('ETag') if child else '-' for child in children]
+    if None in etags:
+        # 有子瓦片要向上游请求：结果在构建时才知道，不带验证器、不缓存，短时浏览器缓存
+        return TilePlan(200, {'Cache-Control': f'public, max-age={PROXY_MAX_AGE}'}, mimetype,
+                        build=lambda: retina_tile(children, want), io=True)
+    sig = hashlib.blake2b('|'.join(etags).encode(), digest_size=12).hexdigest()
+    etag = f'"r{sig}-{want}"'
+    retina_headers = validator_headers(etag, None, tile_cache_control(args), False)
+    if not_modified(etag, headers=headers):
+        return TilePlan(304, retina_headers)
+    key = ('retina', z, x, y, sig, want)
+    return TilePlan(200, retina_headers, mimetype,
+                    build=lambda: response_cache.get_or_build(key, lambda: retina_tile(children, want)))
+
+
+def mosaic_tile(mosaic, z, x, y, want):
+    """从拼接图切出瓦片并编码"""
+    metrics.conversions.inc(kind='mosaic')
+    with phase('convert'):
+        img = mosaics.render(mosaic, z, x, y)
+    return encode_image(img, want)
+
+
+def plan_body(plan):
+    """执行计划得到 (body, mimetype)（不处理 304）"""
+    if plan.body is not None:
+        return plan.body, plan.mimetype
+    if plan.build is not None:
+        return plan.build()
+    return bytes(tile_source.read(plan.tile)), plan.mimetype
+
+
+class UpstreamError(Exception):
+    """读穿代理：上游没有该瓦片或请求失败，且没有可合成的替代；status 为返回给客户端的状态码"""
+
+    def __init__(self, status):
+        super().__init__(f'上游请求失败（{status}）')
+        self.status = status
+
+
+def upstream_error_plan(status):
+    """上游 404/502 时的响应：透明占位图配对应状态码，不缓存（瓦片之后可能补齐）"""
+    body, mimetype = blank_tile()
+    return TilePlan(status, {'Cache-Control': 'no-store'}, mimetype, body)
+
+
+def proxy_tile(z, x, y, want, negotiate, accept, args):
+    """向上游请求并按正常路径返回；上游失败时退回合成瓦片，没有可合成的则抛出 UpstreamError"""
+    headers = {'Accept': accept}
+    status = upstream.fetch(z, x, y)
+    if status == 200:
+        return plan_body(plan_tile(z, x, y, want, negotiate, headers, args))
+    plan = plan_missing(z, x, y, want, negotiate, headers, args, proxy=False, upstream_status=status)
+    if plan.status != 200:
+        raise UpstreamError(plan.status)
+    return plan_body(plan)
+
+
+def plan_missing(z, x, y, want, negotiate, headers, args, proxy=True, upstream_status=None):
+    """
+    瓦片不存在时依次尝试：
+    0. 拼接大图（map/）：从覆盖该瓦片的拼接图中按窗口切出
+    1. 读穿代理（--proxy）：向上游请求并保存，之后按正常瓦片返回
+    2. underzoom：由下方若干级的子瓦片拼合缩小（细节更完整，优先）
+    3. overzoom：由最近的祖先瓦片裁剪放大
+    都没有则返回透明占位图；上游刚失败过（upstream_status 或 retry_after 内的失败记录）时
+    改为带 404/502 状态码、不缓存的占位图，不让客户端把失败结果当作瓦片缓存一小时。
+    """
+    mosaic = mosaics.find(z, x, y) if mosaics is not None else None
+    if mosaic is not None:
+        record_miss('mosaic')
+        etag = f'"m{mosaic.tag}-{want}"'
+        synth_headers = validator_headers(etag, mosaic.mtime, tile_cache_control(args), False)
+        if not_modified(etag, mosaic.mtime, headers):
+            return TilePlan(304, synth_headers)
+        key = ('mosaic', z, x, y, mosaic.tag, want)
+        return TilePlan(200, synth_headers, TILE_FORMATS[want][1],
+                        build=lambda: response_cache.get_or_build(key, lambda: mosaic_tile(mosaic, z, x, y, want)))
+
+    failed = upstream.recently_failed(z, x, y) if proxy and upstream is not None else None
+    if proxy and upstream is not None and failed is None:
+        record_miss('proxy')
+        # 请求结果在构建时才知道，不带验证器，短时缓存；之后的请求命中磁盘上的瓦片
+        proxy_headers = {'Cache-Control': f'public, max-age={PROXY_MAX_AGE}'}
+        if negotiate:
+            proxy_headers['Vary'] = 'Accept'
+        accept = headers.get('Accept', '')
+        return TilePlan(200, proxy_headers, TILE_FORMATS[want][1],
+                        build=lambda: proxy_tile(z, x, y, want, negotiate, accept, args), io=True)
+
+    children = find_descendants(z, x, y, UNDERZOOM_DEPTH)
+    if children is not None:
+        record_miss('underzoom')
+        sig, newest = descendants_signature(children)
+        etag = f'"u{sig}-{want}"'
+        synth_headers = validator_headers(etag, newest, tile_cache_control(args), False)
+        if not_modified(etag, newest, headers):
+            return TilePlan(304, synth_headers)
+        key = ('under', z, x, y, sig, want)
+        return TilePlan(200, synth_headers, TILE_FORMATS[want][1],
+                        build=lambda: response_cache.get_or_build(key, lambda: underzoom_tile(z, x, y, children, sig, want)))
+
+    found = find_ancestor(z, x, y, OVERZOOM_LEVELS) if OVERZOOM_LEVELS > 0 else None
+    if found is not None:
+        dz, ancestor = found
+        record_miss('overzoom')
+        etag = f'"{ancestor.tag}-o{dz}-{want}"'
+        synth_headers = validator_headers(etag, ancestor.mtime, tile_cache_control(args), False)
+        if not_modified(etag, ancestor.mtime, headers):
+            return TilePlan(304, synth_headers)
+        key = ('over', z, x, y, ancestor.tag, want)
+        return TilePlan(200, synth_headers, TILE_FORMATS[want][1],
+                        build=lambda: response_cache.get_or_build(key, lambda: overzoom_tile(x, y, dz, ancestor, want)))
+
+    if upstream_status is not None:
+        return upstream_error_plan(upstream_status)
+    if failed is not None:
+        record_miss('upstream_error')
+        return upstream_error_plan(failed)
+    record_miss('blank')
+    # 瓦片补齐后 ETag 随之改变，客户端重新验证时会拿到真实瓦片
+    blank_headers = validator_headers('"blank"', None, 'public, max-age=3600', False)
+    if not_modified('"blank"', headers=headers):
+        return TilePlan(304, blank_headers)
+    body, mimetype = blank_tile()
+    return TilePlan(200, blank_headers, mimetype, body)
+
+
+def error_tile():
+    """读取或转码失败时返回的半透明红色占位图（不缓存）"""
+    body, mimetype = blank_tile((255, 0, 0, 64))
+    return TilePlan(200, {'Cache-Control': 'public, max-age=0'}, mimetype, body)
+
+
+class Prefetcher:
+    """
+    服务完 (z, x, y) 后在后台把视口附近的瓦片预热进响应缓存：同级一圈 8 个邻居、父瓦片与 4 个子瓦片。
+    - 原样发送的瓦片读入内存，需要转码或合成的瓦片直接构建，之后平移时由内存返回
+    - 队列有界、后进先出，满了丢弃最旧的任务，总是先预热当前视口
+    - 工作线程降低调度优先级；预取后尚未被请求的字节超过缓存的 PREFETCH_BUDGET 时跳过
+    - 不触发读穿代理的上游请求
+    """
+
+    def __init__(self, workers=PREFETCH_WORKERS, queue_size=PREFETCH_QUEUE):
+        self.workers = workers
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.pending = set()
+        self.cond = threading.Condition()
+        self.threads = []
+        self.scheduled = 0
+        self.warmed = 0
+        self.dropped = 0
+        self.skipped = 0
+
+    def start(self):
+        """延迟到第一次调度时启动，多进程模式下每个工作进程各自一组线程"""
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f'prefetch-{i}', daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    @staticmethod
+    def neighbours(z, x, y):
+        n = 1 << z
+        targets = [(z, (x + dx) % n, y + dy)
+                   for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                   if (dx or dy) and 0 <= y + dy < n]
+        if z > 0:
+            targets.append((z - 1, x >> 1, y >> 1))
+        targets += [(z + 1, 2 * x + dx, 2 * y + dy) for dy in (0, 1) for dx in (0, 1)]
+        return targets
+
+    def schedule(self, z, x, y, want, negotiate, accept, args):
+        if self.workers <= 0:
+            return
+        if not 0 <= y < (1 << z) or not 0 <= x < (1 << z):
+            return
+        with self.cond:
+            if not self.threads:
+                self.start()
+            for target in self.neighbours(z, x, y):
+                key = target + (want, negotiate, accept)
+                if key in self.pending:
+                    continue
+                if len(self.queue) >= self.queue_size:
+                    self.pending.discard(self.queue.popleft()[0])
+                    self.dropped += 1
+                self.queue.append((key, args))
+                self.pending.add(key)
+                self.scheduled += 1
+            self.cond.notify()
+
+    def _run(self):
+        try:
+            # Linux 上 PRIO_PROCESS 配合线程 id 只调整当前线程的 nice 值
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                key, args = self.queue.pop()
+                self.pending.discard(key)
+            if response_cache.speculative_bytes > response_cache.max_bytes * PREFETCH_BUDGET:
+                self.skipped += 1
+                continue
+            try:
+                if self.warm(*key, args):
+                    self.warmed += 1
+            except Exception as e:
+                logger.debug(f"预取 {key[:3]} 失败: {e}")
+
+    def warm(self, z, x, y, want, negotiate, accept, args):
+        """按与真实请求相同的计划预热一个瓦片；已在缓存中、占位图或需要上游时返回 False"""
+        with response_cache.speculative():
+            plan = plan_tile(z, x, y, want, negotiate, {'Accept': accept}, args)
+            if plan.io or plan.body is not None or plan.status != 200:
+                return False
+            if plan.build is not None:
+                plan.build()
+                return True
+            key = ('stored', z, x, y, plan.tile.tag)
+            if response_cache.contains(key):
+                return False
+            response_cache.put(key, (bytes(tile_source.read(plan.tile)), plan.mimetype))
+            return True
+
+    def stats(self):
+        with self.cond:
+            return {
+                'workers': self.workers,
+                'queued': len(self.queue),
+                'scheduled': self.scheduled,
+                'warmed': self.warmed,
+                'dropped': self.dropped,
+                'skipped': self.skipped,
+            }
+
+
+prefetcher = Prefetcher()
+
+
+def serve_tile(z, x, y, want, negotiate=False, retina=False):
+    """返回 want 格式（png/webp/jpg）的瓦片；存储格式可用时原样发送文件，否则转码或合成（结果进入响应缓存）"""
+    try:
+        args = request.args.to_dict()
+        with phase('lookup'):
+            if retina:
+                plan = plan_retina(z, x, y, want, request.headers, args)
+            else:
+                plan = plan_tile(z, x, y, want, negotiate, request.headers, args)
+        if not retina:
+            prefetcher.schedule(z, x, y, want, negotiate, request.headers.get('Accept', ''), args)
+        if plan.status == 304:
+            resp = Response(status=304)
+        elif plan.body is not None:
+            resp = Response(plan.body, status=plan.status, mimetype=plan.mimetype)
+        elif plan.build is not None:
+            try:
+                body, mimetype = plan.build()
+            except UpstreamError as e:
+                plan = upstream_error_plan(e.status)
+                body, mimetype = plan.body, plan.mimetype
+            resp = Response(body, status=plan.status, mimetype=mimetype)
+        elif plan.tile.whole_file:
+            resp = make_response(send_file(str(plan.tile.path), mimetype=plan.mimetype, conditional=False, etag=False))
+        else:
+            with phase('read'):
+                resp = Response(tile_source.read(plan.tile), mimetype=plan.mimetype)
+        resp.headers.update(plan.headers)
+        return resp
 
     except Exception as e:
-        logger.error(f"Error reading/converting tile {z}/{x}/{y} ({tile_path}): {e}", exc_info=True)
-        from PIL import Image
-        import io
-        img = Image.new('RGBA', (256, 256), (255, 0, 0, 64))
-        img_io = io.BytesIO()
-        img.save(img_io, 'PNG')
-        img_io.seek(0)
-        resp = make_response(send_file(img_io, mimetype='image/png'))
-        resp.headers['Cache-Control'] = 'public, max-age=0'
+        logger.error(f"Error reading/converting tile {z}/{x}/{y}: {e}", exc_info=True)
+        plan = error_tile()
+        resp = Response(plan.body, mimetype=plan.mimetype)
+        resp.headers.update(plan.headers)
+        return resp
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def get_tile(z, x, y):
+    return serve_tile(z, x, y, 'png', negotiate=True)
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.webp')
+def get_tile_webp(z, x, y):
+    return serve_tile(z, x, y, 'webp')
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.jpg')
+def get_tile_jpg(z, x, y):
+    return serve_tile(z, x, y, 'jpg')
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>@2x.<any(png, webp, jpg):ext>')
+def get_tile_retina(z, x, y, ext):
+    return serve_tile(z, x, y, ext, retina=True)
+
+
+BATCH_FRAME = struct.Struct('<BII4sI')  # z, x, y, 扩展名（ASCII，不足补 0）, 长度
+
+
+def parse_batch(spec):
+    """
+    批量请求体 → [(z, x, y)]：
+    {"tiles": [[z, x, y], ...]} 或瓦片范围 {"z": 12, "x": [x_min, x_max], "y": [y_min, y_max]}（含两端）
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('请求体应为 JSON 对象')
+    if 'tiles' in spec:
+        keys = [tuple(int(v) for v in t) for t in spec['tiles']]
+        if any(len(k) != 3 for k in keys):
+            raise ValueError('tiles 的每一项应为 [z, x, y]')
+    else:
+        z = int(spec['z'])
+        (x_min, x_max), (y_min, y_max) = [map(int, spec[k]) for k in ('x', 'y')]
+        count = (x_max - x_min + 1) * (y_max - y_min + 1)
+        if count > BATCH_MAX_TILES:
+            raise ValueError(f'瓦片数 {count} 超过上限 {BATCH_MAX_TILES}')
+        keys = [(z, x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)]
+    if len(keys) > BATCH_MAX_TILES:
+        raise ValueError(f'瓦片数 {len(keys)} 超过上限 {BATCH_MAX_TILES}')
+    return keys
+
+
+def disk_order(item):
+    """按存储位置排序：归档内按偏移，目录来源按 z/x/y（与爬虫写入顺序一致）"""
+    (z, x, y), tile = item
+    return ('' if tile.whole_file else str(tile.path), tile.offset, z, x, y)
+
+
+def iter_tar(found):
+    """以 tar 流逐个输出瓦片，成员名 {z}/{x}/{y}.{ext}"""
+    for (z, x, y), tile in found:
+        body = tile_source.read(tile)
+        info = tarfile.TarInfo(f'{z}/{x}/{y}.{tile.ext}')
+        info.size = len(body)
+        info.mtime = int(tile.mtime)
+        yield info.tobuf(format=tarfile.USTAR_FORMAT)
+        yield bytes(body)
+        if len(body) % tarfile.BLOCKSIZE:
+            yield b'\0' * (tarfile.BLOCKSIZE - len(body) % tarfile.BLOCKSIZE)
+    yield b'\0' * (tarfile.BLOCKSIZE * 2)
+
+
+def iter_frames(found):
+    """长度前缀帧：每个瓦片一个 BATCH_FRAME 头后接原始字节"""
+    for (z, x, y), tile in found:
+        body = tile_source.read(tile)
+        yield BATCH_FRAME.pack(z, x, y, tile.ext.encode('ascii'), len(body))
+        yield bytes(body)
+
+
+@app.route('/tiles/batch', methods=['POST'])
+def tiles_batch():
+    """
+    一次请求取回一批瓦片的存储字节（不转码、不合成）。
+    先查找全部瓦片并按存储位置排序，再顺序读取、边读边发送；缺失的瓦片跳过，
+    数量见 X-Tiles-Found / X-Tiles-Missing。?format=frames 时输出长度前缀帧，默认 tar。
+    """
+    try:
+        keys = parse_batch(request.get_json(force=True, silent=True))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'无效的批量请求: {e}'}), 400
+    keys = list(dict.fromkeys(keys))
+    found = []
+    for key in keys:
+        tile = tile_source.lookup(*key)
+        if tile is not None:
+            found.append((key, tile))
+    found.sort(key=disk_order)
+
+    if request.args.get('format') == 'frames':
+        body, mimetype = iter_frames(found), 'application/octet-stream'
+    else:
+        body, mimetype = iter_tar(found), 'application/x-tar'
+    resp = Response(body, mimetype=mimetype)
+    resp.headers['X-Tiles-Found'] = str(len(found))
+    resp.headers['X-Tiles-Missing'] = str(len(keys) - len(found))
+    return resp
+
+
+export_slots = threading.BoundedSemaphore(EXPORT_CONCURRENCY)
+
+
+def export_peak_bytes(cols, rows, fmt):
+    """
+    估算单个导出的峰值内存：条带画布缓存的瓦片行（与宽度成正比）+ 编码器在途行带；
+    JPEG/WebP 需整图编码，另加整图数组与编码副本。
+    """
+    row_bytes = cols * 256 * 4
+    strips = min(EXPORT_STRIPS, rows) * 256 * row_bytes
+    if fmt == 'png':
+        band = min(rows * 256, png_band_rows(cols * 256)) * row_bytes
+        return strips + EXPORT_ENCODE_WORKERS * band * PNG_FILTER_PEAK
+    return strips + 2 * rows * 256 * row_bytes
+
+
+def export_params(args):
+    """?bbox=min_lon,min_lat,max_lon,max_lat&z=&format= → (z, x_min, x_max, y_min, y_max, 格式)"""
+    bbox = [float(v) for v in args['bbox'].split(',')]
+    if len(bbox) != 4:
+        raise ValueError('bbox 应为 min_lon,min_lat,max_lon,max_lat')
+    z = int(args['z'])
+    if not 0 <= z <= 30:
+        raise ValueError('z 超出范围')
+    fmt = args.get('format', 'png').lower()
+    if fmt == 'jpeg':
+        fmt = 'jpg'
+    if fmt not in ('png', 'webp', 'jpg'):
+        raise ValueError(f'不支持的导出格式: {fmt}')
+    n = 1 << z
+    x_min, x_max, y_min, y_max = bbox_to_tile_range(*bbox, z)
+    x_min, y_min = max(0, x_min), max(0, y_min)
+    x_max, y_max = min(n - 1, x_max), min(n - 1, y_max)
+    cols, rows = x_max - x_min + 1, y_max - y_min + 1
+    if cols <= 0 or rows <= 0:
+        raise ValueError('bbox 为空')
+    if cols * rows > EXPORT_MAX_TILES:
+        raise ValueError(f'范围过大：{cols}×{rows} 个瓦片（总数上限 {EXPORT_MAX_TILES}）')
+    if fmt != 'png' and cols * rows * 256 * 256 > EXPORT_MAX_PIXELS:
+        raise ValueError(f'{fmt} 导出需整图编码，像素数上限 {EXPORT_MAX_PIXELS}，请改用 png')
+    peak = export_peak_bytes(cols, rows, fmt)
+    if peak > EXPORT_MEMORY_MB * 1024 * 1024:
+        raise ValueError(f'范围过宽：{cols}×{rows} 个瓦片的导出约需 {peak >> 20}MB 内存，'
+                         f'超过单个导出的上限 {EXPORT_MEMORY_MB}MB')
+    return z, x_min, x_max, y_min, y_max, fmt
+
+
+def export_tile_image(z, x, y):
+    """导出用：读取存储的瓦片并解码，缺失返回 None（与 stitch_tiles 一致留空）"""
+    tile = tile_source.lookup(z, x, y)
+    if tile is None:
+        return None
+    return load_tile_image(tile)
+
+
+def iter_export(z, x_min, x_max, y_min, y_max, fmt):
+    """逐段产出导出文件：PNG 按瓦片行渲染、边编码边输出；JPEG/WebP 整图编码后一次输出"""
+    canvas = TileStripCanvas(x_max - x_min + 1, y_max - y_min + 1,
+                             lambda col, row: export_tile_image(z, x_min + col, y_min + row),
+                             cache_strips=EXPORT_STRIPS)
+    try:
+        if fmt == 'png':
+            yield from iter_png(canvas, level=6, workers=EXPORT_ENCODE_WORKERS)
+        else:
+            yield encode_image(canvas.as_image(), fmt)[0]
+    finally:
+        canvas.close()
+
+
+def prune_export_cache():
+    """按修改时间淘汰最旧的导出结果，使缓存目录不超过 EXPORT_CACHE_MB"""
+    try:
+        files = [(e.stat().st_mtime, e.stat().st_size, e.path)
+                 for e in os.scandir(EXPORT_CACHE_DIR) if e.is_file() and not e.name.endswith('.part')]
+    except OSError:
+        return
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= EXPORT_CACHE_MB * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def tee_to_cache(chunks, path):
+    """边发送边写入缓存文件；完整发送后才改名生效，中途断开则丢弃"""
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.part')
+    complete = False
+    try:
+        EXPORT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fh = open(tmp, 'wb')
+    except OSError as e:
+        logger.warning(f"无法写入导出缓存 {tmp}: {e}")
+        yield from chunks
+        return
+    try:
+        with fh:
+            for chunk in chunks:
+                fh.write(chunk)
+                yield chunk
+        complete = True
+        os.replace(tmp, path)
+    finally:
+        if not complete:
+            tmp.unlink(missing_ok=True)
+    prune_export_cache()
+
+
+@app.route('/api/export')
+def export():
+    """
+    导出 bbox 范围在 z 级的拼接图（png/webp/jpg），复用 stitch_tiles 的范围换算与流式 PNG 编码器，
+    下载立即开始、内存有界。相同参数且瓦片集版本未变时直接返回缓存的结果。
+    """
+    try:
+        z, x_min, x_max, y_min, y_max, fmt = export_params(request.args)
+    except (KeyError, ValueError) as e:
+        return jsonify({'error': f'无效的导出参数: {e}'}), 400
+    name = f'export_z{z}_{x_min}-{x_max}_{y_min}-{y_max}.{fmt}'
+    digest = hashlib.blake2b(f'{name}|{tile_set_version()}'.encode(), digest_size=12).hexdigest()
+    cached = EXPORT_CACHE_DIR / f'{digest}.{fmt}'
+    mimetype = TILE_FORMATS[fmt][1]
+    if cached.exists():
+        os.utime(cached)  # 刷新淘汰顺序
+        return send_file(str(cached), mimetype=mimetype, as_attachment=True, download_name=name)
+
+    if not HAVE_NUMPY:
+        # 条带画布与流式 PNG 编码依赖 numpy；必须在发出 200 响应头之前拒绝，否则客户端只拿到截断的文件
+        return jsonify({'error': '导出需要 numpy：pip install numpy'}), 501
+    if not export_slots.acquire(blocking=False):
+        resp = jsonify({'error': f'导出任务已满（{EXPORT_CONCURRENCY} 个），请稍后重试'})
+        resp.status_code = 503
+        resp.headers['Retry-After'] = '10'
         return resp
+    try:
+        body = tee_to_cache(iter_export(z, x_min, x_max, y_min, y_max, fmt), cached)
+        resp = Response(body, mimetype=mimetype)
+    except Exception:
+        export_slots.release()
+        raise
+    resp.call_on_close(export_slots.release)
+    resp.headers['Content-Disposition'] = f'attachment; filename="{name}"'
+    resp.headers['X-Tile-Range'] = f'{z}/{x_min}-{x_max}/{y_min}-{y_max}'
+    return resp
+
+
+ROUTE_PARAM = re.compile(r'<(?:[^<>]*:)?([^<>:]+)>')
+
+
+def route_label(rule):
+    """Flask 路由规则 → 指标标签，如 /tiles/<int:z>/<int:x>/<int:y>.png → /tiles/{z}/{x}/{y}.png"""
+    return ROUTE_PARAM.sub(r'{\1}', rule) if rule else 'unmatched'
+
+
+@app.before_request
+def start_request_timer():
+    g.request_timer = metrics.begin_request(route_label(request.url_rule and request.url_rule.rule), request.path)
+
+
+@app.after_request
+def finish_request_timer(response):
+    timer = g.pop('request_timer', None)
+    if timer is not None:
+        metrics.end_request(timer, response.status_code, response.content_length)
+    return response
+
+
+def _cache_stat(name):
+    return lambda: response_cache.stats()[name]
+
+
+for _name, _help, _kind in (
+        ('hits', '响应缓存命中次数', 'counter'),
+        ('misses', '响应缓存未命中（实际构建）次数', 'counter'),
+        ('coalesced', '并发未命中合并到同一次构建的次数', 'counter'),
+        ('evictions', '响应缓存淘汰次数', 'counter'),
+        ('bytes', '响应缓存占用字节', 'gauge'),
+        ('entries', '响应缓存条目数', 'gauge'),
+        ('hit_ratio', '响应缓存命中率（含合并）', 'gauge'),
+        ('speculative_bytes', '预取后尚未被请求的字节', 'gauge'),
+        ('prefetch_hits', '被真实请求命中的预取条目数', 'counter')):
+    metrics.registry.register(metrics.GaugeFunc(
+        f'tile_server_cache_{_name}' + ('_total' if _kind == 'counter' else ''), _help, _cache_stat(_name), kind=_kind))
+metrics.registry.register(metrics.GaugeFunc(
+    'tile_server_prefetch_warmed_total', '预取预热的瓦片数', lambda: prefetcher.stats()['warmed'], kind='counter'))
+
+
+@app.route('/api/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式的运行指标"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/api/cache-stats')
+def cache_stats():
+    stats = response_cache.stats()
+    if upstream is not None:
+        stats['upstream'] = upstream.stats()
+    stats['prefetch'] = prefetcher.stats()
+    if mosaics is not None:
+        stats['mosaics'] = mosaics.stats()
+    return jsonify(stats)
 
 
 @app.route('/api/tile-stats')
 def tile_stats():
-    stats = {}
-    if TILES_DIR.exists():
-        for z_dir in sorted(TILES_DIR.glob('*/')):
-            if z_dir.is_dir() and z_dir.name.isdigit():
-                count = len(list(z_dir.glob('*/*')))
-                stats[z_dir.name] = count
-    return jsonify(stats)
+    zooms = tile_source.summary()
+    return jsonify({z: info['count'] for z, info in zooms.items()})
+
+
+@app.route('/api/coverage')
+def coverage_info():
+    """各 zoom 的范围、瓦片数、字节数与格式分布"""
+    return jsonify(tile_source.summary())
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地瓦片地图服务')
+    parser.add_argument('--cache-mb', type=int, default=RESPONSE_CACHE_MB, help='转码瓦片响应缓存上限（MB）')
+    parser.add_argument('--no-index', action='store_true', help='不建立内存瓦片索引，每次请求探测文件系统')
+    parser.add_argument('--index-poll', type=float, default=INDEX_POLL_SECONDS,
+                        help='瓦片索引轮询间隔（秒），0 表示启动后不再更新')
+    parser.add_argument('--immutable', action='store_true',
+                        help='首页瓦片 URL 带上瓦片集版本号（?v=），版本一致的请求返回 immutable 长缓存')
+    parser.add_argument('--tiles-dir', type=str, help='瓦片目录（默认与 server.py 同目录的 out/）')
+    parser.add_argument('--source', type=str,
+                        help='瓦片来源：.mbtiles 或 .pmtiles 单文件（默认读取 out/ 目录）')
+    parser.add_argument('--overzoom', type=int, default=OVERZOOM_LEVELS,
+                        help='缺失瓦片最多向上找几级祖先裁剪放大（0 关闭）')
+    parser.add_argument('--underzoom', type=int, default=UNDERZOOM_DEPTH,
+                        help='缺失瓦片最多向下几级由子瓦片拼合缩小（0 关闭）')
+    parser.add_argument('--underzoom-cache', type=str, help='拼合瓦片的磁盘缓存目录（默认 out/.underzoom）')
+    parser.add_argument('--mosaics', type=str, help='拼接大图目录（默认 map/），缺失瓦片从覆盖它的大图中切出')
+    parser.add_argument('--no-mosaics', action='store_true', help='不从拼接大图切瓦片')
+    parser.add_argument('--proxy', action='store_true',
+                        help='读穿代理模式：缺失瓦片向上游请求并保存到 out/（模板、请求头、tokens、代理读取配置文件）')
+    parser.add_argument('--config', type=str, help='代理模式的配置文件（默认与爬虫相同的查找顺序）')
+    parser.add_argument('--proxy-template', type=str, help='上游瓦片 URL 模板（默认取配置文件 defaults.template）')
+    parser.add_argument('--proxy-concurrency', type=int, help=f'每个上游主机的最大并发（默认 {PROXY_CONCURRENCY}）')
+    parser.add_argument('--prefetch-workers', type=int, default=PREFETCH_WORKERS,
+                        help='邻居预取线程数：服务完一个瓦片后在后台预热周围、父级与子级瓦片（0 关闭）')
+    parser.add_argument('--export-concurrency', type=int, default=EXPORT_CONCURRENCY,
+                        help='/api/export 同时进行的导出数')
+    parser.add_argument('--export-memory-mb', type=int, default=EXPORT_MEMORY_MB,
+                        help='单个导出的峰值内存预算（MB），超出的范围返回 400')
+    parser.add_argument('--slow-ms', type=float, default=metrics.SLOW_REQUEST_SECONDS * 1000,
+                        help='慢请求日志阈值（毫秒）')
+    parser.add_argument('--log-sample', type=float, default=metrics.ACCESS_LOG_SAMPLE,
+                        help='其余请求的访问日志抽样比例（0 关闭，1 记录全部）')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=5000, help='监听端口')
+    parser.add_argument('--async', dest='async_mode', action='store_true',
+                        help='异步服务模式：瓦片用 sendfile 发送，转码在有界线程池中执行，支持 keep-alive 与流水线')
+    parser.add_argument('--workers', type=int, default=1, help='异步模式的工作进程数（共享监听套接字与瓦片索引）')
+    parser.add_argument('--convert-workers', type=int, help='异步模式每个进程的转码线程数（默认 CPU 核数）')
+    args = parser.parse_args()
+    if args.tiles_dir:
+        TILES_DIR = Path(args.tiles_dir).resolve()
+        UNDERZOOM_CACHE_DIR = TILES_DIR / '.underzoom'
+        EXPORT_CACHE_DIR = TILES_DIR / '.exports'
+        tile_index = TileIndex(TILES_DIR)
+        coverage = CoverageCache(TILES_DIR)
+        tile_source = DirectorySource(TILES_DIR)
+    IMMUTABLE_TILES = args.immutable
+    OVERZOOM_LEVELS = args.overzoom
+    UNDERZOOM_DEPTH = args.underzoom
+    if args.underzoom_cache:
+        UNDERZOOM_CACHE_DIR = Path(args.underzoom_cache)
+    response_cache.max_bytes = args.cache_mb * 1024 * 1024
+    prefetcher.workers = args.prefetch_workers
+    metrics.SLOW_REQUEST_SECONDS = args.slow_ms / 1000
+    metrics.ACCESS_LOG_SAMPLE = args.log_sample
+    if args.no_mosaics:
+        mosaics = None
+    else:
+        mosaics = MosaicSource(args.mosaics or MAPS_DIR, poll=args.index_poll, overzoom=OVERZOOM_LEVELS)
+    EXPORT_CONCURRENCY = args.export_concurrency
+    EXPORT_MEMORY_MB = args.export_memory_mb
+    export_slots = threading.BoundedSemaphore(EXPORT_CONCURRENCY)
+    USE_TILE_INDEX = not args.no_index
+    if args.proxy:
+        if args.source or not USE_TILE_INDEX:
+            parser.error('--proxy 需要 out/ 目录来源与内存索引（不能与 --source、--no-index 同时使用）')
+        import tile_crawler
+        config, config_path = tile_crawler.load_config(args.config)
+        defaults = config.get('defaults') or {}
+        template = args.proxy_template or defaults.get('template')
+        if not template:
+            parser.error('代理模式需要上游模板：--proxy-template 或配置文件 defaults.template')
+        headers, tokens, proxies = tile_crawler.request_options(config)
+        upstream = UpstreamProxy(
+            template, headers, tokens, proxies, TILES_DIR,
+            concurrency=args.proxy_concurrency or int(defaults.get('proxy_concurrency') or PROXY_CONCURRENCY),
+            timeout=int(defaults.get('timeout') or 15), retries=int(defaults.get('retries') or 1))
+    if args.source:
+        tile_source = open_archive(args.source, poll=args.index_poll)
+        if not (args.async_mode and args.workers > 1):
+            tile_source.start_watcher()
+    elif USE_TILE_INDEX:
+        # 多进程时在 fork 前建好索引，各工作进程以写时复制共享，轮询线程在 fork 后各自启动
+        tile_index.ensure_loaded()
+        if not (args.async_mode and args.workers > 1):
+            tile_index.start_watcher(args.index_poll)
+    # 拼接图目录的重新扫描同样在后台线程进行；多进程时各工作进程自行打开文件，不在 fork 前共享句柄
+    if mosaics is not None and not (args.async_mode and args.workers > 1):
+        mosaics.start_watcher()
+
     print("=" * 60)
     print("🌍 瓦片地图服务已启动")
     print("=" * 60)
-    print(f"📍 瓦片目录: {TILES_DIR.resolve()}")
-    print("🌐 访问地址：http://localhost:5000")
-    print("🗺️  瓦片接口：/tiles/{z}/{x}/{y}.png")
+    if args.source:
+        print(f"📍 瓦片来源: {Path(args.source).resolve()}（{tile_source.kind}）")
+    else:
+        print(f"📍 瓦片目录: {TILES_DIR.resolve()}")
+    print(f"🌐 访问地址：http://{args.host}:{args.port}")
+    if args.async_mode:
+        print(f"⚡ 异步模式：{args.workers} 个工作进程")
+    if upstream is not None:
+        print(f"🔁 读穿代理：{urlsplit(upstream.template).netloc}（每主机并发 {upstream.concurrency}）")
+    print("🗺️  瓦片接口：/tiles/{z}/{x}/{y}.png（按 Accept 协商）、.webp、.jpg；高分屏 /tiles/{z}/{x}/{y}@2x.png")
     print("📊 统计接口：/api/tile-stats")
+    print("📦 缓存统计：/api/cache-stats")
+    print("📈 运行指标：/api/metrics（Prometheus 文本格式）")
+    print("🧭 覆盖清单：/api/coverage")
     print("=" * 60)
     print("按 Ctrl+C 停止服务")
     print("=" * 60)
-    app.run(debug=False, host='127.0.0.1', port=5000, threaded=True)
\ No newline at end of file
+    if args.async_mode:
+        import async_server
+
+        def on_worker_start():
+            if args.source:
+                tile_source.start_watcher()
+            elif USE_TILE_INDEX:
+                tile_index.start_watcher(args.index_poll)
+            if mosaics is not None:
+                mosaics.start_watcher()
+
+        # 以 __main__ 运行时重新 import server 会得到一份未配置的新模块，因此直接传入当前模块
+        async_server.serve(sys.modules[__name__], args.host, args.port, args.workers,
+                           args.convert_workers, on_worker_start)
+    else:
+        app.run(debug=False, host=args.host, port=args.port, threaded=True)
\ No newline at end of file
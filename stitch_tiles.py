@@ -5,20 +5,38 @@ stitch_tiles.py
 功能：
 - 命令行模式：保持原有用法（--zoom --bbox 等）
 - 配置文件模式：通过 --config config.json 读取 jobs 并批量拼接
+- 输出格式：PNG 等 Pillow 支持的格式，或 COG（带概览与 Web Mercator 地理参考的 GeoTIFF）
+- 分幅输出：--sheet-size 将范围切成 N×M 幅在多进程中并行拼接，附 JSON 索引与 world file
+- 多任务：按重叠排序并共享按字节限额的已解码瓦片 LRU 缓存；config 中 parallel_jobs > 1 时并发拼接
+- 增量拼接：COG 输出旁写 {output}.manifest.json 记录每个源瓦片的 mtime/size/hash，
+  重新运行时只重写变化瓦片所在的块及其概览块
 
 与 tile_crawler 共用 config.json 的 jobs 字段。
 """
 
 from pathlib import Path
 import argparse
+import hashlib
+import io
 import json
 import math
+import os
+import threading
+from collections import OrderedDict
 from PIL import Image
 from tqdm import tqdm
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from geotiff import write_cog, compact_tiff, TiledTiff, tile_range_geotransform
+from canvas import new_canvas, CANVAS_BACKENDS
+from encoders import save_image
 
 TILE_SIZE = 256
+COG_FORMATS = ('COG', 'GTIFF', 'GEOTIFF')
 PREFERRED_EXTS = ["png", "webp", "jpg", "jpeg"]
+MANIFEST_VERSION = 1
+COMPACT_WASTE_RATIO = 0.25  # 增量修补后空洞超过有效数据的该比例时整理 COG
+ENCODE_WORKERS = os.cpu_count() or 1
 
 
 def latlon_to_tile_xy(lat, lon, z):
@@ -36,47 +54,535 @@ def bbox_to_tile_range(min_lon, min_lat, max_lon, max_lat, z):
     return min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2)
 
 
-def find_tile_file(input_dir: Path, z: int, x: int, y: int):
-    base = input_dir / str(z) / str(x) / str(y)
-    for ext in PREFERRED_EXTS:
-        p = base.with_suffix('.' + ext)
-        if p.exists():
-            return p
-    for p in base.parent.glob(base.name + '.*'):
-        if p.is_file():
-            return p
-    return None
+class TileIndex:
+    """
+    瓦片目录索引：每个 {input_dir}/{z}/{x} 列目录只用 os.scandir 列举一次，
+    之后 (x, y) → (路径, 格式) 全部在内存中解析，避免逐瓦片 exists()/glob。
+    """
 
+    def __init__(self, input_dir: Path, z: int):
+        self.input_dir = Path(input_dir)
+        self.z = z
+        self._columns = {}
 
-def stitch(z, x_min, x_max, y_min, y_max, input_dir: Path, output: Path, tile_size=TILE_SIZE, output_format='PNG'):
+    def _scan_column(self, x):
+        col_dir = self.input_dir / str(self.z) / str(x)
+        found = {}
+        try:
+            with os.scandir(col_dir) as it:
+                for entry in it:
+                    stem, dot, ext = entry.name.partition('.')
+                    if not dot or not stem.isdigit() or ext.endswith('part'):
+                        continue
+                    if not entry.is_file():
+                        continue
+                    ext = ext.lower()
+                    y = int(stem)
+                    # 同一 y 有多种格式时按 PREFERRED_EXTS 顺序取优
+                    prev = found.get(y)
+                    if prev is None or _ext_rank(ext) < _ext_rank(prev[1]):
+                        found[y] = (col_dir / entry.name, ext)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return found
+
+    def column(self, x):
+        col = self._columns.get(x)
+        if col is None:
+            col = self._columns[x] = self._scan_column(x)
+        return col
+
+    def lookup(self, x, y):
+        """返回 (Path, 格式) 或 None"""
+        return self.column(x).get(y)
+
+    def coverage(self, x_min, x_max, y_min, y_max):
+        """在解码前统计覆盖情况：总数、已有数、缺失数与缺失位置"""
+        missing_tiles = []
+        for x in range(x_min, x_max + 1):
+            col = self.column(x)
+            for y in range(y_min, y_max + 1):
+                if y not in col:
+                    missing_tiles.append((x, y))
+        total = (x_max - x_min + 1) * (y_max - y_min + 1)
+        return {'total': total, 'present': total - len(missing_tiles),
+                'missing': len(missing_tiles), 'missing_tiles': missing_tiles}
+
+
+def _ext_rank(ext):
+    try:
+        return PREFERRED_EXTS.index(ext)
+    except ValueError:
+        return len(PREFERRED_EXTS)
+
+
+def format_coverage(cov, limit=10):
+    """覆盖报告的简短文本，缺失位置最多列出 limit 个"""
+    text = f"覆盖: {cov['present']}/{cov['total']}，缺失 {cov['missing']}"
+    if cov['missing']:
+        shown = ', '.join(f'({x},{y})' for x, y in cov['missing_tiles'][:limit])
+        more = ' …' if cov['missing'] > limit else ''
+        text += f"：{shown}{more}"
+    return text
+
+
+def choose_source_zoom(input_dir: Path, z, x_min, x_max, y_min, y_max, scale):
+    """
+    缩小输出时（scale ≤ 1/2），优先选用磁盘上已完整覆盖该范围的更低 zoom，
+    每低一级瓦片数减为 1/4。返回 (源 zoom, TileIndex 或 None)。
+    """
+    if scale > 0.5:
+        return z, None
+    levels = min(z, int(math.floor(math.log2(1.0 / scale) + 1e-9)))
+    for d in range(levels, 0, -1):
+        index = TileIndex(input_dir, z - d)
+        if index.coverage(x_min >> d, x_max >> d, y_min >> d, y_max >> d)['missing'] == 0:
+            return z - d, index
+    return z, None
+
+
+def decode_tile(path, size=None):
+    """解码为 RGBA；指定 size 时在解码阶段缩小（JPEG 使用 draft 模式按 DCT 缩放）"""
+    with Image.open(path) as im:
+        if size is None or size == im.size:
+            return im.convert('RGBA')
+        if im.format == 'JPEG':
+            im.draft('RGB', size)
+        return im.convert('RGBA').resize(size, Image.BOX, reducing_gap=2.0)
+
+
+class DecodedTileCache:
+    """
+    已解码瓦片的 LRU 缓存，按像素字节数限额，可被多个拼接线程共享。
+    键为 (路径, 目标尺寸)，重叠任务再次用到同一瓦片时无需重新解码；
+    get_or_decode 对同一键只解码一次，并发任务同时用到时等待先到者的结果。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get_or_decode(self, key, decode):
+        with self._lock:
+            im = self._items.get(key)
+            if im is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return im
+            waiting = self._pending.get(key)
+            if waiting is None:
+                self._pending[key] = threading.Event()
+        if waiting is not None:
+            waiting.wait()
+            im = self.get(key)
+            # 先到者解码失败或结果已被淘汰时自行解码（不再登记）
+            return im if im is not None else decode()
+        try:
+            im = decode()
+            with self._lock:
+                self.misses += 1
+            self.put(key, im)
+            return im
+        finally:
+            with self._lock:
+                self._pending.pop(key).set()
+
+    def get(self, key):
+        with self._lock:
+            im = self._items.get(key)
+            if im is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return im
+
+    def put(self, key, im):
+        cost = im.size[0] * im.size[1] * 4
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= old.size[0] * old.size[1] * 4
+            self._items[key] = im
+            self.bytes += cost
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= evicted.size[0] * evicted.size[1] * 4
+
+    def discard(self, key):
+        with self._lock:
+            im = self._items.pop(key, None)
+            if im is not None:
+                self.bytes -= im.size[0] * im.size[1] * 4
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'bytes': self.bytes,
+                'hit_ratio': self.hits / total if total else 0.0}
+
+
+def manifest_path(output: Path) -> Path:
+    return output.with_name(output.name + '.manifest.json')
+
+
+def read_tile_bytes(path):
+    """读取瓦片字节并返回 (data, 清单记录 [mtime_ns, size, hash])"""
+    with open(path, 'rb') as fh:
+        st = os.fstat(fh.fileno())
+        data = fh.read()
+    return data, [st.st_mtime_ns, st.st_size, hashlib.blake2b(data, digest_size=16).hexdigest()]
+
+
+def load_manifest(output: Path, params):
+    """参数一致且输出仍存在时返回清单，否则返回 None"""
+    try:
+        with open(manifest_path(output), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('params') != params:
+        return None
+    if not output.exists():
+        return None
+    return manifest
+
+
+def save_manifest(output: Path, params, tiles):
+    manifest = {'version': MANIFEST_VERSION, 'output': str(output), 'params': params, 'tiles': tiles}
+    tmp = manifest_path(output).with_suffix('.part')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp, manifest_path(output))
+
+
+def diff_manifest(src_index, records, sx_min, sx_max, sy_min, sy_max):
+    """
+    对比磁盘与清单，返回变化的瓦片 {(x, y): 路径或 None(已删除)}。
+    mtime/size 未变视为未变化；变了再比较内容 hash，仅 touch 过的文件不算变化。
+    """
+    changed = {}
+    for x in range(sx_min, sx_max + 1):
+        col = src_index.column(x)
+        for y in range(sy_min, sy_max + 1):
+            key = f'{x}/{y}'
+            rec = records.get(key)
+            hit = col.get(y)
+            if hit is None:
+                if rec is not None:
+                    changed[(x, y)] = None
+                    del records[key]
+                continue
+            if rec is not None:
+                try:
+                    st = os.stat(hit[0])
+                except OSError:
+                    changed[(x, y)] = None
+                    del records[key]
+                    continue
+                if [st.st_mtime_ns, st.st_size] == rec[:2]:
+                    continue
+            changed[(x, y)] = hit[0]
+    return changed
+
+
+def patch_cog(output: Path, rects, records):
+    """
+    将变化的瓦片写回已有 COG：只重写其覆盖的全分辨率块，再逐级重算受影响的概览块。
+    空洞超过有效数据的 COMPACT_WASTE_RATIO 时整理文件，文件大小因此有界。
+    rects: {(x, y): ((left, top, right, bottom), 路径或 None)}
+    返回 (内容确有变化的瓦片数, 各层重写的块数)。
+    """
+    written, changed = [], 0
+    tif = TiledTiff(output, writable=True)
+    try:
+        base = tif.levels[0]
+        bw, bh = base.block_w, base.block_h
+        dirty = {}
+        for (x, y), ((left, top, right, bottom), path) in rects.items():
+            if right <= left or bottom <= top:
+                continue
+            im = None
+            if path is not None:
+                try:
+                    data, rec = read_tile_bytes(path)
+                except OSError as e:
+                    print(f"警告: 读取失败 {path}: {e}", file=sys.stderr)
+                    continue
+                if records.get(f'{x}/{y}', [None])[2:] == rec[2:]:
+                    records[f'{x}/{y}'] = rec  # 内容未变，只刷新 mtime
+                    continue
+                records[f'{x}/{y}'] = rec
+                try:
+                    size = (right - left, bottom - top)
+                    im = decode_tile(io.BytesIO(data), size)
+                except Exception as e:
+                    print(f"警告: 读取失败 {path}: {e}", file=sys.stderr)
+            changed += 1
+            for by in range(max(0, top) // bh, min(base.down, -(-bottom // bh))):
+                for bx in range(max(0, left) // bw, min(base.across, -(-right // bw))):
+                    block = dirty.get((bx, by))
+                    if block is None:
+                        block = dirty[(bx, by)] = tif.read_block(0, bx, by)
+                    ox, oy = left - bx * bw, top - by * bh
+                    block.paste((0, 0, 0, 0), (ox, oy, ox + right - left, oy + bottom - top))
+                    if im is not None:
+                        block.paste(im, (ox, oy), im)
+
+        for level in range(len(tif.levels)):
+            if level:
+                dirty = _rebuild_overview_blocks(tif, level, dirty)
+            for (bx, by), block in dirty.items():
+                try:
+                    tif.write_block(level, bx, by, block)
+                except OverflowError:
+                    # 追加会超出经典 TIFF 的 32 位偏移：先整理并升级为 BigTIFF 再写
+                    tif.close()
+                    compact_tiff(output, bigtiff=True)
+                    tif = TiledTiff(output, writable=True)
+                    tif.write_block(level, bx, by, block)
+            written.append(len(dirty))
+
+        # 放不回原位置的块追加在末尾，旧数据成为空洞；空洞过多时整理，恢复 COG 布局
+        if tif.wasted_bytes() > COMPACT_WASTE_RATIO * tif.data_bytes():
+            tif.close()
+            compact_tiff(output)
+    finally:
+        tif.close()
+    return changed, written
+
+
+def _rebuild_overview_blocks(tif, level, child_dirty):
+    """由上一层（已更新）的块重算本层受影响的块，与 downsample 的整图结果一致"""
+    prev, cur = tif.levels[level - 1], tif.levels[level]
+    bw, bh = cur.block_w, cur.block_h
+    rebuilt = {}
+    for px, py in {(bx // 2, by // 2) for bx, by in child_dirty}:
+        region = Image.new('RGBA', (2 * bw, 2 * bh), (0, 0, 0, 0))
+        for cy in range(2 * py, min(prev.down, 2 * py + 2)):
+            for cx in range(2 * px, min(prev.across, 2 * px + 2)):
+                blk = child_dirty.get((cx, cy)) or tif.read_block(level - 1, cx, cy)
+                region.paste(blk, ((cx - 2 * px) * prev.block_w, (cy - 2 * py) * prev.block_h))
+        # 截到上一层的实际边界，奇数边长时与整图缩小的边缘处理保持一致
+        region = region.crop((0, 0, min(2 * bw, prev.width - 2 * px * bw), min(2 * bh, prev.height - 2 * py * bh)))
+        block = Image.new('RGBA', (bw, bh), (0, 0, 0, 0))
+        block.paste(region.convert('RGBa').reduce(2).convert('RGBA'), (0, 0))
+        rebuilt[(px, py)] = block
+    return rebuilt
+
+
+def stitch(z, x_min, x_max, y_min, y_max, input_dir: Path, output: Path, tile_size=TILE_SIZE, output_format='PNG',
+           block_size=512, index=None, scale=1.0, incremental=False, canvas='memory',
+           compress_level=6, encode_workers=ENCODE_WORKERS, quality=90, tile_cache=None):
     cols = x_max - x_min + 1
     rows = y_max - y_min + 1
-    width, height = cols * tile_size, rows * tile_size
-    out_img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-
-    missing = 0
-    total = cols * rows
+    scale = min(1.0, float(scale))
+    cell = tile_size * scale  # 输出中每个 z 级瓦片的边长（像素，可为小数）
+    width, height = max(1, round(cols * cell)), max(1, round(rows * cell))
+
+    is_cog = output_format.upper() in COG_FORMATS
+    if is_cog:
+        if output.suffix.lower() not in ('.tif', '.tiff'):
+            output = output.with_suffix('.tif')
+    elif not output.suffix.lower():
+        output = output.with_suffix('.png')
 
-    for x in tqdm(range(x_min, x_max + 1), desc=f'拼接 {output.stem}'):
-        for y in range(y_min, y_max + 1):
-            tile_path = find_tile_file(input_dir, z, x, y)
-            if not tile_path:
-                missing += 1
+    # 缩小输出时尽量从更低 zoom 取源瓦片，否则在解码时逐瓦片缩小
+    src_z, src_index = choose_source_zoom(input_dir, z, x_min, x_max, y_min, y_max, scale)
+    if src_index is None:
+        src_index = index if index is not None else TileIndex(input_dir, z)
+    d = z - src_z
+    sx_min, sx_max, sy_min, sy_max = x_min >> d, x_max >> d, y_min >> d, y_max >> d
+    if d:
+        print(f"{output.stem} 使用 z{src_z} 瓦片作为缩小输出的源", file=sys.stderr)
+
+    coverage = src_index.coverage(sx_min, sx_max, sy_min, sy_max)
+    print(f"{output.stem} {format_coverage(coverage)}", file=sys.stderr)
+
+    def covered(x, y):
+        # 源瓦片 (x, y) 在输出 zoom 范围内对应的瓦片数
+        w = min(x_max, ((x + 1) << d) - 1) - max(x_min, x << d) + 1
+        h = min(y_max, ((y + 1) << d) - 1) - max(y_min, y << d) + 1
+        return max(0, w) * max(0, h)
+
+    # total/missing 按输出 zoom 计；使用更低 zoom 作源时，源 zoom 的计数与缺失位置另记为 source_*
+    missing = sum(covered(x, y) for x, y in coverage['missing_tiles'])
+    source_missing = coverage['missing']
+    result = {'z': z, 'x_min': x_min, 'x_max': x_max, 'y_min': y_min, 'y_max': y_max,
+              'cols': cols, 'rows': rows, 'total': cols * rows, 'missing': missing,
+              'source_zoom': src_z, 'source_total': coverage['total'], 'source_missing': source_missing,
+              'missing_tiles': coverage['missing_tiles'],
+              'width': width, 'height': height, 'output': str(output), 'world_file': None}
+
+    def edge(i, origin):
+        # 源瓦片 i 的左/上边在输出中的像素位置
+        return round(((i << d) - origin) * cell)
+
+    def rect(x, y):
+        return edge(x, x_min), edge(y, y_min), edge(x + 1, x_min), edge(y + 1, y_min)
+
+    params = {'z': z, 'x_min': x_min, 'x_max': x_max, 'y_min': y_min, 'y_max': y_max,
+              'tile_size': tile_size, 'scale': scale, 'source_zoom': src_z,
+              'format': output_format.upper(), 'block_size': block_size}
+
+    manifest = load_manifest(output, params) if incremental else None
+    if manifest is not None and is_cog:
+        records = manifest['tiles']
+        changed = diff_manifest(src_index, records, sx_min, sx_max, sy_min, sy_max)
+        n_changed, written = 0, []
+        if changed:
+            n_changed, written = patch_cog(output, {k: (rect(*k), p) for k, p in changed.items()}, records)
+        save_manifest(output, params, records)
+        print(f"{output.stem} 增量更新: {n_changed} 个瓦片变化，重写块 {sum(written)}", file=sys.stderr)
+        result.update({'changed': n_changed, 'blocks_rewritten': sum(written)})
+        return result
+
+    out_img = new_canvas(canvas, (width, height), workdir=output.parent)
+    # 清单只对 COG 输出有用（其他格式总是整图重拼），其余情况不读取原始字节、不计算 hash
+    track = incremental and is_cog
+    records = {}
+
+    for x in tqdm(range(sx_min, sx_max + 1), desc=f'拼接 {output.stem}'):
+        col = src_index.column(x)
+        for y in range(sy_min, sy_max + 1):
+            hit = col.get(y)
+            if hit is None:
                 continue
+            tile_path = hit[0]
+            left, top, right, bottom = rect(x, y)
+            size = (right - left, bottom - top)
+            if size[0] <= 0 or size[1] <= 0:
+                continue
+            target = None if size == (tile_size, tile_size) else size
             try:
-                with Image.open(tile_path) as im:
-                    im = im.convert('RGBA')
-                    out_img.paste(im, ((x - x_min) * tile_size, (y - y_min) * tile_size), im)
+                if track:
+                    data, records[f'{x}/{y}'] = read_tile_bytes(tile_path)
+                    source = io.BytesIO(data)
+                else:
+                    source = tile_path
+                if tile_cache is not None:
+                    im = tile_cache.get_or_decode((str(tile_path), size), lambda: decode_tile(source, target))
+                else:
+                    im = decode_tile(source, target)
+                out_img.paste(im, (left, top))
             except Exception as e:
                 print(f"警告: 读取失败 {tile_path}: {e}", file=sys.stderr)
-                missing += 1
+                missing += covered(x, y)
+                source_missing += 1
 
     output.parent.mkdir(parents=True, exist_ok=True)
-    if not output.suffix.lower():
-        output = output.with_suffix('.png')
-    out_img.save(output, format=output_format)
+    try:
+        if is_cog:
+            write_cog(out_img, output, z, x_min, y_min, tile_size=width / cols, block_size=block_size,
+                      level=compress_level, workers=encode_workers)
+            files = [output]
+        else:
+            files = save_image(out_img, output, output_format, level=compress_level,
+                               workers=encode_workers, quality=quality)
+            if files == [output]:
+                # PNG/JPEG/WebP 没有地理参考标签，附 world file 供 GIS 与 server.py 的拼接图来源使用
+                write_world_file(output, *tile_range_geotransform(z, x_min, y_min, width / cols))
+                result['world_file'] = str(world_file_path(output))
+    finally:
+        out_img.close()
+    if track:
+        save_manifest(output, params, records)
+    result['missing'] = missing
+    result['source_missing'] = source_missing
+    result['files'] = [str(f) for f in files]
+    return result
+
+
+def resolve_scale(cols, tile_size, scale=None, max_width=None):
+    """由 --scale / --max-width 得到最终缩放比例（不放大）"""
+    s = float(scale) if scale else 1.0
+    if max_width:
+        s = min(s, max_width / float(cols * tile_size))
+    return min(1.0, s)
+
+
+def tile_to_lonlat(x, y, z):
+    """瓦片左上角 (x, y) 的经纬度"""
+    n = 2.0 ** z
+    lon = x / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lon, lat
+
+
+def world_file_path(image_path: Path) -> Path:
+    """world file 扩展名：首字母 + 末字母 + w（.png → .pgw，.tif → .tfw）"""
+    ext = image_path.suffix.lstrip('.')
+    return image_path.with_suffix(f'.{ext[0]}{ext[-1]}w' if len(ext) > 1 else '.wld')
+
+
+def write_world_file(image_path: Path, ulx, uly, res):
+    with open(world_file_path(image_path), 'w', encoding='ascii') as f:
+        # 像元宽、旋转、旋转、像元高（负）、左上像元中心 x、y
+        f.write(f"{res:.10f}\n0.0\n0.0\n{-res:.10f}\n{ulx + res / 2:.10f}\n{uly - res / 2:.10f}\n")
+
+
+def _render_sheet(z, x_min, x_max, y_min, y_max, input_dir, output, options):
+    """进程池工作函数：拼接一幅（world file 或 GeoTIFF 标签由 stitch 写出）"""
+    return stitch(z, x_min, x_max, y_min, y_max, Path(input_dir), Path(output), **options)
+
+
+def stitch_sheets(z, x_min, x_max, y_min, y_max, input_dir: Path, output: Path, sheet_size,
+                  workers=None, **options):
+    """
+    将瓦片范围切成边长 sheet_size 瓦片的 N×M 幅，在进程池中并行拼接。
+    每幅写为 {stem}_r{行}_c{列}{ext}（PNG/JPEG/WebP 附 world file，COG 自带地理参考），另写 {stem}.sheets.json 索引
+    记录每幅的瓦片范围与地理范围（WGS84 经纬度与 EPSG:3857）。
+    """
+    workers = workers or os.cpu_count() or 1
+    # 进程间已并行，编码线程按进程数均分
+    options['encode_workers'] = max(1, options.get('encode_workers', ENCODE_WORKERS) // workers)
+    suffix = output.suffix or '.png'
+    jobs = []
+    for r, sy in enumerate(range(y_min, y_max + 1, sheet_size)):
+        for c, sx in enumerate(range(x_min, x_max + 1, sheet_size)):
+            ex, ey = min(x_max, sx + sheet_size - 1), min(y_max, sy + sheet_size - 1)
+            sheet_out = output.with_name(f'{output.stem}_r{r}_c{c}{suffix}')
+            jobs.append((r, c, (z, sx, ex, sy, ey, str(input_dir), str(sheet_out), options)))
+
+    print(f"🗂️ {output.stem}: {len(jobs)} 幅（{sheet_size}x{sheet_size} 瓦片/幅），{workers} 个进程", file=sys.stderr)
+    sheets = []
+    total = missing = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(r, c, pool.submit(_render_sheet, *args)) for r, c, args in jobs]
+        for r, c, fut in futures:
+            res = fut.result()
+            total += res['total']
+            missing += res['missing']
+            west, north = tile_to_lonlat(res['x_min'], res['y_min'], z)
+            east, south = tile_to_lonlat(res['x_max'] + 1, res['y_max'] + 1, z)
+            ulx, uly, px = tile_range_geotransform(z, res['x_min'], res['y_min'], res['width'] / res['cols'])
+            sheets.append({
+                'row': r, 'col': c, 'file': Path(res['output']).name,
+                'world_file': Path(res['world_file']).name if res['world_file'] else None,
+                'x_range': [res['x_min'], res['x_max']], 'y_range': [res['y_min'], res['y_max']],
+                'width': res['width'], 'height': res['height'],
+                'bounds': [west, south, east, north],
+                'bounds_3857': [ulx, uly - res['height'] * px, ulx + res['width'] * px, uly],
+                'missing': res['missing'],
+            })
+
+    index_path = output.with_name(f'{output.stem}.sheets.json')
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump({'z': z, 'crs': 'EPSG:3857', 'sheet_size': sheet_size,
+                   'x_range': [x_min, x_max], 'y_range': [y_min, y_max],
+                   'rows': max(s['row'] for s in sheets) + 1, 'cols': max(s['col'] for s in sheets) + 1,
+                   'sheets': sheets}, f, ensure_ascii=False, indent=2)
     return {'z': z, 'x_min': x_min, 'x_max': x_max, 'y_min': y_min, 'y_max': y_max,
-            'cols': cols, 'rows': rows, 'total': total, 'missing': missing, 'output': str(output)}
+            'cols': x_max - x_min + 1, 'rows': y_max - y_min + 1, 'total': total, 'missing': missing,
+            'sheets': len(sheets), 'output': str(index_path),
+            'files': [str(index_path.with_name(s['file'])) for s in sheets]}
 
 
 def parse_range(s: str):
@@ -86,7 +592,72 @@ def parse_range(s: str):
     return int(parts[0]), int(parts[1])
 
 
-def run_from_config(config_path: str):
+def _job_overlap(a, b):
+    """两个任务（同一 outdir 与 zoom）重叠的瓦片数"""
+    if a['outdir'] != b['outdir'] or a['z'] != b['z']:
+        return 0
+    w = min(a['x_max'], b['x_max']) - max(a['x_min'], b['x_min']) + 1
+    h = min(a['y_max'], b['y_max']) - max(a['y_min'], b['y_min']) + 1
+    return max(0, w) * max(0, h)
+
+
+def order_jobs_by_overlap(specs):
+    """
+    贪心排序：从最大的任务开始，每次接上与上一个任务重叠最多的任务，
+    使重叠区域在时间上相邻处理，提高共享解码缓存的命中率。
+    """
+    remaining = list(specs)
+    if not remaining:
+        return []
+    area = lambda j: (j['x_max'] - j['x_min'] + 1) * (j['y_max'] - j['y_min'] + 1)
+    current = max(remaining, key=area)
+    ordered = [current]
+    remaining.remove(current)
+    while remaining:
+        current = max(remaining, key=lambda j: (_job_overlap(current, j), -abs(j['z'] - current['z'])))
+        ordered.append(current)
+        remaining.remove(current)
+    return ordered
+
+
+def run_jobs(specs, parallel_jobs=1, cache_bytes=0):
+    """按重叠顺序执行任务，共享解码缓存（cache_bytes > 0 时）与目录索引；parallel_jobs > 1 时并发执行"""
+    cache = DecodedTileCache(cache_bytes) if cache_bytes else None
+    indexes = {}
+    for spec in specs:
+        key = (str(spec['outdir']), spec['z'])
+        if key not in indexes:
+            indexes[key] = TileIndex(spec['outdir'], spec['z'])
+
+    def run(spec):
+        print(f"\n🧩 开始拼接任务: {spec['name']}")
+        args = (spec['z'], spec['x_min'], spec['x_max'], spec['y_min'], spec['y_max'], spec['outdir'], spec['output'])
+        options = spec['options']
+        if options.get('sheet_size'):
+            options = dict(options)
+            sheet_size = options.pop('sheet_size')
+            workers = options.pop('sheet_workers', None)
+            result = stitch_sheets(*args, sheet_size, workers=workers, **options)
+        else:
+            options = {k: v for k, v in options.items() if k not in ('sheet_size', 'sheet_workers')}
+            result = stitch(*args, index=indexes[(str(spec['outdir']), spec['z'])], tile_cache=cache, **options)
+        print(f"✅ 完成: {result['output']} | 缺失: {result['missing']}/{result['total']}")
+        return result
+
+    ordered = order_jobs_by_overlap(specs)
+    if parallel_jobs <= 1:
+        results = [run(spec) for spec in ordered]
+    else:
+        with ThreadPoolExecutor(max_workers=parallel_jobs) as pool:
+            # 按排好的顺序提交，重叠任务大致同时或相继运行
+            results = list(pool.map(run, ordered))
+    if cache is not None:
+        st = cache.stats()
+        print(f"📦 解码缓存: 命中 {st['hits']}，未命中 {st['misses']}，命中率 {st['hit_ratio']:.1%}", file=sys.stderr)
+    return results
+
+
+def run_from_config(config_path: str, parallel_jobs=None, cache_mb=None):
     with open(config_path, 'r', encoding='utf-8') as f:
         config = json.load(f)
 
@@ -95,12 +666,28 @@ def run_from_config(config_path: str):
     input_dir_default = defaults.get("outdir", "out")
     tile_size_default = defaults.get("tile_size", TILE_SIZE)
     format_default = defaults.get("format", "PNG")
-
+    block_size_default = defaults.get("block_size", 512)
+    scale_default = defaults.get("scale")
+    max_width_default = defaults.get("max_width")
+    incremental_default = defaults.get("incremental", False)
+    canvas_default = defaults.get("canvas", "memory")
+    compress_level_default = defaults.get("compress_level", 6)
+    encode_workers_default = defaults.get("encode_workers", ENCODE_WORKERS)
+    quality_default = defaults.get("quality", 90)
+    sheet_size_default = defaults.get("sheet_size")
+    sheet_workers_default = defaults.get("sheet_workers")
+    if parallel_jobs is None:
+        parallel_jobs = config.get("parallel_jobs", defaults.get("parallel_jobs", 1))
     jobs = config.get("jobs", [])
+    if cache_mb is None:
+        # 多个任务时无论串行还是并发都共享解码缓存，重叠任务按排序相继运行时同样命中
+        cache_mb = config.get("tile_cache_mb", defaults.get("tile_cache_mb", 512 if len(jobs) > 1 else 0))
+
     if not jobs:
         print("❌ config.json 中未找到 'jobs' 字段", file=sys.stderr)
         sys.exit(1)
 
+    specs = []
     for job in jobs:
         name = job.get("name", "unnamed")
         zoom = job.get("zoom")
@@ -109,6 +696,16 @@ def run_from_config(config_path: str):
         output = Path(job.get("output", f"maps/{name}.png"))
         tile_size = job.get("tile_size", tile_size_default)
         fmt = job.get("format", format_default)
+        block_size = job.get("block_size", block_size_default)
+        scale = job.get("scale", scale_default)
+        max_width = job.get("max_width", max_width_default)
+        incremental = job.get("incremental", incremental_default)
+        canvas = job.get("canvas", canvas_default)
+        compress_level = job.get("compress_level", compress_level_default)
+        encode_workers = job.get("encode_workers", encode_workers_default)
+        quality = job.get("quality", quality_default)
+        sheet_size = job.get("sheet_size", sheet_size_default)
+        sheet_workers = job.get("sheet_workers", sheet_workers_default)
 
         if zoom is None or bbox is None:
             print(f"⚠️ 跳过任务 '{name}'：缺少 zoom 或 bbox", file=sys.stderr)
@@ -122,9 +719,15 @@ def run_from_config(config_path: str):
 
         x_min, x_max, y_min, y_max = bbox_to_tile_range(min_lon, min_lat, max_lon, max_lat, zoom)
 
-        print(f"\n🧩 开始拼接任务: {name}")
-        result = stitch(zoom, x_min, x_max, y_min, y_max, outdir, output, tile_size, fmt)
-        print(f"✅ 完成: {result['output']} | 缺失: {result['missing']}/{result['total']}")
+        scale = resolve_scale(x_max - x_min + 1, tile_size, scale, max_width)
+        options = dict(tile_size=tile_size, output_format=fmt, block_size=block_size, scale=scale,
+                       incremental=incremental, canvas=canvas, compress_level=compress_level,
+                       encode_workers=encode_workers, quality=quality,
+                       sheet_size=sheet_size, sheet_workers=sheet_workers)
+        specs.append({'name': name, 'z': zoom, 'x_min': x_min, 'x_max': x_max, 'y_min': y_min, 'y_max': y_max,
+                      'outdir': outdir, 'output': output, 'options': options})
+
+    return run_jobs(specs, parallel_jobs=parallel_jobs, cache_bytes=int(cache_mb * 1024 * 1024))
 
 
 def main():
@@ -139,12 +742,26 @@ def main():
     parser.add_argument('--input-dir', default='out', help='瓦片根目录')
     parser.add_argument('--output', help='输出文件路径')
     parser.add_argument('--tile-size', type=int, default=TILE_SIZE)
-    parser.add_argument('--format', default='PNG')
+    parser.add_argument('--format', default='PNG', help='输出格式：PNG/JPEG/WEBP… 或 COG（Cloud-Optimized GeoTIFF）')
+    parser.add_argument('--block-size', type=int, default=512, choices=[256, 512], help='COG 内部分块大小')
+    parser.add_argument('--scale', type=float, help='输出缩放比例（0~1），如 0.05 输出 1/20 尺寸的概览图')
+    parser.add_argument('--max-width', type=int, help='输出最大宽度（像素），自动换算缩放比例')
+    parser.add_argument('--incremental', action='store_true', help='增量拼接：COG 输出只重写变化瓦片所在的块')
+    parser.add_argument('--canvas', default='memory', choices=sorted(CANVAS_BACKENDS),
+                        help='画布后端：memory（内存）或 memmap（磁盘映射，适合超过内存的大图，需要 numpy）')
+    parser.add_argument('--compress-level', type=int, default=6, choices=range(10), metavar='0-9',
+                        help='压缩级别：PNG/COG 的 deflate 级别，WebP 映射为 method（越大越小越慢）')
+    parser.add_argument('--encode-workers', type=int, default=ENCODE_WORKERS, help='并行编码线程数')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG/WebP 质量')
+    parser.add_argument('--sheet-size', type=int, help='分幅输出：每幅边长（瓦片数），各幅多进程并行拼接')
+    parser.add_argument('--sheet-workers', type=int, help='分幅拼接的进程数（默认 CPU 核数）')
+    parser.add_argument('--jobs', type=int, help='配置文件模式：同时拼接的任务数（覆盖 parallel_jobs）')
+    parser.add_argument('--tile-cache-mb', type=int, help='配置文件模式：共享解码缓存上限（MB，覆盖 tile_cache_mb）')
 
     args = parser.parse_args()
 
     if args.config:
-        run_from_config(args.config)
+        run_from_config(args.config, parallel_jobs=args.jobs, cache_mb=args.tile_cache_mb)
     else:
         # 旧命令行模式
         if not args.zoom or not args.output:
@@ -165,14 +782,27 @@ def main():
             x_min, x_max = parse_range(args.xrange)
             y_min, y_max = parse_range(args.yrange)
 
-        result = stitch(z, x_min, x_max, y_min, y_max, input_dir, Path(args.output),
-                        tile_size=args.tile_size, output_format=args.format)
+        scale = resolve_scale(x_max - x_min + 1, args.tile_size, args.scale, args.max_width)
+        options = dict(tile_size=args.tile_size, output_format=args.format, block_size=args.block_size,
+                       scale=scale, incremental=args.incremental,
+                       canvas=args.canvas, compress_level=args.compress_level,
+                       encode_workers=args.encode_workers, quality=args.quality)
+        if args.sheet_size:
+            result = stitch_sheets(z, x_min, x_max, y_min, y_max, input_dir, Path(args.output), args.sheet_size,
+                                   workers=args.sheet_workers, **options)
+        else:
+            result = stitch(z, x_min, x_max, y_min, y_max, input_dir, Path(args.output), **options)
         print('拼接完成:')
         print(f" - zoom: {result['z']}")
         print(f" - x: {result['x_min']}..{result['x_max']} ({result['cols']} cols)")
         print(f" - y: {result['y_min']}..{result['y_max']} ({result['rows']} rows)")
-        print(f" - tiles 总计: {result['total']}, 缺失: {result['missing']}")
-        print(f" - 输出: {result['output']}")
+        print(f" - tiles 总计（z{result['z']}）: {result['total']}, 缺失: {result['missing']}")
+        if args.sheet_size:
+            print(f" - 分幅: {result['sheets']} 幅，索引 {result['output']}")
+        elif scale < 1.0:
+            print(f" - 缩放: {scale:.4f}（源 zoom {result['source_zoom']}：{result['source_total']} 个瓦片，"
+                  f"缺失 {result['source_missing']}；{result['width']}x{result['height']}）")
+        print(f" - 输出: {', '.join(result['files']) if result.get('files') else result['output']}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,40 @@
+import sys
+from pathlib import Path
+
+# 仓库为平铺脚本，测试直接按模块名导入
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+import pytest  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+def write_tile(root, z, x, y, ext='png', color=(0, 0, 0, 255), size=256):
+    """在 root 下写出 {z}/{x}/{y}.{ext} 纯色瓦片，返回路径"""
+    path = Path(root) / str(z) / str(x) / f'{y}.{ext}'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    im = Image.new('RGBA', (size, size), color)
+    if ext in ('jpg', 'jpeg'):
+        im = im.convert('RGB')
+    im.save(path, {'png': 'PNG', 'webp': 'WEBP', 'jpg': 'JPEG', 'jpeg': 'JPEG'}[ext], lossless=True)
+    return path
+
+
+@pytest.fixture
+def srv(tmp_path, monkeypatch):
+    """server 模块，瓦片目录指向临时目录，关闭拼接图、代理与预取"""
+    import server
+    tiles = tmp_path / 'out'
+    tiles.mkdir()
+    monkeypatch.setattr(server, 'TILES_DIR', tiles)
+    monkeypatch.setattr(server, 'UNDERZOOM_CACHE_DIR', tiles / '.underzoom')
+    monkeypatch.setattr(server, 'EXPORT_CACHE_DIR', tiles / '.exports')
+    monkeypatch.setattr(server, 'tile_index', server.TileIndex(tiles))
+    monkeypatch.setattr(server, 'coverage', server.CoverageCache(tiles))
+    monkeypatch.setattr(server, 'tile_source', server.DirectorySource(tiles))
+    monkeypatch.setattr(server, 'response_cache', server.ResponseCache(server.RESPONSE_CACHE_MB * 1024 * 1024))
+    monkeypatch.setattr(server, 'USE_TILE_INDEX', True)
+    monkeypatch.setattr(server, 'mosaics', None)
+    monkeypatch.setattr(server, 'upstream', None)
+    monkeypatch.setattr(server, 'prefetcher', server.Prefetcher(workers=0))
+    return server
@@ -0,0 +1,134 @@
+import asyncio
+import threading
+
+import pytest
+
+import async_server
+from conftest import write_tile
+from mosaic_source import MosaicSource
+from tile_sources import iter_loose_tiles, open_archive, pack_pmtiles
+
+
+async def fetch_all(srv, paths, headers=''):
+    """在同一 keep-alive 连接上依次请求，返回 [(状态码, 头部字典, 响应体)]"""
+    server = async_server.AsyncTileServer(srv, 2)
+    server.slots = asyncio.Semaphore(4)
+    listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+    results = []
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for path in paths:
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: x\r\n{headers}\r\n'.encode())
+            await writer.drain()
+            head = (await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)).decode('latin-1')
+            lines = head.split('\r\n')
+            fields = {k.lower(): v.strip() for k, _, v in (l.partition(':') for l in lines[1:] if l)}
+            body = await reader.readexactly(int(fields['content-length']))
+            results.append((int(lines[0].split()[1]), fields, body))
+        writer.close()
+    finally:
+        listener.close()
+        await listener.wait_closed()
+        server.executor.shutdown()
+        server.io_executor.shutdown()
+    return results
+
+
+def test_stored_tile_sent_with_sendfile(srv):
+    path = write_tile(srv.TILES_DIR, 4, 3, 5, 'png', (9, 8, 7, 255))
+    (status, fields, body), = asyncio.run(fetch_all(srv, ['/tiles/4/3/5.png']))
+    assert status == 200
+    assert fields['content-type'] == 'image/png'
+    assert body == path.read_bytes()
+
+
+def test_empty_tile_does_not_break_connection(srv):
+    """0 字节的瓦片不走 sendfile，同一连接上的后续请求照常应答"""
+    write_tile(srv.TILES_DIR, 4, 3, 5, 'png')
+    empty = srv.TILES_DIR / '4' / '3' / '6.png'
+    empty.write_bytes(b'')
+    results = asyncio.run(fetch_all(srv, ['/tiles/4/3/6.png', '/tiles/4/3/5.png']))
+    assert (results[0][0], results[0][1]['content-length'], results[0][2]) == (200, '0', b'')
+    assert results[1][0] == 200
+    assert results[1][2] == (srv.TILES_DIR / '4' / '3' / '5.png').read_bytes()
+
+
+def planning_threads(srv, monkeypatch, path):
+    """请求 path，返回执行 plan_tile 的线程名"""
+    threads = []
+    plan_tile = srv.plan_tile
+
+    def recording(*args):
+        threads.append(threading.current_thread().name)
+        return plan_tile(*args)
+
+    monkeypatch.setattr(srv, 'plan_tile', recording)
+    (status, _, body), = asyncio.run(fetch_all(srv, [path]))
+    assert status == 200 and body
+    return threads
+
+
+@pytest.mark.parametrize('use_index', [True, False])
+def test_directory_planned_in_thread(srv, monkeypatch, use_index):
+    """松散目录的查找要 stat 瓦片文件（--no-index 时还要逐个探测），规划在线程池中进行，不阻塞事件循环"""
+    write_tile(srv.TILES_DIR, 4, 3, 5, 'png')
+    monkeypatch.setattr(srv, 'USE_TILE_INDEX', use_index)
+    threads = planning_threads(srv, monkeypatch, '/tiles/4/3/5.png')
+    assert len(threads) == 1 and threads[0] != 'MainThread'
+
+
+@pytest.fixture
+def pmtiles(srv, tmp_path, monkeypatch):
+    write_tile(tmp_path / 'loose', 4, 3, 5, 'png')
+    output = tmp_path / 'region.pmtiles'
+    pack_pmtiles(list(iter_loose_tiles(tmp_path / 'loose')), output, 'png', 'region')
+    source = open_archive(output)
+    monkeypatch.setattr(srv, 'tile_source', source)
+    return source
+
+
+@pytest.mark.parametrize('path', ['/tiles/4/3/5.png', '/tiles/4/3/6.png', '/tiles/3/1/2@2x.png'])
+def test_pmtiles_planned_inline_when_in_memory(srv, monkeypatch, pmtiles, path):
+    """mmap 的 PMTiles 且文件身份由后台线程检查时，命中、缺失（合成或占位）都在事件循环上规划"""
+    pmtiles.start_watcher(60)
+    assert set(planning_threads(srv, monkeypatch, path)) == {'MainThread'}
+
+
+def test_pmtiles_stat_check_planned_in_thread(srv, monkeypatch, pmtiles):
+    """没有后台线程时查找会按间隔 stat 归档文件，规划在线程池中进行"""
+    threads = planning_threads(srv, monkeypatch, '/tiles/4/3/5.png')
+    assert len(threads) == 1 and threads[0] != 'MainThread'
+
+
+def test_unscanned_mosaics_planned_in_thread(srv, monkeypatch, pmtiles, tmp_path):
+    """拼接图目录首次扫描前，缺失瓦片的规划会触及文件系统，在线程池中进行；扫描后回到事件循环"""
+    pmtiles.start_watcher(60)
+    monkeypatch.setattr(srv, 'mosaics', MosaicSource(tmp_path / 'map'))
+    threads = planning_threads(srv, monkeypatch, '/tiles/4/3/6.png')
+    assert len(threads) == 1 and threads[0] != 'MainThread'
+    assert srv.mosaics.loaded
+    assert planning_threads(srv, monkeypatch, '/tiles/4/3/6.png') == ['MainThread']
+
+
+def test_blank_tile_does_not_wait(srv):
+    """占位图常驻内存，不经过 ResponseCache 的 single-flight"""
+    assert srv.blank_tile() is srv.blank_tile()
+    assert not srv.response_cache.stats()['entries']
+
+
+class MissingUpstream:
+    """上游一律 404 的读穿代理替身"""
+
+    def recently_failed(self, z, x, y):
+        return None
+
+    def fetch(self, z, x, y):
+        return 404
+
+
+def test_upstream_error_status(srv, monkeypatch):
+    monkeypatch.setattr(srv, 'upstream', MissingUpstream())
+    (status, fields, body), = asyncio.run(fetch_all(srv, ['/tiles/4/3/5.png']))
+    assert status == 404 and fields['cache-control'] == 'no-store'
+    assert body == srv.blank_tile()[0]
@@ -0,0 +1,53 @@
+import io
+import tarfile
+
+import pytest
+
+from conftest import write_tile
+
+
+@pytest.fixture
+def client(srv):
+    for x, y in ((1, 2), (2, 2), (1, 3)):
+        write_tile(srv.TILES_DIR, 4, x, y, 'png', color=(x * 40, y * 40, 0, 255))
+    write_tile(srv.TILES_DIR, 4, 2, 3, 'webp')
+    return srv.app.test_client()
+
+
+def expected(srv, z, x, y, ext):
+    return (srv.TILES_DIR / str(z) / str(x) / f'{y}.{ext}').read_bytes()
+
+
+def test_tar_by_range(srv, client):
+    resp = client.post('/tiles/batch', json={'z': 4, 'x': [1, 2], 'y': [2, 4]})
+    assert resp.status_code == 200 and resp.mimetype == 'application/x-tar'
+    assert resp.headers['X-Tiles-Found'] == '4' and resp.headers['X-Tiles-Missing'] == '2'
+    with tarfile.open(fileobj=io.BytesIO(resp.data)) as tar:
+        members = {m.name: tar.extractfile(m).read() for m in tar.getmembers()}
+    assert sorted(members) == ['4/1/2.png', '4/1/3.png', '4/2/2.png', '4/2/3.webp']
+    assert members['4/2/3.webp'] == expected(srv, 4, 2, 3, 'webp')
+
+
+def test_frames_by_list(srv, client):
+    keys = [[4, 1, 2], [4, 9, 9], [4, 2, 3], [4, 1, 2]]
+    resp = client.post('/tiles/batch?format=frames', json={'tiles': keys})
+    assert resp.headers['X-Tiles-Found'] == '2' and resp.headers['X-Tiles-Missing'] == '1'
+    data, frames = resp.data, {}
+    while data:
+        z, x, y, ext, length = srv.BATCH_FRAME.unpack_from(data)
+        start = srv.BATCH_FRAME.size
+        frames[(z, x, y)] = (ext.rstrip(b'\0').decode(), data[start:start + length])
+        data = data[start + length:]
+    assert frames == {(4, 1, 2): ('png', expected(srv, 4, 1, 2, 'png')),
+                      (4, 2, 3): ('webp', expected(srv, 4, 2, 3, 'webp'))}
+
+
+@pytest.mark.parametrize('body', [
+    [1, 2, 3],
+    {'tiles': [[4, 1]]},
+    {'z': 4, 'x': [0, 1]},
+    {'z': 20, 'x': [0, 1000], 'y': [0, 1000]},
+])
+def test_invalid_requests(client, body):
+    resp = client.post('/tiles/batch', json=body)
+    assert resp.status_code == 400 and 'error' in resp.get_json()
@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from canvas import ImageCanvas, MemmapCanvas
+
+
+def tile(seed, size=(40, 30)):
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, size=(size[1], size[0], 4), dtype=np.uint8), 'RGBA')
+
+
+def test_memmap_paste_matches_pillow(tmp_path):
+    ref, mm = ImageCanvas((64, 48)), MemmapCanvas((64, 48), tmp_path)
+    opaque = Image.new('RGBA', (64, 48), (10, 20, 30, 255))
+    # 不透明底图、半透明叠加与越界粘贴
+    for im, pos in ((opaque, (0, 0)), (tile(1), (5, 4)), (tile(2), (40, 30)), (tile(3), (-10, -8))):
+        ref.paste(im, pos)
+        mm.paste(im, pos)
+    assert np.array_equal(np.asarray(ref.as_image()), np.asarray(mm.as_image()))
+    box = (-5, 40, 70, 60)
+    assert np.array_equal(np.asarray(ref.crop(box)), np.asarray(mm.crop(box)))
+    mm.close()
+
+
+def test_memmap_reduced_and_cleanup(tmp_path):
+    mm = MemmapCanvas((33, 17), tmp_path)
+    mm.paste(Image.new('RGBA', (33, 17), (200, 100, 50, 255)), (0, 0))
+    half = mm.reduced(band=4)
+    assert half.size == (17, 9)
+    assert tuple(half.array[4, 8]) == (200, 100, 50, 255)
+    paths = [mm.path, half.path]
+    mm.close()
+    half.close()
+    assert not any(os.path.exists(p) for p in paths)
+
+
+def test_memmap_jpeg_encoded_in_budgeted_sheets(tmp_path, monkeypatch):
+    import encoders
+    mm = MemmapCanvas((600, 300), tmp_path)
+    mm.paste(tile(4, (600, 300)).convert('RGB').convert('RGBA'), (0, 0))
+    monkeypatch.setattr(encoders, 'SHEET_MAX_BYTES', 256 * 256 * 4)
+    monkeypatch.setattr(MemmapCanvas, 'as_image', lambda self: (_ for _ in ()).throw(AssertionError('整图物化')))
+    files = encoders.save_image(mm, tmp_path / 'big.jpg', 'JPEG', workers=2)
+    assert sorted(p.name for p in files) == [f'big_r{r}_c{c}.jpg' for r in range(2) for c in range(3)]
+    with Image.open(tmp_path / 'big_r1_c2.jpg') as im:
+        assert im.size == (600 - 512, 300 - 256)
+    mm.close()
+
+
+def test_memory_canvas_below_format_limit_stays_single_file(tmp_path, monkeypatch):
+    import encoders
+    monkeypatch.setattr(encoders, 'SHEET_MAX_BYTES', 256 * 256 * 4)
+    canvas = ImageCanvas((600, 300))
+    assert encoders.save_image(canvas, tmp_path / 'one.webp', 'WEBP') == [tmp_path / 'one.webp']
@@ -0,0 +1,54 @@
+import os
+
+from werkzeug.http import http_date
+
+from conftest import write_tile
+
+
+def test_etag_and_not_modified(srv):
+    write_tile(srv.TILES_DIR, 6, 10, 20, 'png')
+    plan = srv.plan_tile(6, 10, 20, 'png', True, {}, {})
+    etag = plan.headers['ETag']
+    assert plan.status == 200 and 'Last-Modified' in plan.headers
+    again = srv.plan_tile(6, 10, 20, 'png', True, {'If-None-Match': etag}, {})
+    assert again.status == 304 and again.headers['ETag'] == etag
+    other = srv.plan_tile(6, 10, 20, 'webp', False, {'If-None-Match': etag}, {})
+    assert other.status == 200 and other.headers['ETag'] != etag
+
+
+def test_if_none_match_lists_and_weak(srv):
+    etag = '"abc-png"'
+    assert srv.not_modified(etag, None, {'If-None-Match': '"x", "abc-png"'})
+    assert srv.not_modified(etag, None, {'If-None-Match': 'W/"abc-png"'})
+    assert srv.not_modified(etag, None, {'If-None-Match': '*'})
+    assert not srv.not_modified(etag, None, {'If-None-Match': '"abc-webp"'})
+
+
+def test_if_none_match_wins_over_if_modified_since(srv):
+    headers = {'If-None-Match': '"old"', 'If-Modified-Since': http_date(2_000_000_000)}
+    assert not srv.not_modified('"new"', 1_000_000_000, headers)
+
+
+def test_if_modified_since(srv):
+    assert srv.not_modified('"e"', 1_000_000_000.7, {'If-Modified-Since': http_date(1_000_000_000)})
+    assert not srv.not_modified('"e"', 1_000_000_001, {'If-Modified-Since': http_date(1_000_000_000)})
+    assert not srv.not_modified('"e"', 1_000_000_000, {'If-Modified-Since': 'garbage'})
+
+
+def test_redownloaded_tile_changes_etag(srv):
+    path = write_tile(srv.TILES_DIR, 6, 10, 20, 'png')
+    first = srv.plan_tile(6, 10, 20, 'png', True, {}, {}).headers['ETag']
+    write_tile(srv.TILES_DIR, 6, 10, 20, 'png', color=(255, 0, 0, 255))
+    os.utime(path, (1_000_000_000, 1_000_000_000))
+    plan = srv.plan_tile(6, 10, 20, 'png', True, {'If-None-Match': first}, {})
+    assert plan.status == 200 and plan.headers['ETag'] != first
+
+
+def test_immutable_only_for_current_version(srv, monkeypatch):
+    write_tile(srv.TILES_DIR, 6, 10, 20, 'png')
+    monkeypatch.setattr(srv, 'IMMUTABLE_TILES', True)
+    version = srv.tile_set_version()
+    current = srv.plan_tile(6, 10, 20, 'png', True, {}, {'v': version})
+    assert current.headers['Cache-Control'].endswith('immutable')
+    stale = srv.plan_tile(6, 10, 20, 'png', True, {}, {'v': 'stale'})
+    assert stale.headers['Cache-Control'] == f'public, max-age={srv.TILE_MAX_AGE}'
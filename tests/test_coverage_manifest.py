@@ -0,0 +1,92 @@
+import json
+import multiprocessing
+import os
+
+import pytest
+
+import coverage_manifest
+from conftest import write_tile
+
+
+@pytest.fixture
+def scans(monkeypatch):
+    """记录被重扫的列目录"""
+    seen = []
+    real = coverage_manifest.scan_column
+
+    def counted(path):
+        seen.append(os.path.basename(path))
+        return real(path)
+
+    monkeypatch.setattr(coverage_manifest, 'scan_column', counted)
+    return seen
+
+
+def test_update_columns_rescans_only_given_columns(tmp_path, scans):
+    for x, y in ((3, 4), (3, 5), (4, 4)):
+        write_tile(tmp_path, 5, x, y)
+    write_tile(tmp_path, 5, 3, 5, 'webp')
+    coverage_manifest.update_columns(tmp_path, 5, [3, 4])
+    write_tile(tmp_path, 5, 9, 1)
+    data = coverage_manifest.update_columns(tmp_path, 5, [9])
+    assert scans == ['3', '4', '9']
+    zoom = coverage_manifest.summary(data)['5']
+    assert zoom['count'] == 4 and zoom['tile_range'] == [3, 9, 1, 5]
+    assert zoom['formats'] == {'png': 4, 'webp': 1}
+    assert coverage_manifest.summary(coverage_manifest.load(tmp_path)) == coverage_manifest.summary(data)
+
+
+def test_refresh_reuses_unchanged_columns(tmp_path, scans):
+    write_tile(tmp_path, 5, 3, 4)
+    write_tile(tmp_path, 5, 4, 4)
+    coverage_manifest.refresh(tmp_path)
+    assert sorted(scans) == ['3', '4']
+    scans.clear()
+    write_tile(tmp_path, 5, 4, 6)
+    col = tmp_path / '5' / '4'
+    os.utime(col, ns=(col.stat().st_mtime_ns + 10 ** 9,) * 2)  # 保证列目录 mtime 变化
+    data = coverage_manifest.refresh(tmp_path)
+    assert scans == ['4']
+    assert coverage_manifest.summary(data)['5']['count'] == 3
+
+
+def test_refresh_starts_from_disk_not_stale_copy(tmp_path, scans):
+    """服务端持有的旧清单不能覆盖爬虫刚写入的新列"""
+    write_tile(tmp_path, 5, 3, 4)
+    stale = coverage_manifest.refresh(tmp_path)
+    write_tile(tmp_path, 6, 1, 1)
+    coverage_manifest.update_columns(tmp_path, 6, [1])
+    scans.clear()
+    data = coverage_manifest.refresh(tmp_path, stale)
+    assert scans == []  # 新列已在磁盘清单中，无需重扫
+    assert set(coverage_manifest.summary(data)) == {'5', '6'}
+
+
+def test_server_generates_missing_manifest(srv):
+    write_tile(srv.TILES_DIR, 7, 10, 11)
+    assert not coverage_manifest.manifest_path(srv.TILES_DIR).exists()
+    data = srv.coverage.get()
+    assert coverage_manifest.summary(data)['7']['count'] == 1
+    assert coverage_manifest.manifest_path(srv.TILES_DIR).exists()
+
+
+def _update_many(outdir, x, rounds):
+    for _ in range(rounds):
+        coverage_manifest.update_columns(outdir, 5, [x])
+        coverage_manifest.refresh(outdir)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='需要 fork')
+def test_concurrent_writers_lose_no_updates(tmp_path):
+    for x in range(6):
+        write_tile(tmp_path, 5, x, x)
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=_update_many, args=(tmp_path, x, 15)) for x in range(6)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    assert all(p.exitcode == 0 for p in procs)
+    data = json.loads(coverage_manifest.manifest_path(tmp_path).read_text())
+    assert sorted(data['zooms']['5']['columns'], key=int) == [str(x) for x in range(6)]
+    assert not list(tmp_path.glob('*.part'))
@@ -0,0 +1,85 @@
+import io
+import tracemalloc
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from encoders import PNG_FILTER_PEAK, adler32_combine, filter_rows, iter_png, png_band_rows, save_sheets, write_png
+
+
+def noisy_image(w, h, seed=0):
+    """带渐变与噪声的 RGBA 图，让各种 PNG 滤波器都可能被选中"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:h, 0:w]
+    arr = np.stack([xx % 256, yy % 256, (xx + yy) % 256, np.full_like(xx, 255)], axis=-1)
+    arr[::7, :, :3] = rng.integers(0, 256, size=arr[::7, :, :3].shape)
+    arr[::11, :, 3] = rng.integers(1, 256, size=arr[::11, :, 3].shape)
+    return Image.fromarray(arr.astype(np.uint8), 'RGBA')
+
+
+def test_adler32_combine_matches_zlib():
+    a, b = b'first part of the stream' * 50, b'second' * 333
+    combined = adler32_combine(zlib.adler32(a), zlib.adler32(b), len(b))
+    assert combined == zlib.adler32(a + b)
+    assert adler32_combine(1, zlib.adler32(b), len(b)) == zlib.adler32(b)
+
+
+@pytest.mark.parametrize('workers,band', [(1, 256), (1, 7), (4, 16)])
+def test_streamed_png_decodes_to_source(workers, band):
+    src = noisy_image(97, 130)
+    data = b''.join(iter_png(src, band=band, workers=workers))
+    with Image.open(io.BytesIO(data)) as out:
+        out.load()  # Pillow 会校验 CRC 与 zlib 流
+        assert out.mode == 'RGBA' and out.size == src.size
+        assert np.array_equal(np.asarray(out), np.asarray(src))
+
+
+def test_parallel_png_identical_to_serial(tmp_path):
+    src = noisy_image(64, 200, seed=3)
+    serial = write_png(src, tmp_path / 'a.png', band=32, workers=1)
+    parallel = write_png(src, tmp_path / 'b.png', band=32, workers=4)
+    assert serial.read_bytes() == parallel.read_bytes()
+
+
+def test_band_height_shrinks_with_width():
+    assert png_band_rows(1000, 4 << 20) == 1048
+    assert png_band_rows(80000, 4 << 20) == 13
+    assert png_band_rows(2_000_000, 4 << 20) == 1
+    assert png_band_rows(1000, 4 << 20) > png_band_rows(8000, 4 << 20) > png_band_rows(80000, 4 << 20)
+
+
+def test_filter_peak_memory_bounded():
+    band = np.random.default_rng(1).integers(0, 256, size=(64, 8000 * 4), dtype=np.uint8)
+    tracemalloc.start()
+    try:
+        filter_rows(band, np.zeros(band.shape[1], dtype=np.uint8))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 14 * band.nbytes  # 五种候选逐个比较，约 13 倍
+
+
+def test_wide_png_peak_follows_band_budget():
+    src = noisy_image(20000, 40)
+    budget = 256 * 1024
+    tracemalloc.start()
+    try:
+        for _ in iter_png(src, band_bytes=budget, workers=2):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # 两个线程各处理一个行带；整图原始数据为 3.2MB，远大于该上限
+    assert peak < 2 * PNG_FILTER_PEAK * budget
+
+
+def test_save_sheets_split_and_cover(tmp_path):
+    src = noisy_image(50, 30)
+    sheets = save_sheets(src, tmp_path / 'map.webp', 'WEBP', 20, workers=3, lossless=True)
+    names = sorted(p.name for p, _ in sheets)
+    assert names == [f'map_r{r}_c{c}.webp' for r in range(2) for c in range(3)]
+    for path, box in sheets:
+        with Image.open(path) as im:
+            assert np.array_equal(np.asarray(im.convert('RGBA')), np.asarray(src.crop(box)))
@@ -0,0 +1,81 @@
+import io
+
+from PIL import Image
+
+from conftest import write_tile
+from stitch_tiles import tile_to_lonlat
+
+COLORS = {(40, 20): (255, 0, 0, 255), (41, 20): (0, 255, 0, 255), (40, 21): (0, 0, 255, 255)}
+
+
+def export_url(z=6, x_min=40, x_max=41, y_min=20, y_max=21, fmt='png'):
+    # bbox 取瓦片范围内缩一点，换算回同一瓦片范围
+    west, north = tile_to_lonlat(x_min + 0.01, y_min + 0.01, z)
+    east, south = tile_to_lonlat(x_max + 0.99, y_max + 0.99, z)
+    return f'/api/export?bbox={west},{south},{east},{north}&z={z}&format={fmt}'
+
+
+def make_tiles(srv):
+    for (x, y), color in COLORS.items():
+        write_tile(srv.TILES_DIR, 6, x, y, 'png', color)
+
+
+def test_export_png_matches_tiles(srv):
+    make_tiles(srv)
+    resp = srv.app.test_client().get(export_url())
+    assert resp.status_code == 200
+    assert resp.headers['X-Tile-Range'] == '6/40-41/20-21'
+    with Image.open(io.BytesIO(resp.data)) as im:
+        assert im.size == (512, 512)
+        im = im.convert('RGBA')
+        for (x, y), color in COLORS.items():
+            assert im.getpixel(((x - 40) * 256 + 100, (y - 20) * 256 + 100)) == color
+        assert im.getpixel((300, 300))[3] == 0  # 缺失瓦片留空
+    # 第二次由缓存文件返回，内容相同
+    again = srv.app.test_client().get(export_url())
+    assert again.status_code == 200 and again.data == resp.data
+
+
+def test_export_rejects_bad_params(srv):
+    client = srv.app.test_client()
+    assert client.get('/api/export?bbox=1,2,3&z=6').status_code == 400
+    assert client.get(export_url(fmt='gif')).status_code == 400
+
+
+def test_export_without_numpy_fails_before_streaming(srv, monkeypatch):
+    """缺少 numpy 时在发出 200 之前返回 501，而不是发出截断的图片"""
+    make_tiles(srv)
+    monkeypatch.setattr(srv, 'HAVE_NUMPY', False)
+    resp = srv.app.test_client().get(export_url())
+    assert resp.status_code == 501
+    assert 'numpy' in resp.get_json()['error']
+
+
+def test_export_width_capped_by_memory_budget(srv):
+    params = lambda cols: {'bbox': export_url(10, 100, 100 + cols - 1, 300, 303).split('bbox=')[1].split('&')[0],
+                           'z': '10'}
+    budget = srv.EXPORT_MEMORY_MB * 1024 * 1024
+    widest = max(c for c in range(1, 1024) if srv.export_peak_bytes(c, 4, 'png') <= budget)
+    assert srv.export_params(params(widest))[:5] == (10, 100, 100 + widest - 1, 300, 303)
+    try:
+        srv.export_params(params(widest + 1))
+    except ValueError as e:
+        assert '内存' in str(e)
+    else:
+        raise AssertionError('超出内存预算的导出应被拒绝')
+    # 旧的 256 列上限对应数百 MB，不再允许
+    assert widest < 256
+
+
+def test_export_peak_within_estimate(srv):
+    import tracemalloc
+    for x in range(40, 52):
+        write_tile(srv.TILES_DIR, 6, x, 20, 'png', (x, 0, 0, 255))
+    tracemalloc.start()
+    try:
+        for _ in srv.iter_export(6, 40, 51, 20, 20, 'png'):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < srv.export_peak_bytes(12, 1, 'png')
@@ -0,0 +1,217 @@
+import os
+import random
+import struct
+
+import pytest
+from PIL import Image
+
+from geotiff import TiledTiff, WEB_MERCATOR_HALF, compact_tiff, downsample, tile_range_geotransform, write_cog
+
+
+def noise_image(size, seed=0):
+    rng = random.Random(seed)
+    return Image.frombytes('RGBA', size, bytes(rng.randrange(256) for _ in range(size[0] * size[1] * 4)))
+
+
+def test_tile_range_geotransform():
+    assert tile_range_geotransform(0, 0, 0) == (-WEB_MERCATOR_HALF, WEB_MERCATOR_HALF, 2 * WEB_MERCATOR_HALF / 256)
+    ulx, uly, res = tile_range_geotransform(2, 1, 3)
+    assert ulx == pytest.approx(-WEB_MERCATOR_HALF / 2)
+    assert uly == pytest.approx(-WEB_MERCATOR_HALF / 2)
+    assert res == pytest.approx(2 * WEB_MERCATOR_HALF / 4 / 256)
+
+
+@pytest.mark.parametrize('compression', ['deflate', 'none'])
+def test_write_cog_round_trip(tmp_path, compression):
+    src = noise_image((300, 200))
+    out = tmp_path / 'out.tif'
+    info = write_cog(src, out, 5, 3, 7, block_size=128, compression=compression)
+    # 300×200 → 150×100 → 75×50，最小层可放进单个 128 块
+    assert info['levels'] == [(300, 200), (150, 100), (75, 50)]
+    assert not info['bigtiff']
+
+    with TiledTiff(out) as tif:
+        assert [lvl.size for lvl in tif.levels] == info['levels']
+        base = tif.levels[0]
+        assert (base.block_w, base.across, base.down) == (128, 3, 2)
+        full = Image.new('RGBA', (base.across * 128, base.down * 128))
+        for by in range(base.down):
+            for bx in range(base.across):
+                full.paste(tif.read_block(0, bx, by), (bx * 128, by * 128))
+        assert full.crop((0, 0, 300, 200)).tobytes() == src.tobytes()
+        overview = tif.read_block(1, 1, 0).crop((0, 0, 150 - 128, 100))
+        assert overview.tobytes() == downsample(src).crop((128, 0, 150, 100)).tobytes()
+
+        ulx, uly, res = tile_range_geotransform(5, 3, 7)
+        assert tif.geo[33550][:2] == [res, res]
+        assert tif.geo[33922][3:5] == [ulx, uly]
+
+
+def test_cog_layout_ifds_before_data(tmp_path):
+    out = tmp_path / 'out.tif'
+    write_cog(noise_image((600, 600), seed=1), out, 3, 0, 0, block_size=256)
+    with TiledTiff(out) as tif:
+        first_block = min(off for lvl in tif.levels for off in lvl.offsets)
+        # 最小概览的块在最前，全分辨率在最后
+        assert max(tif.levels[-1].offsets) < min(tif.levels[0].offsets)
+    with open(out, 'rb') as fh:
+        head = fh.read(8)
+    assert head[:4] == b'II*\0'
+    assert struct.unpack('<I', head[4:])[0] < first_block
+
+
+def test_write_block_in_place(tmp_path):
+    out = tmp_path / 'out.tif'
+    write_cog(noise_image((256, 256), seed=2), out, 4, 0, 0, block_size=128)
+    patch = Image.new('RGBA', (128, 128), (10, 20, 30, 255))
+    with TiledTiff(out, writable=True) as tif:
+        tif.write_block(0, 1, 1, patch)
+    with TiledTiff(out) as tif:
+        assert tif.read_block(0, 1, 1).tobytes() == patch.tobytes()
+        assert tif.read_block(0, 0, 1).tobytes() != patch.tobytes()
+
+
+def test_rejects_non_tiff(tmp_path):
+    path = tmp_path / 'x.tif'
+    path.write_bytes(b'not a tiff at all')
+    with pytest.raises(ValueError):
+        TiledTiff(path)
+
+
+@pytest.mark.parametrize('pread', [True, False])
+def test_read_with_and_without_pread(tmp_path, monkeypatch, pread):
+    """Windows 没有 os.pread，读取退回加锁的 seek + read"""
+    import geotiff
+    monkeypatch.setattr(geotiff, 'HAVE_PREAD', pread)
+    src = noise_image((256, 256), seed=3)
+    out = tmp_path / 'out.tif'
+    write_cog(src, out, 4, 0, 0, block_size=128)
+    patch = Image.new('RGBA', (128, 128), (200, 0, 0, 255))
+    with TiledTiff(out, writable=True) as tif:
+        tif.write_block(0, 0, 0, patch)
+        # 写入后同一句柄立即读回
+        assert tif.read_block(0, 0, 0).tobytes() == patch.tobytes()
+        assert tif.read_block(0, 1, 0).tobytes() == src.crop((128, 0, 256, 128)).tobytes()
+
+
+def test_incremental_restitch_patches_changed_tile(tmp_path):
+    from stitch_tiles import stitch
+    tiles = tmp_path / 'tiles'
+    colors = {(x, y): (40 * x, 40 * y, 90, 255) for x in range(4, 7) for y in range(2, 4)}
+    for (x, y), color in colors.items():
+        (tiles / '3' / str(x)).mkdir(parents=True, exist_ok=True)
+        Image.new('RGBA', (256, 256), color).save(tiles / '3' / str(x) / f'{y}.png')
+    out = tmp_path / 'map.tif'
+    stitch(3, 4, 6, 2, 3, tiles, out, output_format='COG', block_size=256, incremental=True)
+
+    again = stitch(3, 4, 6, 2, 3, tiles, out, output_format='COG', block_size=256, incremental=True)
+    assert again['changed'] == 0
+
+    Image.new('RGBA', (256, 256), (1, 2, 3, 255)).save(tiles / '3' / '5' / '3.png')
+    patched = stitch(3, 4, 6, 2, 3, tiles, out, output_format='COG', block_size=256, incremental=True)
+    assert patched['changed'] == 1
+    with TiledTiff(out) as tif:
+        assert tif.read_block(0, 1, 1).getpixel((10, 10)) == (1, 2, 3, 255)
+        assert tif.read_block(0, 0, 0).getpixel((10, 10)) == colors[(4, 2)]
+    full = Image.new('RGBA', (768, 512))
+    for (x, y), color in colors.items():
+        full.paste(color if (x, y) != (5, 3) else (1, 2, 3, 255), ((x - 4) * 256, (y - 2) * 256, (x - 3) * 256, (y - 1) * 256))
+    overview = Image.new('RGBA', (512, 256))
+    with TiledTiff(out) as tif:
+        overview.paste(tif.read_block(1, 0, 0), (0, 0))
+        overview.paste(tif.read_block(1, 1, 0), (256, 0))
+    assert overview.crop((0, 0, 384, 256)).tobytes() == downsample(full).tobytes()
+
+
+def read_all_blocks(path):
+    with TiledTiff(path) as tif:
+        return [[tif.read_block(i, bx, by).tobytes() for by in range(lvl.down) for bx in range(lvl.across)]
+                for i, lvl in enumerate(tif.levels)]
+
+
+def test_write_block_fits_in_place(tmp_path):
+    out = tmp_path / 'out.tif'
+    write_cog(noise_image((256, 256), seed=4), out, 4, 0, 0, block_size=128)
+    size = out.stat().st_size
+    with TiledTiff(out, writable=True) as tif:
+        offset = tif.levels[0].offsets[3]
+        tif.write_block(0, 1, 1, Image.new('RGBA', (128, 128), (1, 2, 3, 255)))  # 纯色压缩后远小于噪声块
+        assert tif.levels[0].offsets[3] == offset
+        assert tif.wasted_bytes() > 0
+    assert out.stat().st_size == size
+
+
+@pytest.mark.parametrize('bigtiff', [None, True])
+def test_compact_restores_cog_layout(tmp_path, bigtiff):
+    out = tmp_path / 'out.tif'
+    write_cog(Image.new('RGBA', (256, 256), (9, 9, 9, 255)), out, 4, 0, 0, block_size=128)
+    with TiledTiff(out, writable=True) as tif:
+        for bx in range(2):
+            tif.write_block(0, bx, 0, noise_image((128, 128), seed=bx))  # 放不下，追加到末尾
+        assert tif.wasted_bytes() > 0
+    before = read_all_blocks(out)
+    compact_tiff(out, bigtiff=bigtiff)
+    assert read_all_blocks(out) == before
+    with TiledTiff(out) as tif:
+        assert tif.bigtiff is bool(bigtiff)
+        assert tif.wasted_bytes() == 0
+        assert tif.geo[33922][3:5] == list(tile_range_geotransform(4, 0, 0)[:2])
+        # 最小概览在前，全分辨率在后，每层内按行优先
+        offsets = [o for lvl in reversed(tif.levels) for o in lvl.offsets]
+        assert offsets == sorted(offsets)
+
+
+def opaque_noise(size, seed):
+    im = noise_image(size, seed)
+    im.putalpha(255)
+    return im
+
+
+def write_color_tile(tiles, x, y, im, stamp):
+    path = tiles / '3' / str(x) / f'{y}.png'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    im.save(path)
+    os.utime(path, ns=(stamp, stamp))
+
+
+def test_repeated_patches_keep_file_bounded(tmp_path):
+    from stitch_tiles import COMPACT_WASTE_RATIO, stitch
+    tiles = tmp_path / 'tiles'
+    for x in range(4):
+        for y in range(2):
+            write_color_tile(tiles, x, y, opaque_noise((256, 256), seed=10 * x + y), 1)
+    out = tmp_path / 'map.tif'
+    stitch(3, 0, 3, 0, 1, tiles, out, output_format='COG', block_size=256, incremental=True)
+    fresh = out.stat().st_size
+
+    for i in range(12):
+        # 噪声块每次略有不同，压缩后常常比原块大，只能追加
+        write_color_tile(tiles, 1 + i % 2, 1, opaque_noise((256, 256), seed=100 + i), 2 + i)
+        result = stitch(3, 0, 3, 0, 1, tiles, out, output_format='COG', block_size=256, incremental=True)
+        assert result['changed'] == 1
+        with TiledTiff(out) as tif:
+            assert tif.wasted_bytes() <= COMPACT_WASTE_RATIO * tif.data_bytes()
+        assert out.stat().st_size < (1 + COMPACT_WASTE_RATIO) * fresh * 1.1
+
+    # 与整图重拼的结果逐块一致
+    full = tmp_path / 'full.tif'
+    stitch(3, 0, 3, 0, 1, tiles, full, output_format='COG', block_size=256)
+    assert read_all_blocks(out) == read_all_blocks(full)
+
+
+def test_patch_promotes_to_bigtiff_before_offset_overflow(tmp_path, monkeypatch):
+    import geotiff
+    from stitch_tiles import stitch
+    tiles = tmp_path / 'tiles'
+    for x in range(2):
+        write_color_tile(tiles, x, 0, Image.new('RGBA', (256, 256), (x, 0, 0, 255)), 1)
+    out = tmp_path / 'map.tif'
+    stitch(3, 0, 1, 0, 0, tiles, out, output_format='COG', block_size=256, incremental=True)
+    # 把经典 TIFF 的偏移上限压到当前文件末尾，下一次追加即会溢出
+    monkeypatch.setattr(geotiff, 'CLASSIC_MAX_OFFSET', out.stat().st_size + 16)
+    write_color_tile(tiles, 1, 0, opaque_noise((256, 256), seed=7), 2)
+    stitch(3, 0, 1, 0, 0, tiles, out, output_format='COG', block_size=256, incremental=True)
+    with TiledTiff(out) as tif:
+        assert tif.bigtiff
+        assert tif.read_block(0, 1, 0).tobytes() == opaque_noise((256, 256), seed=7).tobytes()
+        assert tif.read_block(0, 0, 0).getpixel((5, 5)) == (0, 0, 0, 255)
@@ -0,0 +1,87 @@
+import re
+
+import pytest
+
+from conftest import write_tile
+
+SAMPLE = re.compile(r'^([a-z_]+)(\{.*\})? (\S+)$')
+PNG = '/tiles/{z}/{x}/{y}.png'
+WEBP = '/tiles/{z}/{x}/{y}.webp'
+
+
+def scrape(client):
+    """抓取 /api/metrics → {(指标名, 标签串): 数值}"""
+    resp = client.get('/api/metrics')
+    assert resp.status_code == 200 and resp.mimetype == 'text/plain'
+    samples = {}
+    for line in resp.get_data(as_text=True).splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, labels, value = SAMPLE.match(line).groups()
+        samples[(name, labels or '')] = float(value.replace('+Inf', 'inf'))
+    return samples
+
+
+@pytest.fixture
+def client(srv):
+    return srv.app.test_client()
+
+
+def delta(before, after, name, labels=''):
+    key = (name, labels)
+    return after.get(key, 0) - before.get(key, 0)
+
+
+def test_counters_and_histograms_after_requests(srv, client):
+    path = write_tile(srv.TILES_DIR, 4, 3, 5)
+    before = scrape(client)
+    sizes = [len(client.get(p).data) for p in ('/tiles/4/3/5.png', '/tiles/4/3/5.png', '/tiles/4/3/6.png')]
+    webp = [len(client.get('/tiles/4/3/5.webp').data) for _ in range(2)]
+    after = scrape(client)
+
+    assert sizes[0] == path.stat().st_size
+    assert delta(before, after, 'tile_server_requests_total', f'{{route="{PNG}",status="200"}}') == 3
+    assert delta(before, after, 'tile_server_requests_total', f'{{route="{WEBP}",status="200"}}') == 2
+    assert delta(before, after, 'tile_server_response_bytes_total', f'{{route="{PNG}"}}') == sum(sizes)
+    assert delta(before, after, 'tile_server_response_bytes_total', f'{{route="{WEBP}"}}') == sum(webp)
+    assert delta(before, after, 'tile_server_tile_misses_total', '{fallback="blank"}') == 1
+    # 第二个 webp 请求命中响应缓存，只转码一次
+    assert delta(before, after, 'tile_server_conversions_total', '{kind="convert"}') == 1
+    assert after[('tile_server_cache_hits_total', '')] == 1
+    assert after[('tile_server_cache_misses_total', '')] == 1
+    assert after[('tile_server_cache_hit_ratio', '')] == 0.5
+
+    # 直方图：计数与请求数一致，桶单调不减，+Inf 桶等于计数，耗时之和为正
+    count = delta(before, after, 'tile_server_request_duration_seconds_count', f'{{route="{PNG}"}}')
+    assert count == 3
+    assert delta(before, after, 'tile_server_request_duration_seconds_sum', f'{{route="{PNG}"}}') > 0
+    buckets = sorted((float(le.replace('+Inf', 'inf')), value) for (name, labels), value in after.items()
+                     for le in re.findall(rf'route="{re.escape(PNG)}",le="([^"]+)"', labels)
+                     if name == 'tile_server_request_duration_seconds_bucket')
+    assert buckets[-1][0] == float('inf')
+    assert [v for _, v in buckets] == sorted(v for _, v in buckets)
+    assert buckets[-1][1] == after[('tile_server_request_duration_seconds_count', f'{{route="{PNG}"}}')]
+
+    # 阶段直方图：两个 webp 请求都有 lookup，只有第一个有 convert/encode 耗时
+    assert delta(before, after, 'tile_server_request_phase_seconds_count', f'{{route="{WEBP}",phase="lookup"}}') == 2
+    assert delta(before, after, 'tile_server_request_phase_seconds_count', f'{{route="{WEBP}",phase="encode"}}') == 1
+
+
+def test_scrape_counts_itself(client):
+    before = scrape(client)
+    after = scrape(client)
+    assert delta(before, after, 'tile_server_requests_total', '{route="/api/metrics",status="200"}') == 1
+
+
+def test_slow_and_sampled_logs(srv, client, monkeypatch, caplog):
+    import metrics
+    write_tile(srv.TILES_DIR, 4, 3, 5)
+    monkeypatch.setattr(metrics, 'ACCESS_LOG_SAMPLE', 0)
+    monkeypatch.setattr(metrics, 'SLOW_REQUEST_SECONDS', 60)
+    with caplog.at_level('INFO', logger='server.access'):
+        client.get('/tiles/4/3/5.png')
+        assert not caplog.records
+        monkeypatch.setattr(metrics, 'SLOW_REQUEST_SECONDS', 0)
+        client.get('/tiles/4/3/5.png')
+    record, = caplog.records
+    assert record.levelname == 'WARNING' and '/tiles/4/3/5.png 200' in record.getMessage()
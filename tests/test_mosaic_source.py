@@ -0,0 +1,154 @@
+import shutil
+import time
+
+import pytest
+from PIL import Image
+
+from conftest import write_tile
+from mosaic_source import MosaicSource, name_tile_range, open_mosaic
+from stitch_tiles import bbox_to_tile_range, stitch, world_file_path
+
+BBOX = (116.2, 39.8, 116.6, 40.1)
+Z = 10
+
+
+@pytest.fixture
+def tiles(tmp_path):
+    """BBOX 在 Z 级覆盖的每个瓦片一种颜色"""
+    x_min, x_max, y_min, y_max = bbox_to_tile_range(*BBOX, Z)
+    colors = {}
+    for x in range(x_min, x_max + 1):
+        for y in range(y_min, y_max + 1):
+            colors[(x, y)] = (x * 37 % 256, y * 53 % 256, (x + y) % 256, 255)
+            write_tile(tmp_path / 'out', Z, x, y, 'png', colors[(x, y)])
+    return tmp_path / 'out', (x_min, x_max, y_min, y_max), colors
+
+
+def bbox_name(ext='png'):
+    return '_'.join(str(v) for v in BBOX) + f'_z{Z}.{ext}'
+
+
+def test_name_tile_range():
+    assert name_tile_range('116.2_39.8_116.6_40.1_z10') == (10,) + bbox_to_tile_range(*BBOX, 10)
+    assert name_tile_range('beijing_-73.5_40.5_-73.2_40.9_z12') == (12,) + bbox_to_tile_range(-73.5, 40.5, -73.2, 40.9, 12)
+    assert name_tile_range('export_z9_400-410_200-205') == (9, 400, 410, 200, 205)
+    assert name_tile_range('beijing_z8') is None
+    assert name_tile_range('1_2_3_z8') is None
+
+
+def check_render(mosaic, colors, cache=None):
+    from stitch_tiles import DecodedTileCache
+    cache = cache or DecodedTileCache(1 << 24)
+    for (x, y), color in colors.items():
+        tile = mosaic.render(Z, x, y, cache)
+        assert tile.getpixel((128, 128)) == color, (x, y)
+
+
+def test_documented_name_without_world_file(tmp_path, tiles):
+    """README 约定的 {minLon}_{minLat}_{maxLon}_{maxLat}_z{z}.png，没有 world file 也能定位"""
+    root, (x_min, x_max, y_min, y_max), colors = tiles
+    maps = tmp_path / 'map'
+    out = maps / bbox_name()
+    stitch(Z, x_min, x_max, y_min, y_max, root, out)
+    world_file_path(out).unlink()
+    mosaic = open_mosaic(out)
+    assert mosaic is not None and mosaic.native_zoom == Z
+    check_render(mosaic, colors)
+
+
+def test_stitch_png_writes_world_file(tmp_path, tiles):
+    root, (x_min, x_max, y_min, y_max), colors = tiles
+    out = tmp_path / 'map' / 'anything.png'
+    stitch(Z, x_min, x_max, y_min, y_max, root, out)
+    assert world_file_path(out).exists()
+    check_render(open_mosaic(out), colors)
+
+
+def test_cog_mosaic(tmp_path, tiles):
+    root, (x_min, x_max, y_min, y_max), colors = tiles
+    out = tmp_path / 'map' / 'area.tif'
+    stitch(Z, x_min, x_max, y_min, y_max, root, out, output_format='COG', block_size=256)
+    mosaic = open_mosaic(out)
+    assert mosaic.tiff is not None
+    check_render(mosaic, colors)
+    mosaic.close()
+
+
+def test_mismatched_name_is_skipped(tmp_path):
+    maps = tmp_path / 'map'
+    maps.mkdir()
+    Image.new('RGBA', (300, 77)).save(maps / bbox_name())
+    assert open_mosaic(maps / bbox_name()) is None
+
+
+def test_rescan_closes_replaced_tiffs(tmp_path, tiles):
+    root, (x_min, x_max, y_min, y_max), colors = tiles
+    maps = tmp_path / 'map'
+    stitch(Z, x_min, x_max, y_min, y_max, root, maps / 'a.tif', output_format='COG', block_size=256)
+    stitch(Z, x_min, x_max, y_min, y_max, root, maps / 'b.tif', output_format='COG', block_size=256)
+    source = MosaicSource(maps)
+    assert source.rescan()
+    first = {m.path.name: m for m in source.mosaics}
+    assert set(first) == {'a.tif', 'b.tif'}
+
+    # a 被替换、b 被删除、新增 c
+    shutil.copy(maps / 'b.tif', maps / 'c.tif')
+    (maps / 'b.tif').unlink()
+    (maps / 'a.tif').unlink()
+    stitch(Z, x_min, x_max, y_min, y_max, root, maps / 'a.tif', output_format='COG', block_size=512)
+    assert source.rescan()
+    second = {m.path.name: m for m in source.mosaics}
+    assert set(second) == {'a.tif', 'c.tif'}
+    assert first['a.tif'].tiff._fh.closed
+    assert first['b.tif'].tiff._fh.closed
+    assert second['a.tif'] is not first['a.tif'] and not second['a.tif'].tiff._fh.closed
+
+    # 没有变化时沿用已打开的对象
+    assert not source.rescan()
+    assert {m.path.name: m for m in source.mosaics} == second
+    for m in source.mosaics:
+        m.close()
+
+
+def test_plain_images_share_bounded_cache(tmp_path, tiles):
+    """非分块图片的整图放在按字节限额的 LRU 中，超出时淘汰，重新扫描时丢弃被替换的图"""
+    root, (x_min, x_max, y_min, y_max), colors = tiles
+    maps = tmp_path / 'map'
+    stitch(Z, x_min, x_max, y_min, y_max, root, maps / 'a.png')
+    stitch(Z, x_min, x_max, y_min, y_max, root, maps / 'b.png')
+    with Image.open(maps / 'a.png') as im:
+        one = im.size[0] * im.size[1] * 4
+    source = MosaicSource(maps, image_cache_mb=1)
+    source.images.max_bytes = one + one // 2
+    source.rescan()
+    a, b = sorted(source.mosaics, key=lambda m: m.path.name)
+    for mosaic in (a, b):
+        source.render(mosaic, Z, x_min, y_min)
+        assert source.images.bytes <= source.images.max_bytes
+    assert list(source.images._items) == [b.image_key]
+
+    (maps / 'b.png').unlink()
+    source.rescan()
+    assert source.images.bytes == 0 and not source.images._items
+
+
+def test_find_does_not_rescan(tmp_path, tiles, monkeypatch):
+    """请求路径上只在首次使用时扫描，之后的变化由后台线程发现"""
+    root, (x_min, x_max, y_min, y_max), colors = tiles
+    maps = tmp_path / 'map'
+    stitch(Z, x_min, x_max, y_min, y_max, root, maps / 'a.png')
+    source = MosaicSource(maps, poll=0.001)
+    scans = []
+    scan = source._scan_stamps
+    monkeypatch.setattr(source, '_scan_stamps', lambda: scans.append(1) or scan())
+    for _ in range(3):
+        assert source.find(Z, x_min, y_min) is not None
+    assert len(scans) == 1
+
+    (maps / 'a.png').unlink()
+    source.start_watcher()
+    for _ in range(200):
+        if not source.mosaics:
+            break
+        time.sleep(0.01)
+    assert source.find(Z, x_min, y_min) is None
@@ -0,0 +1,42 @@
+import pytest
+
+from conftest import write_tile
+
+
+@pytest.mark.parametrize('accept,expected', [
+    ('image/webp,image/*;q=0.8', True),
+    ('image/avif, image/*', True),
+    ('image/webp;q=0', False),
+    ('image/webp;q=0.5', True),
+    ('*/*', False),
+    ('', False),
+    ('image/png', False),
+])
+def test_accepts(srv, accept, expected):
+    assert srv.accepts('image/webp', {'Accept': accept}) is expected
+
+
+def test_stored_webp_sent_when_accepted(srv):
+    write_tile(srv.TILES_DIR, 5, 3, 4, 'webp')
+    plan = srv.plan_tile(5, 3, 4, 'png', True, {'Accept': 'image/webp,*/*'}, {})
+    assert plan.status == 200 and plan.mimetype == 'image/webp'
+    assert plan.build is None and plan.tile is not None
+    assert plan.headers['Vary'] == 'Accept'
+
+
+def test_stored_webp_transcoded_otherwise(srv):
+    write_tile(srv.TILES_DIR, 5, 3, 4, 'webp')
+    plan = srv.plan_tile(5, 3, 4, 'png', True, {'Accept': '*/*'}, {})
+    assert plan.mimetype == 'image/png' and plan.build is not None
+    body, mimetype = plan.build()
+    assert mimetype == 'image/png' and body.startswith(b'\x89PNG')
+    # 两种表示的 ETag 不同，避免缓存互相顶替
+    webp = srv.plan_tile(5, 3, 4, 'png', True, {'Accept': 'image/webp'}, {})
+    assert webp.headers['ETag'] != plan.headers['ETag']
+
+
+def test_explicit_extension_not_negotiated(srv):
+    write_tile(srv.TILES_DIR, 5, 3, 4, 'webp')
+    plan = srv.plan_tile(5, 3, 4, 'jpg', False, {'Accept': 'image/webp'}, {})
+    assert plan.mimetype == 'image/jpeg' and plan.build is not None
+    assert 'Vary' not in plan.headers
@@ -0,0 +1,88 @@
+import io
+import os
+
+from PIL import Image
+
+from conftest import write_tile
+
+RED, GREEN, BLUE, GREY = (255, 0, 0, 255), (0, 255, 0, 255), (0, 0, 255, 255), (90, 90, 90, 255)
+CLEAR = (0, 0, 0, 0)
+
+
+def write_quadrants(root, z, x, y, colors):
+    """四个象限（左上、右上、左下、右下）各一种颜色的瓦片"""
+    path = root / str(z) / str(x) / f'{y}.png'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    im = Image.new('RGBA', (256, 256))
+    for i, color in enumerate(colors):
+        im.paste(color, ((i % 2) * 128, (i // 2) * 128, (i % 2) * 128 + 128, (i // 2) * 128 + 128))
+    im.save(path)
+    return path
+
+
+def fetch(srv, z, x, y, headers=None):
+    """(计划, 解码后的瓦片)；304 时瓦片为 None"""
+    plan = srv.plan_tile(z, x, y, 'png', False, headers or {}, {})
+    if plan.status == 304:
+        return plan, None
+    body, _ = srv.plan_body(plan)
+    with Image.open(io.BytesIO(body)) as im:
+        return plan, im.convert('RGBA')
+
+
+def center(im):
+    return im.getpixel((128, 128))
+
+
+def test_children_crop_matching_quadrant(srv):
+    write_quadrants(srv.TILES_DIR, 3, 1, 2, [RED, GREEN, BLUE, GREY])
+    for (dx, dy), color in zip([(0, 0), (1, 0), (0, 1), (1, 1)], [RED, GREEN, BLUE, GREY]):
+        plan, im = fetch(srv, 4, 2 + dx, 4 + dy)
+        assert plan.status == 200 and plan.headers['ETag'].endswith('-o1-png"')
+        assert im.size == (256, 256)
+        # 象限内部（远离双三次插值的接缝）为纯色
+        assert im.getpixel((20, 20)) == color and im.getpixel((235, 235)) == color
+
+
+def test_two_levels_up(srv):
+    """z+2 的瓦片取祖先的 1/4 边长：(x & 3, y & 3) = (1, 2) 落在左下象限"""
+    write_quadrants(srv.TILES_DIR, 3, 1, 2, [RED, GREEN, BLUE, GREY])
+    plan, im = fetch(srv, 5, 4 * 1 + 1, 4 * 2 + 2)
+    assert plan.headers['ETag'].endswith('-o2-png"')
+    assert center(im) == BLUE
+
+
+def test_nearest_ancestor_wins(srv):
+    write_tile(srv.TILES_DIR, 2, 0, 1, 'png', RED)
+    write_tile(srv.TILES_DIR, 3, 1, 2, 'png', GREEN)
+    _, im = fetch(srv, 5, 4, 8)
+    assert center(im) == GREEN
+
+
+def test_fallback_depth(srv, monkeypatch):
+    write_tile(srv.TILES_DIR, 3, 1, 2, 'png', GREEN)
+    monkeypatch.setattr(srv, 'OVERZOOM_LEVELS', 2)
+    _, im = fetch(srv, 5, 4, 8)
+    assert center(im) == GREEN
+    plan, im = fetch(srv, 6, 8, 16)
+    assert plan.headers['ETag'] == '"blank"' and center(im) == CLEAR
+    monkeypatch.setattr(srv, 'OVERZOOM_LEVELS', 0)
+    plan, _ = fetch(srv, 4, 2, 4)
+    assert plan.headers['ETag'] == '"blank"'
+
+
+def test_result_cached_and_follows_ancestor(srv):
+    path = write_quadrants(srv.TILES_DIR, 3, 1, 2, [RED, GREEN, BLUE, GREY])
+    plan, _ = fetch(srv, 4, 2, 4)
+    fetch(srv, 4, 2, 4)
+    stats = srv.response_cache.stats()
+    assert (stats['misses'], stats['hits']) == (1, 1)
+    assert fetch(srv, 4, 2, 4, {'If-None-Match': plan.headers['ETag']})[0].status == 304
+
+    # 祖先瓦片被替换后 ETag 与缓存键随之改变
+    write_quadrants(srv.TILES_DIR, 3, 1, 2, [GREY, GREEN, BLUE, GREY])
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    again, im = fetch(srv, 4, 2, 4, {'If-None-Match': plan.headers['ETag']})
+    assert again.status == 200 and again.headers['ETag'] != plan.headers['ETag']
+    assert center(im) == GREY
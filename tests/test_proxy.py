@@ -0,0 +1,112 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import write_tile
+
+GREEN = (0, 200, 0, 255)
+
+
+@pytest.fixture
+def origin(tmp_path):
+    """本地上游：responses 为 {路径: (状态码, 响应体)}，未登记的路径返回 404；hits 记录每个路径的请求次数"""
+    responses, hits = {}, {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits[self.path] = hits.get(self.path, 0) + 1
+            status, body = responses.get(self.path, (404, b'not found'))
+            self.send_response(status)
+            self.send_header('Content-Type', 'image/png' if status == 200 else 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    # 上游的瓦片内容：写在瓦片目录之外
+    tile = write_tile(tmp_path / 'origin', 4, 3, 5, 'png', GREEN)
+    yield f'http://127.0.0.1:{server.server_address[1]}', responses, hits, tile.read_bytes()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def proxied(srv, origin, monkeypatch):
+    base, responses, hits, body = origin
+    proxy = srv.UpstreamProxy(base + '/{z}/{x}/{y}.png', {}, None, None, srv.TILES_DIR, timeout=5, retries=0)
+    monkeypatch.setattr(srv, 'upstream', proxy)
+    return srv.app.test_client(), proxy, responses, hits, body
+
+
+def test_fetch_and_persist(srv, proxied):
+    client, proxy, responses, hits, body = proxied
+    responses['/4/3/5.png'] = (200, body)
+    resp = client.get('/tiles/4/3/5.png')
+    assert resp.status_code == 200 and resp.data == body
+    assert (srv.TILES_DIR / '4' / '3' / '5.png').read_bytes() == body
+    assert srv.tile_index.lookup(4, 3, 5) is not None
+    # 之后从磁盘返回，不再请求上游
+    resp = client.get('/tiles/4/3/5.png')
+    assert resp.status_code == 200 and resp.data == body and 'ETag' in resp.headers
+    assert hits == {'/4/3/5.png': 1}
+    assert proxy.stats()['fetched'] == 1
+
+
+def test_upstream_404_is_negatively_cached(srv, proxied):
+    client, proxy, responses, hits, body = proxied
+    for _ in range(3):
+        resp = client.get('/tiles/4/3/5.png')
+        assert resp.status_code == 404
+        assert resp.headers['Cache-Control'] == 'no-store'
+    # retry_after 内只请求一次上游，也没有写入任何文件
+    assert hits == {'/4/3/5.png': 1}
+    assert not (srv.TILES_DIR / '4').exists()
+
+    # 窗口过后重新请求，上游补齐的瓦片正常返回
+    proxy.retry_after = 0
+    responses['/4/3/5.png'] = (200, body)
+    resp = client.get('/tiles/4/3/5.png')
+    assert resp.status_code == 200 and resp.data == body
+    assert hits == {'/4/3/5.png': 2}
+
+
+def test_upstream_error_returns_502_without_poisoning(srv, proxied):
+    client, proxy, responses, hits, body = proxied
+    responses['/4/3/5.png'] = (500, b'boom')
+    resp = client.get('/tiles/4/3/5.png')
+    assert resp.status_code == 502 and resp.headers['Cache-Control'] == 'no-store'
+    assert not (srv.TILES_DIR / '4').exists()
+    assert srv.response_cache.stats()['entries'] == 0
+    assert proxy.recently_failed(4, 3, 5) == 502
+
+    proxy.retry_after = 0
+    responses['/4/3/5.png'] = (200, body)
+    resp = client.get('/tiles/4/3/5.png')
+    assert resp.status_code == 200 and resp.data == body
+
+
+def test_failed_upstream_falls_back_to_overzoom(srv, proxied):
+    """上游没有时仍先用本地能合成的瓦片"""
+    client, proxy, responses, hits, body = proxied
+    write_tile(srv.TILES_DIR, 3, 1, 2, 'png', GREEN)
+    srv.tile_index.refresh()
+    resp = client.get('/tiles/4/3/5.png')
+    assert resp.status_code == 200
+    assert hits == {'/4/3/5.png': 1}
+
+
+def test_failure_records_are_bounded(srv, origin):
+    base, responses, hits, body = origin
+    proxy = srv.UpstreamProxy(base + '/{z}/{x}/{y}.png', {}, None, None, srv.TILES_DIR, timeout=5, retries=0,
+                              max_failed=3)
+    for y in range(10):
+        assert proxy.fetch(4, 3, y) == 404
+    assert len(proxy._failed) == 3
+    # 保留的是最近的失败
+    assert [proxy.recently_failed(4, 3, y) for y in range(10)] == [None] * 7 + [404] * 3
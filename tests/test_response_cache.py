@@ -0,0 +1,98 @@
+import threading
+import time
+
+from conftest import write_tile
+from test_tile_sources import fake_png
+import pytest
+
+from tile_sources import MBTilesSource, iter_loose_tiles, open_archive, pack_mbtiles
+
+
+class LengthTaggedMBTiles(MBTilesSource):
+    """按旧方式只以归档身份与长度作 tag，验证缓存键本身不依赖 tag 唯一"""
+
+    def lookup(self, z, x, y):
+        tile = super().lookup(z, x, y)
+        return tile and tile._replace(tag=f'{self.tag}-{tile.length:x}')
+
+
+def test_lru_eviction_by_bytes(srv):
+    cache = srv.ResponseCache(10)
+    cache.put('a', (b'xxxx', 'image/png'))
+    cache.put('b', (b'yyyy', 'image/png'))
+    assert cache.get('a') is not None  # a 变为最近使用
+    cache.put('c', (b'zzzz', 'image/png'))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.bytes == 8 and cache.evictions == 1
+    cache.put('huge', (b'0' * 11, 'image/png'))
+    assert not cache.contains('huge')
+
+
+def test_single_flight(srv):
+    cache = srv.ResponseCache(1 << 20)
+    calls = []
+    gate = threading.Event()
+
+    def build():
+        calls.append(1)
+        gate.wait(5)
+        return b'body', 'image/png'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_build('k', build))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    gate.set()
+    for t in threads:
+        t.join()
+    assert calls == [1]
+    assert results == [(b'body', 'image/png')] * 4
+    stats = cache.stats()
+    assert stats['misses'] == 1 and stats['coalesced'] == 3
+
+
+def test_speculative_entries_accounted_separately(srv):
+    cache = srv.ResponseCache(1 << 20)
+    with cache.speculative():
+        cache.put('p', (b'12345', 'image/png'))
+        assert cache.get('p') is not None  # 预取自身的查找不算命中
+    assert cache.speculative_bytes == 5 and cache.hits == 0
+    assert cache.get('p') == (b'12345', 'image/png')
+    assert cache.speculative_bytes == 0 and cache.prefetch_hits == 1 and cache.hits == 1
+
+
+def test_transcode_key_includes_coordinates(srv):
+    write_tile(srv.TILES_DIR, 5, 1, 1, 'png', (255, 0, 0, 255))
+    write_tile(srv.TILES_DIR, 5, 2, 1, 'png', (0, 0, 255, 255))
+    bodies = set()
+    for x in (1, 2):
+        plan = srv.plan_tile(5, x, 1, 'webp', False, {}, {})
+        bodies.add(plan.build()[0])
+    assert len(bodies) == 2
+
+
+@pytest.mark.parametrize('source', [open_archive, LengthTaggedMBTiles])
+def test_prefetched_archive_tiles_keyed_by_coordinate(srv, tmp_path, monkeypatch, source):
+    """
+    回归：预取的原样瓦片曾以 ('stored', tag) 为键；MBTiles 中两个长度相同的瓦片 tag 相同时，
+    /tiles/3/1/1 会返回 3/2/1 的字节
+    """
+    loose = tmp_path / 'loose'
+    for x in (1, 2):
+        path = loose / '3' / str(x) / '1.png'
+        path.parent.mkdir(parents=True)
+        path.write_bytes(fake_png(3, x, 1))
+    archive = tmp_path / 'region.mbtiles'
+    pack_mbtiles(list(iter_loose_tiles(loose)), archive, 'png', 'region')
+    monkeypatch.setattr(srv, 'tile_source', source(archive))
+
+    # 先预热 3/2/1，再预热 3/1/1，最后请求两者
+    assert srv.prefetcher.warm(3, 2, 1, 'png', True, 'image/png', {})
+    assert srv.prefetcher.warm(3, 1, 1, 'png', True, 'image/png', {})
+    for x in (1, 2):
+        plan = srv.plan_tile(3, x, 1, 'png', True, {'Accept': 'image/png'}, {})
+        assert plan.body == fake_png(3, x, 1)
+    assert srv.response_cache.prefetch_hits == 2
+
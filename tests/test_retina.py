@@ -0,0 +1,87 @@
+import io
+
+from PIL import Image
+
+from conftest import write_tile
+
+RED, GREEN, BLUE, GREY = (255, 0, 0, 255), (0, 255, 0, 255), (0, 0, 255, 255), (90, 90, 90, 255)
+
+
+def render(srv, plan):
+    body, mimetype = srv.plan_body(plan)
+    assert mimetype == 'image/png'
+    with Image.open(io.BytesIO(body)) as im:
+        assert im.size == (512, 512)
+        return im.convert('RGBA')
+
+
+def quadrants(im):
+    return [im.getpixel((128 + 256 * (i % 2), 128 + 256 * (i // 2))) for i in range(4)]
+
+
+def test_composed_from_children(srv):
+    for (dx, dy), color in zip([(0, 0), (1, 0), (0, 1), (1, 1)], [RED, GREEN, BLUE, GREY]):
+        write_tile(srv.TILES_DIR, 8, 20 + dx, 30 + dy, 'webp' if dx else 'png', color)
+    plan = srv.plan_retina(7, 10, 15, 'png', {}, {})
+    assert plan.status == 200 and not plan.io
+    assert quadrants(render(srv, plan)) == [RED, GREEN, BLUE, GREY]
+    again = srv.plan_retina(7, 10, 15, 'png', {'If-None-Match': plan.headers['ETag']}, {})
+    assert again.status == 304
+
+
+def test_missing_child_uses_underzoom(srv):
+    """缺失的子瓦片走正常的补齐路径：此处由其下一级的子瓦片拼合"""
+    write_tile(srv.TILES_DIR, 8, 20, 30, 'png', RED)
+    for dx in (0, 1):
+        for dy in (0, 1):
+            write_tile(srv.TILES_DIR, 9, 40 + dx, 62 + dy, 'png', BLUE)
+    colors = quadrants(render(srv, srv.plan_retina(7, 10, 15, 'png', {}, {})))
+    assert colors[0] == RED
+    assert colors[1] == (0, 0, 0, 0)
+    assert colors[2] == BLUE  # 8/20/31 由 9/40-41/62-63 拼合
+
+
+def test_missing_children_use_overzoom(srv):
+    write_tile(srv.TILES_DIR, 6, 5, 7, 'png', GREEN)
+    colors = quadrants(render(srv, srv.plan_retina(7, 10, 15, 'png', {}, {})))
+    assert colors == [GREEN] * 4
+
+
+def test_blank_when_nothing_found(srv):
+    plan = srv.plan_retina(7, 10, 15, 'png', {}, {})
+    assert plan.headers['ETag'] == '"blank"'
+    assert plan.body == srv.blank_tile()[0]
+
+
+class FakeUpstream:
+    """读穿代理的替身：fetch 时把瓦片写进瓦片目录并登记到索引"""
+
+    def __init__(self, srv, color):
+        self.srv, self.color, self.fetched = srv, color, []
+
+    def recently_failed(self, z, x, y):
+        return None
+
+    def fetch(self, z, x, y):
+        write_tile(self.srv.TILES_DIR, z, x, y, 'png', self.color)
+        self.srv.tile_index.add(z, x, y, 'png')
+        self.fetched.append((z, x, y))
+        return 200
+
+
+def test_missing_children_fetched_through_proxy(srv, monkeypatch):
+    write_tile(srv.TILES_DIR, 8, 20, 30, 'png', RED)
+    upstream = FakeUpstream(srv, GREY)
+    monkeypatch.setattr(srv, 'upstream', upstream)
+    plan = srv.plan_retina(7, 10, 15, 'png', {}, {})
+    assert plan.io and 'ETag' not in plan.headers
+    assert quadrants(render(srv, plan)) == [RED, GREY, GREY, GREY]
+    assert sorted(upstream.fetched) == [(8, 20, 31), (8, 21, 30), (8, 21, 31)]
+    # 之后全部来自磁盘，带验证器
+    assert 'ETag' in srv.plan_retina(7, 10, 15, 'png', {}, {}).headers
+
+
+def test_index_page_does_not_use_detect_retina(srv):
+    html = srv.app.test_client().get('/').get_data(as_text=True)
+    assert 'zoomOffset: retina ? -1 : 0' in html
+    assert 'detectRetina:' not in html
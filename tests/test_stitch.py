@@ -0,0 +1,292 @@
+import pytest
+from PIL import Image
+
+import stitch_tiles
+from stitch_tiles import stitch
+
+
+def make_tiles(root, z, xs, ys, ext='png'):
+    """写出 {z}/{x}/{y}.{ext} 纯色瓦片，颜色由坐标决定；返回 {(x, y): 颜色}"""
+    colors = {}
+    for x in xs:
+        for y in ys:
+            color = ((37 * x) % 256, (59 * y) % 256, (x + y) % 256, 255)
+            path = root / str(z) / str(x) / f'{y}.{ext}'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            im = Image.new('RGBA', (256, 256), color)
+            im.convert('RGB').save(path, 'JPEG', quality=95) if ext == 'jpg' else im.save(path)
+            colors[(x, y)] = color
+    return colors
+
+
+@pytest.fixture
+def count_reads(monkeypatch):
+    calls = []
+    real = stitch_tiles.read_tile_bytes
+
+    def counted(path):
+        calls.append(path)
+        return real(path)
+
+    monkeypatch.setattr(stitch_tiles, 'read_tile_bytes', counted)
+    return calls
+
+
+@pytest.fixture
+def count_scandir(monkeypatch):
+    """记录 TileIndex 列举的列（只替换 TileIndex 的列扫描，不影响其他测试留下的后台线程）"""
+    calls = []
+    real = stitch_tiles.TileIndex._scan_column
+
+    def counted(self, x):
+        calls.append(str(x))
+        return real(self, x)
+
+    monkeypatch.setattr(stitch_tiles.TileIndex, '_scan_column', counted)
+    return calls
+
+
+def test_index_scans_each_column_once(tmp_path, count_scandir):
+    make_tiles(tmp_path, 4, [2, 3], range(3))
+    index = stitch_tiles.TileIndex(tmp_path, 4)
+    for _ in range(2):
+        for x in (2, 3, 9):
+            for y in range(4):
+                index.lookup(x, y)
+    assert sorted(count_scandir) == ['2', '3', '9']
+
+
+def test_index_prefers_png_and_skips_partial_files(tmp_path):
+    make_tiles(tmp_path, 4, [2], [0, 1], ext='jpg')
+    make_tiles(tmp_path, 4, [2], [1])
+    col = tmp_path / '4' / '2'
+    (col / '5.png.part').write_bytes(b'')
+    (col / 'notes.txt').write_text('x')
+    (col / '7.webp').mkdir()
+    index = stitch_tiles.TileIndex(tmp_path, 4)
+    assert index.lookup(2, 0) == (col / '0.jpg', 'jpg')
+    assert index.lookup(2, 1) == (col / '1.png', 'png')
+    assert index.lookup(2, 5) is None and index.lookup(2, 7) is None
+    assert index.lookup(3, 0) is None
+
+
+def test_coverage_reports_missing_before_decoding(tmp_path, monkeypatch, capsys):
+    make_tiles(tmp_path / 'tiles', 4, range(3), range(2))
+    (tmp_path / 'tiles' / '4' / '1' / '0.png').unlink()
+    (tmp_path / 'tiles' / '4' / '2' / '1.png').unlink()
+    cov = stitch_tiles.TileIndex(tmp_path / 'tiles', 4).coverage(0, 2, 0, 1)
+    assert cov == {'total': 6, 'present': 4, 'missing': 2, 'missing_tiles': [(1, 0), (2, 1)]}
+    assert stitch_tiles.format_coverage(cov, limit=1) == '覆盖: 4/6，缺失 2：(1,0) …'
+
+    # 覆盖报告在开始解码之前输出，结果中带缺失位置
+    decoded = []
+    real = stitch_tiles.Image.open
+
+    def opened(*args, **kwargs):
+        decoded.append(capsys.readouterr().err)
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(stitch_tiles.Image, 'open', opened)
+    result = stitch(4, 0, 2, 0, 1, tmp_path / 'tiles', tmp_path / 'map.png')
+    assert '缺失 2：(1,0), (2,1)' in decoded[0]
+    assert (result['total'], result['missing'], result['missing_tiles']) == (6, 2, [(1, 0), (2, 1)])
+
+
+@pytest.mark.parametrize('fmt,incremental', [('PNG', False), ('PNG', True), ('COG', False)])
+def test_no_hashing_without_cog_manifest(tmp_path, count_reads, fmt, incremental):
+    make_tiles(tmp_path / 'tiles', 3, range(2), range(2))
+    result = stitch(3, 0, 1, 0, 1, tmp_path / 'tiles', tmp_path / 'map.png', output_format=fmt,
+                    block_size=256, incremental=incremental)
+    assert count_reads == []
+    assert not stitch_tiles.manifest_path(stitch_tiles.Path(result['output'])).exists()
+
+
+def test_incremental_cog_hashes_each_tile_once(tmp_path, count_reads):
+    make_tiles(tmp_path / 'tiles', 3, range(2), range(2))
+    stitch(3, 0, 1, 0, 1, tmp_path / 'tiles', tmp_path / 'map.tif', output_format='COG',
+           block_size=256, incremental=True)
+    assert len(count_reads) == 4
+    assert stitch_tiles.manifest_path(tmp_path / 'map.tif').exists()
+
+
+def test_decoded_cache_evicts_by_bytes():
+    cache = stitch_tiles.DecodedTileCache(3 * 256 * 256 * 4)
+    for i in range(4):
+        cache.get_or_decode(i, lambda: Image.new('RGBA', (256, 256)))
+    assert cache.bytes == 3 * 256 * 256 * 4
+    assert cache.get(0) is None and cache.get(3) is not None
+
+
+def test_decoded_cache_single_flight():
+    import threading
+    import time
+    cache = stitch_tiles.DecodedTileCache(1 << 24)
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.05)
+        return Image.new('RGBA', (8, 8))
+
+    threads = [threading.Thread(target=cache.get_or_decode, args=('k', slow)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1 and cache.hits == 3
+
+
+def test_order_jobs_puts_overlapping_jobs_together():
+    spec = lambda name, x0, x1: {'name': name, 'outdir': 'out', 'z': 5, 'x_min': x0, 'x_max': x1, 'y_min': 0, 'y_max': 3}
+    jobs = [spec('a', 0, 9), spec('far', 30, 31), spec('b', 5, 12)]
+    assert [j['name'] for j in stitch_tiles.order_jobs_by_overlap(jobs)] == ['a', 'b', 'far']
+
+
+@pytest.fixture
+def cache_instances(monkeypatch):
+    made = []
+
+    class Recording(stitch_tiles.DecodedTileCache):
+        def __init__(self, max_bytes):
+            super().__init__(max_bytes)
+            made.append(self)
+
+    monkeypatch.setattr(stitch_tiles, 'DecodedTileCache', Recording)
+    return made
+
+
+@pytest.mark.parametrize('parallel', [1, 2])
+def test_overlapping_jobs_share_decodes_and_match_independent_stitches(tmp_path, cache_instances, parallel):
+    tiles = tmp_path / 'tiles'
+    make_tiles(tiles, 4, range(6), range(3))
+    specs = []
+    for name, (x0, x1) in {'left': (0, 3), 'right': (2, 5)}.items():
+        specs.append({'name': name, 'z': 4, 'x_min': x0, 'x_max': x1, 'y_min': 0, 'y_max': 2,
+                      'outdir': tiles, 'output': tmp_path / 'jobs' / f'{name}.png', 'options': {}})
+    stitch_tiles.run_jobs(specs, parallel_jobs=parallel, cache_bytes=64 << 20)
+    cache, = cache_instances
+    # 18 个瓦片中重叠的 2 列 × 3 行只解码一次
+    assert cache.misses == 18 and cache.hits == 6
+
+    for spec in specs:
+        alone = tmp_path / 'alone' / spec['output'].name
+        stitch(4, spec['x_min'], spec['x_max'], 0, 2, tiles, alone)
+        with Image.open(spec['output']) as a, Image.open(alone) as b:
+            assert a.tobytes() == b.tobytes()
+
+
+def test_config_runs_share_cache_sequentially(tmp_path, cache_instances, monkeypatch):
+    import json
+    tiles = tmp_path / 'tiles'
+    make_tiles(tiles, 4, range(6), range(3))
+    west, north = stitch_tiles.tile_to_lonlat(0.2, 0.2, 4)
+    mid_w, _ = stitch_tiles.tile_to_lonlat(2.2, 0.2, 4)
+    mid_e, _ = stitch_tiles.tile_to_lonlat(3.8, 0.2, 4)
+    east, south = stitch_tiles.tile_to_lonlat(5.8, 2.8, 4)
+    config = {'defaults': {'outdir': str(tiles)}, 'jobs': [
+        {'name': 'left', 'zoom': 4, 'bbox': f'{west},{south},{mid_e},{north}', 'output': str(tmp_path / 'l.png')},
+        {'name': 'right', 'zoom': 4, 'bbox': f'{mid_w},{south},{east},{north}', 'output': str(tmp_path / 'r.png')},
+    ]}
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps(config))
+    stitch_tiles.run_from_config(str(path))
+    cache, = cache_instances
+    assert cache.max_bytes == 512 << 20 and cache.hits == 6
+
+
+def test_world_file_written_once(tmp_path, monkeypatch):
+    make_tiles(tmp_path / 'tiles', 3, range(2), range(2))
+    written = []
+    real = stitch_tiles.write_world_file
+    monkeypatch.setattr(stitch_tiles, 'write_world_file', lambda *args: written.append(args) or real(*args))
+    result = stitch_tiles._render_sheet(3, 0, 1, 0, 1, str(tmp_path / 'tiles'), str(tmp_path / 'a.png'), {})
+    assert len(written) == 1
+    assert result['world_file'] == str(tmp_path / 'a.pgw')
+    result = stitch_tiles._render_sheet(3, 0, 1, 0, 1, str(tmp_path / 'tiles'), str(tmp_path / 'b.tif'),
+                                        {'output_format': 'COG', 'block_size': 256})
+    assert len(written) == 1 and result['world_file'] is None
+
+
+def test_sheets_split_in_process_pool(tmp_path):
+    import json
+    from geotiff import tile_range_geotransform
+    colors = make_tiles(tmp_path / 'tiles', 4, range(3, 6), range(7, 10))
+    result = stitch_tiles.stitch_sheets(4, 3, 5, 7, 9, tmp_path / 'tiles', tmp_path / 'map' / 'area.png',
+                                        sheet_size=2, workers=2)
+    assert (result['sheets'], result['total'], result['missing']) == (4, 9, 0)
+    index = json.loads((tmp_path / 'map' / 'area.sheets.json').read_text(encoding='utf-8'))
+    assert (index['rows'], index['cols']) == (2, 2)
+    for sheet in index['sheets']:
+        x_min, x_max = sheet['x_range']
+        y_min, y_max = sheet['y_range']
+        assert sheet['file'] == f"area_r{sheet['row']}_c{sheet['col']}.png"
+        assert (x_min, y_min) == (3 + 2 * sheet['col'], 7 + 2 * sheet['row'])
+        with Image.open(tmp_path / 'map' / sheet['file']) as im:
+            assert im.size == ((x_max - x_min + 1) * 256, (y_max - y_min + 1) * 256)
+            for x in range(x_min, x_max + 1):
+                for y in range(y_min, y_max + 1):
+                    assert im.convert('RGBA').getpixel(((x - x_min) * 256 + 128, (y - y_min) * 256 + 128)) \
+                        == colors[(x, y)]
+        # world file 与该幅的瓦片范围一致
+        ulx, uly, res = tile_range_geotransform(4, x_min, y_min, 256)
+        values = [float(v) for v in (tmp_path / 'map' / sheet['world_file']).read_text().split()]
+        assert values == pytest.approx([res, 0, 0, -res, ulx + res / 2, uly - res / 2])
+
+
+def test_resolve_scale():
+    assert stitch_tiles.resolve_scale(10, 256) == 1.0
+    assert stitch_tiles.resolve_scale(10, 256, scale=0.25) == 0.25
+    assert stitch_tiles.resolve_scale(10, 256, max_width=640) == 0.25
+    assert stitch_tiles.resolve_scale(10, 256, scale=0.1, max_width=640) == 0.1
+    assert stitch_tiles.resolve_scale(10, 256, scale=2, max_width=100000) == 1.0
+
+
+def test_scale_sets_output_dimensions(tmp_path):
+    colors = make_tiles(tmp_path / 'tiles', 4, range(3), range(2))
+    result = stitch(4, 0, 2, 0, 1, tmp_path / 'tiles', tmp_path / 'small.png', scale=0.25)
+    assert (result['width'], result['height'], result['source_zoom']) == (192, 128, 4)
+    with Image.open(tmp_path / 'small.png') as im:
+        assert im.size == (192, 128)
+        assert im.convert('RGBA').getpixel((64 + 32, 32)) == colors[(1, 0)]
+
+
+@pytest.fixture
+def count_drafts(monkeypatch):
+    from PIL import JpegImagePlugin
+    calls = []
+    real = JpegImagePlugin.JpegImageFile.draft
+
+    def counted(self, mode, size):
+        calls.append(size)
+        return real(self, mode, size)
+
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, 'draft', counted)
+    return calls
+
+
+def test_draft_decode_only_for_downscaled_jpeg(tmp_path, count_drafts):
+    make_tiles(tmp_path / 'jpg', 4, range(2), range(2), ext='jpg')
+    make_tiles(tmp_path / 'png', 4, range(2), range(2))
+    stitch(4, 0, 1, 0, 1, tmp_path / 'jpg', tmp_path / 'full.png')
+    assert count_drafts == []
+    stitch(4, 0, 1, 0, 1, tmp_path / 'png', tmp_path / 'png_small.png', scale=0.25)
+    assert count_drafts == []
+    result = stitch(4, 0, 1, 0, 1, tmp_path / 'jpg', tmp_path / 'jpg_small.png', scale=0.25)
+    assert count_drafts == [(64, 64)] * 4
+    assert (result['width'], result['height']) == (128, 128)
+
+
+def test_lower_source_zoom_counts_reported_at_output_zoom(tmp_path):
+    make_tiles(tmp_path / 'tiles', 5, range(8, 12), range(4, 8))
+    make_tiles(tmp_path / 'tiles', 4, range(4, 6), range(2, 4))
+    # 一个 z4 源瓦片损坏：对应 z5 的 2×2 个瓦片算作缺失
+    (tmp_path / 'tiles' / '4' / '5' / '3.png').write_bytes(b'broken')
+    result = stitch(5, 8, 11, 4, 7, tmp_path / 'tiles', tmp_path / 'half.png', scale=0.5)
+    assert result['source_zoom'] == 4
+    assert (result['total'], result['missing']) == (16, 4)
+    assert (result['source_total'], result['source_missing']) == (4, 1)
+    assert (result['width'], result['height']) == (512, 512)
+
+    # 源 zoom 范围只部分落在输出范围内时按重叠的瓦片数计
+    result = stitch(5, 9, 11, 5, 7, tmp_path / 'tiles', tmp_path / 'part.png', scale=0.5)
+    assert (result['total'], result['missing'], result['source_missing']) == (9, 4, 1)
@@ -0,0 +1,87 @@
+import threading
+
+from conftest import write_tile
+
+
+def watcher_threads():
+    return [t for t in threading.enumerate() if t.name == 'tile-index-watcher']
+
+
+def test_lookup_prefers_png(srv):
+    write_tile(srv.TILES_DIR, 3, 1, 2, 'webp')
+    write_tile(srv.TILES_DIR, 3, 1, 2, 'png')
+    write_tile(srv.TILES_DIR, 3, 1, 5, 'jpg')
+    assert srv.find_tile_file(3, 1, 2).name == '2.png'
+    assert srv.find_tile_file(3, 1, 5).name == '5.jpg'
+    assert srv.find_tile_file(3, 1, 3) is None
+    assert srv.find_tile_file(3, 7, 2) is None
+    assert srv.find_tile_file(4, 1, 2) is None
+
+
+def test_refresh_sees_new_tiles(srv):
+    write_tile(srv.TILES_DIR, 5, 10, 10)
+    srv.find_tile_file(5, 10, 10)
+    version = srv.tile_index.version
+    write_tile(srv.TILES_DIR, 5, 10, 12)
+    write_tile(srv.TILES_DIR, 5, 11, 3)
+    assert srv.tile_index.refresh()
+    assert srv.tile_index.version > version
+    assert srv.find_tile_file(5, 10, 12) is not None
+    assert srv.find_tile_file(5, 11, 3) is not None
+    assert srv.tile_index.count(5) == 3
+
+
+def test_add_registers_without_rescan(srv):
+    srv.tile_index.ensure_loaded()
+    srv.tile_index.add(6, 4, 9, 'webp')
+    srv.tile_index.add(6, 4, 2, 'png')
+    assert srv.tile_index.lookup_ext(6, 4, 9) == 'webp'
+    assert srv.tile_index.lookup_ext(6, 4, 2) == 'png'
+    assert srv.tile_index.lookup_ext(6, 4, 5) is None
+
+
+def test_lookup_does_not_start_watcher(srv):
+    """--index-poll 0 表示启动后不再更新；查找路径不得自行启动轮询线程"""
+    before = len(watcher_threads())
+    write_tile(srv.TILES_DIR, 2, 1, 1)
+    assert srv.find_tile_file(2, 1, 1) is not None
+    srv.tile_index.start_watcher(0)
+    assert srv.find_tile_file(2, 1, 1) is not None
+    assert srv.tile_index._watcher is None
+    assert len(watcher_threads()) == before
+
+
+def test_add_during_refresh_survives_swap(srv, monkeypatch):
+    """重扫在锁外进行；期间 add() 登记的瓦片在替换 zooms 后仍然可查"""
+    index = srv.tile_index
+    write_tile(srv.TILES_DIR, 5, 10, 10)
+    index.ensure_loaded()
+    real = index._scan_zoom
+
+    def scan_then_add(path, old_cols):
+        result = real(path, old_cols)
+        index.add(7, 3, 3, 'webp')  # 代理在扫描进行中写入的瓦片
+        return result
+
+    monkeypatch.setattr(index, '_scan_zoom', scan_then_add)
+    index.refresh()
+    assert index.lookup_ext(7, 3, 3) == 'webp'
+    assert index.lookup_ext(5, 10, 10) == 'png'
+
+
+def test_new_extensions_get_unique_codes(srv):
+    index = srv.tile_index
+    exts = [f'x{i}' for i in range(20)]
+    barrier = threading.Barrier(8)
+
+    def register():
+        barrier.wait()
+        for ext in exts:
+            index._ext_code(ext)
+
+    threads = [threading.Thread(target=register) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(e for e in index.exts if e.startswith('x')) == sorted(exts)
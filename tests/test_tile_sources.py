@@ -0,0 +1,93 @@
+import pytest
+
+import tile_sources
+from tile_sources import (MBTilesSource, PMTilesSource, iter_loose_tiles, open_archive, pack_mbtiles,
+                          pack_pmtiles, parse_directory, serialize_directory, zxy_to_tileid)
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def fake_png(z, x, y, size=757):
+    """长度固定、内容按坐标区分的瓦片字节（打包时格式一致，不会转码）"""
+    body = f'{z}/{x}/{y}|'.encode() * size
+    return PNG_SIGNATURE + body[:size - len(PNG_SIGNATURE)]
+
+
+@pytest.fixture
+def loose(tmp_path):
+    coords = [(3, 1, 1), (3, 2, 1), (3, 2, 2), (4, 3, 2), (4, 4, 2), (4, 4, 3), (0, 0, 0)]
+    root = tmp_path / 'out'
+    for z, x, y in coords:
+        path = root / str(z) / str(x) / f'{y}.png'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(fake_png(z, x, y))
+    return root, coords
+
+
+def test_zxy_to_tileid():
+    assert zxy_to_tileid(0, 0, 0) == 0
+    assert [zxy_to_tileid(1, x, y) for x, y in ((0, 0), (0, 1), (1, 1), (1, 0))] == [1, 2, 3, 4]
+    assert zxy_to_tileid(2, 0, 0) == 5
+    assert zxy_to_tileid(3, 0, 0) == 21
+    assert zxy_to_tileid(12, 3423, 1763) == 19078479
+    # 每级的 ID 恰好覆盖 [该级起点, 下一级起点)
+    ids = sorted(zxy_to_tileid(3, x, y) for x in range(8) for y in range(8))
+    assert ids == list(range(21, 85))
+
+
+def test_directory_round_trip():
+    entries = [(5, 0, 100, 1), (6, 100, 50, 3), (20, 0, 100, 1), (21, 400, 10, 0)]
+    import gzip
+    ids, runs, offs, lens = parse_directory(gzip.decompress(serialize_directory(entries)))
+    assert list(zip(ids, offs, lens, runs)) == entries
+
+
+@pytest.mark.parametrize('suffix,pack', [('.mbtiles', pack_mbtiles), ('.pmtiles', pack_pmtiles)])
+def test_archive_returns_tile_for_coordinate(tmp_path, loose, suffix, pack):
+    root, coords = loose
+    output = tmp_path / ('region' + suffix)
+    pack(list(iter_loose_tiles(root)), output, 'png', 'region')
+    src = open_archive(output)
+    assert isinstance(src, MBTilesSource if suffix == '.mbtiles' else PMTilesSource)
+    tags = set()
+    for z, x, y in coords:
+        tile = src.lookup(z, x, y)
+        assert tile is not None, (z, x, y)
+        assert tile.ext == 'png'
+        assert bytes(src.read(tile)) == fake_png(z, x, y)
+        tags.add(tile.tag)
+    # 长度相同的不同瓦片必须有不同的 tag（ETag 与缓存键）
+    assert len(tags) == len(coords)
+    assert src.lookup(3, 1, 2) is None
+    assert src.lookup(3, 6, 1) is None
+    assert src.lookup(9, 0, 0) is None
+    summary = src.summary()
+    assert summary['3']['count'] == 3
+    assert summary['4']['count'] == 3
+
+
+def test_pmtiles_leaf_directories(tmp_path, monkeypatch, loose):
+    root, coords = loose
+    # 根目录上限压到很小，强制写出叶目录
+    monkeypatch.setattr(tile_sources, 'PMTILES_ROOT_MAX', tile_sources.PMTILES_HEADER.size + 30)
+    output = tmp_path / 'leaf.pmtiles'
+    pack_pmtiles(list(iter_loose_tiles(root)), output, 'png', 'leaf')
+    src = PMTilesSource(output)
+    assert src.file.leaf_length > 0
+    for z, x, y in coords:
+        assert bytes(src.read(src.lookup(z, x, y))) == fake_png(z, x, y)
+    assert src.summary()['4']['count'] == 3
+
+
+def test_pmtiles_dedup_shares_bytes(tmp_path):
+    root = tmp_path / 'out'
+    for x in range(2):
+        path = root / '1' / str(x) / '0.png'
+        path.parent.mkdir(parents=True)
+        path.write_bytes(fake_png(9, 9, 9))
+    output = tmp_path / 'dup.pmtiles'
+    pack_pmtiles(list(iter_loose_tiles(root)), output, 'png', 'dup')
+    src = PMTilesSource(output)
+    a, b = src.lookup(1, 0, 0), src.lookup(1, 1, 0)
+    assert a.offset == b.offset and a.tag == b.tag
+    assert bytes(src.read(a)) == fake_png(9, 9, 9)
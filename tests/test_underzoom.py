@@ -0,0 +1,103 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from conftest import write_tile
+
+RED, GREEN, BLUE, GREY = (255, 0, 0, 255), (0, 255, 0, 255), (0, 0, 255, 255), (90, 90, 90, 255)
+CLEAR = (0, 0, 0, 0)
+QUADRANTS = [(0, 0), (1, 0), (0, 1), (1, 1)]
+
+
+def fetch(srv, z, x, y, headers=None):
+    plan = srv.plan_tile(z, x, y, 'png', False, headers or {}, {})
+    if plan.status == 304:
+        return plan, None
+    body, _ = srv.plan_body(plan)
+    with Image.open(io.BytesIO(body)) as im:
+        return plan, im.convert('RGBA')
+
+
+def quadrants(im):
+    return [im.getpixel((64 + 128 * (i % 2), 64 + 128 * (i // 2))) for i in range(4)]
+
+
+@pytest.fixture
+def composed(srv, monkeypatch):
+    """记录实际拼合的次数（命中磁盘缓存时不拼合）"""
+    calls = []
+    real = srv.compose_children
+
+    def counted(children):
+        calls.append(1)
+        return real(children)
+
+    monkeypatch.setattr(srv, 'compose_children', counted)
+    return calls
+
+
+def test_composed_from_four_children(srv):
+    for (dx, dy), color in zip(QUADRANTS, [RED, GREEN, BLUE, GREY]):
+        write_tile(srv.TILES_DIR, 5, 10 + dx, 12 + dy, 'png', color)
+    plan, im = fetch(srv, 4, 5, 6)
+    assert plan.headers['ETag'].startswith('"u')
+    assert quadrants(im) == [RED, GREEN, BLUE, GREY]
+
+
+def test_partial_children_leave_gaps_transparent(srv):
+    write_tile(srv.TILES_DIR, 5, 11, 13, 'png', GREY)
+    _, im = fetch(srv, 4, 5, 6)
+    assert quadrants(im) == [CLEAR, CLEAR, CLEAR, GREY]
+
+
+def test_fallback_depth(srv, monkeypatch):
+    """缺失的子瓦片继续向下找，最多 UNDERZOOM_DEPTH 级"""
+    write_tile(srv.TILES_DIR, 5, 10, 12, 'png', RED)
+    for dx, dy in QUADRANTS:
+        write_tile(srv.TILES_DIR, 6, 22 + dx, 24 + dy, 'png', BLUE)  # 5/11/12 的四个子瓦片
+    _, im = fetch(srv, 4, 5, 6)
+    assert quadrants(im) == [RED, BLUE, CLEAR, CLEAR]
+
+    monkeypatch.setattr(srv, 'UNDERZOOM_DEPTH', 1)
+    _, im = fetch(srv, 4, 5, 6)
+    assert quadrants(im) == [RED, CLEAR, CLEAR, CLEAR]
+
+    # 只有三级以下才有瓦片时不拼合
+    monkeypatch.setattr(srv, 'UNDERZOOM_DEPTH', 2)
+    plan, _ = fetch(srv, 3, 2, 3)
+    assert plan.headers['ETag'].startswith('"u')
+    plan, _ = fetch(srv, 2, 1, 1)
+    assert plan.headers['ETag'] == '"blank"'
+
+
+def test_disk_cache_built_once(srv, composed):
+    for dx, dy in QUADRANTS:
+        write_tile(srv.TILES_DIR, 5, 10 + dx, 12 + dy, 'png', GREEN)
+    plan, _ = fetch(srv, 4, 5, 6)
+    cached = list((srv.UNDERZOOM_CACHE_DIR / '4' / '5').glob('6-*.png'))
+    assert len(cached) == 1
+    # 清空响应缓存（如重启）后从磁盘读取，不再拼合
+    srv.response_cache = srv.ResponseCache(srv.RESPONSE_CACHE_MB * 1024 * 1024)
+    again, im = fetch(srv, 4, 5, 6)
+    assert again.headers['ETag'] == plan.headers['ETag']
+    assert quadrants(im) == [GREEN] * 4
+    assert len(composed) == 1
+
+
+def test_disk_cache_invalidated_when_children_change(srv, composed):
+    paths = [write_tile(srv.TILES_DIR, 5, 10 + dx, 12 + dy, 'png', GREEN) for dx, dy in QUADRANTS]
+    plan, _ = fetch(srv, 4, 5, 6)
+    old = list((srv.UNDERZOOM_CACHE_DIR / '4' / '5').glob('6-*.png'))
+
+    write_tile(srv.TILES_DIR, 5, 11, 13, 'png', RED)
+    st = paths[3].stat()
+    os.utime(paths[3], ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    again, im = fetch(srv, 4, 5, 6, {'If-None-Match': plan.headers['ETag']})
+    assert again.status == 200 and again.headers['ETag'] != plan.headers['ETag']
+    assert quadrants(im) == [GREEN, GREEN, GREEN, RED]
+    # 旧签名的缓存文件在重建时删除
+    new = list((srv.UNDERZOOM_CACHE_DIR / '4' / '5').glob('6-*.png'))
+    assert len(new) == 1 and new != old
+    assert len(composed) == 2
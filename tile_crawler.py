@@ -4,6 +4,7 @@
 - 计算经纬度到 Slippy map 瓦片 (x, y, z) 的转换
 - 根据 bbox 或 GeoJSON 多边形导出瓦片索引范围
 - 并发下载瓦片并保存为 `out/{z}/{x}/{y}.png`
+- 每个下载任务结束后增量更新覆盖清单 `out/coverage.json`（供 server.py 首页与统计使用）
 
 使用说明见仓库 README
 """
@@ -15,6 +16,8 @@ import argparse
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import coverage_manifest
+
 try:
     import requests
 except Exception:
@@ -124,6 +127,17 @@ def tile_url(template, z, x, y):
     return template.format(z=z, x=x, y=y)
 
 
+def format_tile_url(template, z, x, y, tokens=None):
+    """填充模板中的 {z}/{x}/{y} 与 tokens；tokens 缺失时退回只填坐标"""
+    fmt_kwargs = {'z': z, 'x': x, 'y': y}
+    if tokens:
+        fmt_kwargs.update(tokens)
+    try:
+        return template.format(**fmt_kwargs)
+    except Exception:
+        return tile_url(template, z, x, y)
+
+
 def _get_ext_from_url_or_content(url, resp=None):
     # try to get extension from URL
     path = url.split('?')[0]
@@ -151,13 +165,7 @@ def validate_tile_request(template, z, x, y, headers=None, tokens=None, timeout=
     except Exception:
         return False, 'requests 未安装'
 
-    fmt_kwargs = {'z': z, 'x': x, 'y': y}
-    if tokens:
-        fmt_kwargs.update(tokens)
-    try:
-        url = template.format(**fmt_kwargs)
-    except Exception:
-        url = tile_url(template, z, x, y)
+    url = format_tile_url(template, z, x, y, tokens)
 
     sess = _req.Session()
     if proxies:
@@ -190,17 +198,27 @@ def validate_tile_request(template, z, x, y, headers=None, tokens=None, timeout=
 
 
 def download_tile(session, url, out_path, timeout=15, retries=2, headers=None, skip_existing=True):
+    return fetch_tile(session, url, out_path, timeout, retries, headers, skip_existing)[0]
+
+
+def fetch_tile(session, url, out_path, timeout=15, retries=2, headers=None, skip_existing=True):
+    """
+    与 download_tile 相同，另外返回最后一次响应的状态码（请求异常时为 None）。
+    404 不再重试；目录在拿到 200 响应后才创建，失败的请求不在磁盘上留下空目录。
+    """
     # write to a temporary file first
     tmp_path = out_path + '.part'
-    os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
     # if final exists and skipping enabled
     if skip_existing and os.path.exists(out_path) and os.path.getsize(out_path) > 0:
-        return True
+        return True, None
 
+    status = None
     for attempt in range(1, retries + 2):
         try:
             resp = session.get(url, timeout=timeout, stream=True, headers=headers)
+            status = resp.status_code
             if resp.status_code == 200:
+                os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
                 with open(tmp_path, 'wb') as fh:
                     for chunk in resp.iter_content(chunk_size=8192):
                         if chunk:
@@ -217,19 +235,23 @@ def download_tile(session, url, out_path, timeout=15, retries=2, headers=None, s
                     os.replace(tmp_path, final_path)
                 except Exception:
                     os.remove(tmp_path)
-                    return False
-                return final_path
-            else:
+                    return False, status
+                return final_path, status
+            elif resp.status_code == 404:
+                break
+            elif attempt <= retries:
                 time.sleep(0.5 * attempt)
         except Exception:
-            time.sleep(0.5 * attempt)
+            status = None
+            if attempt <= retries:
+                time.sleep(0.5 * attempt)
     # cleanup tmp if exists
     if os.path.exists(tmp_path):
         try:
             os.remove(tmp_path)
         except Exception:
             pass
-    return False
+    return False, status
 
 
 def download_tile_range(template, z, x_range, y_range, outdir='out', concurrency=32, rate=0.0, headers=None, skip_existing=True, timeout=15, retries=2, tokens=None, convert_webp_to_png=False, proxies=None):
@@ -241,12 +263,7 @@ def download_tile_range(template, z, x_range, y_range, outdir='out', concurrency
             tasks.append((x, y))
 
     total = len(tasks)
-    session = requests.Session()
-    if proxies:
-        try:
-            session.proxies.update(proxies)
-        except Exception:
-            pass
+    session = make_session(proxies)
 
     successes = 0
     failures = 0
@@ -255,13 +272,7 @@ def download_tile_range(template, z, x_range, y_range, outdir='out', concurrency
         futures = {}
         for x, y in tasks:
             # build url with tokens if provided
-            fmt_kwargs = {'z': z, 'x': x, 'y': y}
-            if tokens:
-                fmt_kwargs.update(tokens)
-            try:
-                url = template.format(**fmt_kwargs)
-            except Exception:
-                url = tile_url(template, z, x, y)
+            url = format_tile_url(template, z, x, y, tokens)
 
             # prepare out path without extension (extension decided after response)
             out_base = os.path.join(outdir, str(z), str(x), f"{y}")
@@ -287,9 +298,85 @@ def download_tile_range(template, z, x_range, y_range, outdir='out', concurrency
             else:
                 failures += 1
 
+    # 只重扫本次涉及的列，更新覆盖清单
+    try:
+        coverage_manifest.update_columns(outdir, z, range(xmin, xmax + 1))
+    except Exception as e:
+        print(f'警告：更新覆盖清单失败: {e}')
+
     return {'total': total, 'successes': successes, 'failures': failures}
 
 
+# default essential headers (can be overridden by config.json and/or --headers)
+ESSENTIAL_HEADERS = {
+    'Accept': 'image/webp,*/*',
+    'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+    'Origin': 'https://online.geovisearth.com',
+    'Referer': 'https://online.geovisearth.com/',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-site',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36 Edg/142.0.0.0',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Priority': 'u=1, i',
+}
+
+
+def load_config(path=None):
+    """按顺序查找配置文件：指定路径、脚本目录、仓库根目录、当前目录。返回 (config, 路径)"""
+    candidates = []
+    if path:
+        candidates.append(path)
+    candidates.append(str(Path(__file__).resolve().parent / 'config.json'))
+    try:
+        repo_root = Path(__file__).resolve().parents[2]
+        candidates.append(str(repo_root / 'config.json'))
+    except Exception:
+        pass
+    candidates.append(str(Path.cwd() / 'config.json'))
+
+    for p in candidates:
+        try:
+            if p and Path(p).exists():
+                with open(p, 'r', encoding='utf-8') as fh:
+                    return json.load(fh) or {}, p
+        except Exception:
+            continue
+    return {}, None
+
+
+def request_options(config):
+    """由配置构造请求头、模板 tokens 与代理 → (headers, tokens, proxies)；爬虫与 server.py 的读穿代理共用"""
+    hdrs = ESSENTIAL_HEADERS.copy()
+    try:
+        cfg_hdrs = config.get('headers') if isinstance(config, dict) else None
+        if isinstance(cfg_hdrs, dict):
+            hdrs.update(cfg_hdrs)
+    except Exception:
+        pass
+
+    cfg_tokens = (config.get('tokens') if isinstance(config, dict) else None) or {}
+    tokens = {key: cfg_tokens.get(key, '') for key in ('secretId', 'clientId', 'expireTime', 'sign')}
+
+    proxies = None
+    try:
+        if isinstance(config, dict) and config.get('proxies'):
+            proxies = config.get('proxies')
+    except Exception:
+        proxies = None
+    return hdrs, tokens, proxies
+
+
+def make_session(proxies=None):
+    session = requests.Session()
+    if proxies:
+        try:
+            session.proxies.update(proxies)
+        except Exception:
+            pass
+    return session
+
+
 def parse_bbox_arg(bbox_str):
     parts = [p.strip() for p in bbox_str.split(',')]
     if len(parts) != 4:
@@ -322,51 +409,11 @@ def main():
     parser.add_argument('--config', type=str, help='JSON 配置文件路径，优先读取 headers、tokens、proxies 等')
     args = parser.parse_args()
 
-    # default essential headers (can be overridden by config.json and/or --headers)
-    essential_headers = {
-        'Accept': 'image/webp,*/*',
-        'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-        'Origin': 'https://online.geovisearth.com',
-        'Referer': 'https://online.geovisearth.com/',
-        'Sec-Fetch-Dest': 'empty',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Site': 'same-site',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36 Edg/142.0.0.0',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Priority': 'u=1, i',
-    }
-
-    # load optional JSON config
-    config = {}
-    candidates = []
-    if args.config:
-        candidates.append(args.config)
-    candidates.append(str(Path(__file__).resolve().parent / 'config.json'))
-    try:
-        repo_root = Path(__file__).resolve().parents[2]
-        candidates.append(str(repo_root / 'config.json'))
-    except Exception:
-        pass
-    candidates.append(str(Path.cwd() / 'config.json'))
-
-    for p in candidates:
-        try:
-            if p and Path(p).exists():
-                with open(p, 'r', encoding='utf-8') as fh:
-                    config = json.load(fh) or {}
-                print(f'Loaded config from: {p}')
-                break
-        except Exception:
-            continue
+    config, config_path = load_config(args.config)
+    if config_path:
+        print(f'Loaded config from: {config_path}')
 
-    # build headers
-    hdrs = essential_headers.copy()
-    try:
-        cfg_hdrs = config.get('headers') if isinstance(config, dict) else None
-        if isinstance(cfg_hdrs, dict):
-            hdrs.update(cfg_hdrs)
-    except Exception:
-        pass
+    hdrs, tokens, proxies = request_options(config)
 
     if args.referer:
         hdrs['Referer'] = args.referer
@@ -381,21 +428,10 @@ def main():
             print('警告：无法解析 --headers JSON，忽略')
 
     # tokens priority: CLI args override config tokens
-    cfg_tokens = config.get('tokens') if isinstance(config, dict) else {}
-    tokens = {
-        'secretId': args.secretId or cfg_tokens.get('secretId', ''),
-        'clientId': args.clientId or cfg_tokens.get('clientId', ''),
-        'expireTime': args.expireTime or cfg_tokens.get('expireTime', ''),
-        'sign': args.sign or cfg_tokens.get('sign', ''),
-    }
-
-    # proxies
-    proxies = None
-    try:
-        if isinstance(config, dict) and config.get('proxies'):
-            proxies = config.get('proxies')
-    except Exception:
-        proxies = None
+    for key in ('secretId', 'clientId', 'expireTime', 'sign'):
+        value = getattr(args, key)
+        if value:
+            tokens[key] = value
 
     if args.single_url:
         url = args.single_url
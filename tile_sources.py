@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+"""
+tile_sources.py
+
+单文件瓦片来源，供 server.py 使用（--source region.mbtiles / region.pmtiles）：
+- MBTilesSource：SQLite，每个线程一个只读连接
+- PMTilesSource：PMTiles v3，mmap 读取整个文件，解析过的目录缓存在内存 LRU 中
+两者都按间隔检查文件身份（inode/mtime/大小），文件被替换后自动重新打开；
+查找本身不产生任何文件系统元数据调用。
+
+也可以把 out/ 打包为单个文件，部署一个区域只需复制一个文件：
+    python tile_sources.py out/ region.mbtiles
+    python tile_sources.py out/ region.pmtiles --zoom 8-12
+"""
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import logging
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple, Optional
+from urllib.parse import quote
+
+from coverage_manifest import tile_range_bounds
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+PREFERRED_EXTS = ['png', 'webp', 'jpg', 'jpeg']
+SOURCE_POLL_SECONDS = 5.0
+DIR_CACHE_ENTRIES = 1024
+
+PMTILES_HEADER = struct.Struct('<7sBQQQQQQQQQQQBBBBBBiiiiBii')
+PMTILES_ROOT_MAX = 16384
+# PMTiles 压缩与瓦片类型编码
+COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_BROTLI, COMPRESSION_ZSTD = 1, 2, 3, 4
+PMTILES_TYPES = {2: 'png', 3: 'jpg', 4: 'webp', 5: 'avif'}
+PMTILES_TYPE_CODES = {'png': 2, 'jpg': 3, 'jpeg': 3, 'webp': 4, 'avif': 5}
+PIL_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'jpeg': 'JPEG', 'webp': 'WEBP'}
+
+
+class Tile(NamedTuple):
+    """
+    一次查找的结果。
+    tag 标识瓦片内容的版本（用于 ETag 与转码缓存键）；
+    path 非空时文件中 [offset, offset + length) 即瓦片字节，可直接发送。
+    """
+    ext: str
+    mtime: float
+    tag: str
+    path: Optional[Path] = None
+    offset: int = 0
+    length: int = 0
+    data: Optional[bytes] = None
+
+    @property
+    def whole_file(self):
+        """瓦片就是整个文件（松散目录来源）"""
+        return self.path is not None and self.data is None and self.offset == 0
+
+
+def sniff_ext(data):
+    """按文件头判断图片格式"""
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return 'png'
+
+
+def lonlat_to_tile(lon, lat, z):
+    n = 2 ** z
+    lat = max(-85.05112878, min(85.05112878, lat))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(n - 1, max(0, x)), min(n - 1, max(0, y))
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return st.st_ino, st.st_mtime_ns, st.st_size, st.st_mtime
+
+
+class ArchiveSource:
+    """单文件来源的公共部分：按间隔检查文件身份，变化时重新打开"""
+
+    kind = 'archive'
+
+    def __init__(self, path, poll=SOURCE_POLL_SECONDS):
+        self.path = Path(path)
+        self.poll = poll
+        self._lock = threading.Lock()
+        self._checked = 0.0
+        self._summary = None
+        self._watcher = None
+        self.stamp = file_stamp(self.path)
+        self.tag = '{:x}-{:x}-{:x}'.format(*self.stamp[:3])
+        self._open()
+
+    def _open(self):
+        raise NotImplementedError
+
+    @property
+    def watching(self):
+        """查找路径上是否不再 stat（由后台线程检查文件身份，或 poll <= 0 不检查）"""
+        return self._watcher is not None or self.poll <= 0
+
+    def check(self):
+        """距上次检查超过 poll 秒时 stat 一次；文件被替换或修改则重新打开。后台线程检查时直接返回"""
+        now = time.monotonic()
+        if self.watching or now - self._checked < self.poll:
+            return
+        with self._lock:
+            if now - self._checked < self.poll:
+                return
+            self._checked = now
+            self._reopen_if_changed()
+
+    def _reopen_if_changed(self):
+        try:
+            stamp = file_stamp(self.path)
+        except OSError:
+            return
+        if stamp[:3] != self.stamp[:3]:
+            self._open()
+            self.stamp = stamp
+            self.tag = '{:x}-{:x}-{:x}'.format(*stamp[:3])
+            self._summary = None
+
+    def start_watcher(self, interval=None):
+        """后台按间隔检查文件身份，查找不再触及文件系统（与 server.TileIndex 的轮询线程相同）"""
+        interval = self.poll if interval is None else interval
+        if self._watcher is not None or interval <= 0:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    with self._lock:
+                        self._reopen_if_changed()
+                except Exception as e:
+                    logger.warning(f"检查 {self.path} 失败: {e}")
+
+        self._watcher = threading.Thread(target=loop, name='archive-watcher', daemon=True)
+        self._watcher.start()
+
+    def version(self):
+        return self.tag
+
+    def summary(self):
+        """与 coverage_manifest.summary 相同的结构：{z: {count, bytes, formats, bounds, tile_range}}"""
+        if self._summary is None:
+            self._summary = self._build_summary()
+        return self._summary
+
+    def read(self, tile):
+        return tile.data
+
+
+class MBTilesSource(ArchiveSource):
+    """MBTiles（TMS 行号）；每个线程持有自己的只读连接，文件重新打开时整体换掉 threading.local"""
+
+    kind = 'mbtiles'
+
+    def _open(self):
+        self._local = threading.local()
+        conn = self._connect()
+        self.metadata = dict(conn.execute('SELECT name, value FROM metadata').fetchall())
+        conn.close()
+        self.format = self.metadata.get('format', 'png').lower()
+
+    def _connect(self):
+        uri = 'file:' + quote(str(self.path.resolve())) + '?mode=ro'
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def _conn(self):
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = self._connect()
+        return conn
+
+    def lookup(self, z, x, y):
+        self.check()
+        row = (1 << z) - 1 - y
+        found = self._conn().execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+            (z, x, row)).fetchone()
+        if found is None or found[0] is None:
+            return None
+        data = bytes(found[0])
+        # 同一归档内坐标唯一标识瓦片内容（长度相同的不同瓦片不能共用 ETag/缓存键）
+        tag = f'{self.tag}-{z:x}-{x:x}-{y:x}'
+        return Tile(sniff_ext(data), self.stamp[3], tag, length=len(data), data=data)
+
+    def _build_summary(self):
+        rows = self._conn().execute(
+            'SELECT zoom_level, COUNT(*), SUM(LENGTH(tile_data)), MIN(tile_column), MAX(tile_column), '
+            'MIN(tile_row), MAX(tile_row) FROM tiles GROUP BY zoom_level').fetchall()
+        zooms = {}
+        for z, count, size, x_min, x_max, row_min, row_max in rows:
+            # TMS 行号翻转为 XYZ
+            y_min, y_max = (1 << z) - 1 - row_max, (1 << z) - 1 - row_min
+            zooms[str(z)] = {'count': count, 'bytes': size or 0, 'formats': {self.format: count},
+                             'bounds': tile_range_bounds(z, x_min, x_max, y_min, y_max),
+                             'tile_range': [x_min, x_max, y_min, y_max]}
+        return zooms
+
+
+def zxy_to_tileid(z, x, y):
+    """PMTiles 瓦片 ID：低层级瓦片总数 + 当前层级的 Hilbert 曲线序号"""
+    acc = ((1 << (2 * z)) - 1) // 3
+    for a in range(z - 1, -1, -1):
+        s = 1 << a
+        rx, ry = s & x, s & y
+        acc += ((3 * rx) ^ ry) << a
+        if not ry:
+            if rx:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+    return acc
+
+
+def _read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decompress(data, compression):
+    if compression in (0, COMPRESSION_NONE):
+        return data
+    if compression == COMPRESSION_GZIP:
+        return gzip.decompress(data)
+    if compression == COMPRESSION_BROTLI and brotli is not None:
+        return brotli.decompress(data)
+    if compression == COMPRESSION_ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise RuntimeError(f'不支持的 PMTiles 压缩方式: {compression}（brotli/zstd 需安装对应模块）')
+
+
+def parse_directory(buf):
+    """解码 PMTiles 目录 → (tile_ids, run_lengths, offsets, lengths) 四个列表"""
+    n, pos = _read_varint(buf, 0)
+    ids, runs, lens, offs = [0] * n, [0] * n, [0] * n, [0] * n
+    last = 0
+    for i in range(n):
+        delta, pos = _read_varint(buf, pos)
+        last += delta
+        ids[i] = last
+    for i in range(n):
+        runs[i], pos = _read_varint(buf, pos)
+    for i in range(n):
+        lens[i], pos = _read_varint(buf, pos)
+    for i in range(n):
+        v, pos = _read_varint(buf, pos)
+        offs[i] = offs[i - 1] + lens[i - 1] if v == 0 and i > 0 else v - 1
+    return ids, runs, offs, lens
+
+
+def serialize_directory(entries):
+    """entries: [(tile_id, offset, length, run_length), ...]，按 tile_id 升序"""
+    out = bytearray()
+    _write_varint(out, len(entries))
+    last = 0
+    for tile_id, _, _, _ in entries:
+        _write_varint(out, tile_id - last)
+        last = tile_id
+    for entry in entries:
+        _write_varint(out, entry[3])
+    for entry in entries:
+        _write_varint(out, entry[2])
+    for i, (_, offset, length, _) in enumerate(entries):
+        prev = entries[i - 1] if i else None
+        _write_varint(out, 0 if prev and offset == prev[1] + prev[2] else offset + 1)
+    return gzip.compress(bytes(out), compresslevel=9, mtime=0)
+
+
+class PMTilesFile:
+    """一个打开的 PMTiles v3 文件：mmap、头部字段、常驻的根目录与叶目录 LRU"""
+
+    def __init__(self, path, dir_cache_entries=DIR_CACHE_ENTRIES):
+        with open(path, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fields = PMTILES_HEADER.unpack_from(self.mm, 0)
+        if fields[0] != b'PMTiles' or fields[1] != 3:
+            raise ValueError(f'{path} 不是 PMTiles v3 文件')
+        (self.root_offset, self.root_length, self.meta_offset, self.meta_length,
+         self.leaf_offset, self.leaf_length, self.data_offset, self.data_length) = fields[2:10]
+        self.internal_compression, self.tile_compression, tile_type = fields[14:17]
+        self.min_zoom, self.max_zoom = fields[17:19]
+        self.bounds = [v / 1e7 for v in fields[19:23]]
+        self.format = PMTILES_TYPES.get(tile_type, 'png')
+        self.dir_cache_entries = dir_cache_entries
+        self.dirs = OrderedDict()
+        self.root = self.parse(self.root_offset, self.root_length)
+
+    def parse(self, offset, length):
+        return parse_directory(_decompress(self.mm[offset:offset + length], self.internal_compression))
+
+    def leaf(self, offset, length):
+        key = (offset, length)
+        dirs = self.dirs
+        found = dirs.get(key)
+        if found is not None:
+            try:
+                dirs.move_to_end(key)
+            except KeyError:
+                pass
+            return found
+        found = self.parse(self.leaf_offset + offset, length)
+        dirs[key] = found
+        while len(dirs) > self.dir_cache_entries:
+            try:
+                dirs.popitem(last=False)
+            except KeyError:
+                break
+        return found
+
+    def find(self, tile_id):
+        """在目录中查找瓦片 ID → (数据区内偏移, 长度) 或 None"""
+        directory = self.root
+        for _ in range(4):  # 规范规定目录最多三层叶目录
+            ids, runs, offs, lens = directory
+            i = bisect_right(ids, tile_id) - 1
+            if i < 0:
+                return None
+            if runs[i] == 0:
+                directory = self.leaf(offs[i], lens[i])
+                continue
+            if tile_id - ids[i] < runs[i]:
+                return offs[i], lens[i]
+            return None
+        return None
+
+    def iter_entries(self, directory=None, depth=0):
+        """遍历所有瓦片条目 → (tile_id, run_length, length)"""
+        ids, runs, offs, lens = directory or self.root
+        for i in range(len(ids)):
+            if runs[i]:
+                yield ids[i], runs[i], lens[i]
+            elif depth < 3:
+                yield from self.iter_entries(self.parse(self.leaf_offset + offs[i], lens[i]), depth + 1)
+
+
+class PMTilesSource(ArchiveSource):
+    """PMTiles v3：mmap 整个文件，根目录常驻，叶目录进入 LRU 缓存"""
+
+    kind = 'pmtiles'
+
+    def __init__(self, path, poll=SOURCE_POLL_SECONDS, dir_cache_entries=DIR_CACHE_ENTRIES):
+        self.dir_cache_entries = dir_cache_entries
+        super().__init__(path, poll)
+
+    def _open(self):
+        # 整体替换，正在查找的线程继续使用旧映射，由垃圾回收释放
+        self.file = PMTilesFile(self.path, self.dir_cache_entries)
+
+    def lookup(self, z, x, y):
+        self.check()
+        f = self.file
+        if z < f.min_zoom or z > f.max_zoom or not (0 <= x < 1 << z and 0 <= y < 1 << z):
+            return None
+        found = f.find(zxy_to_tileid(z, x, y))
+        if found is None:
+            return None
+        offset, length = found
+        offset += f.data_offset
+        tag = f'{self.tag}-{offset:x}-{length:x}'
+        if f.tile_compression not in (0, COMPRESSION_NONE):
+            data = _decompress(f.mm[offset:offset + length], f.tile_compression)
+            return Tile(f.format, self.stamp[3], tag, length=len(data), data=data)
+        return Tile(f.format, self.stamp[3], tag, self.path, offset, length)
+
+    def read(self, tile):
+        if tile.data is not None:
+            return tile.data
+        if not tile.tag.startswith(self.tag):
+            raise RuntimeError(f'{self.path} 已被替换，请重新请求')
+        return self.file.mm[tile.offset:tile.offset + tile.length]
+
+    def metadata(self):
+        f = self.file
+        return json.loads(_decompress(f.mm[f.meta_offset:f.meta_offset + f.meta_length],
+                                      f.internal_compression) or b'{}')
+
+    def _build_summary(self):
+        """逐层计数来自目录；范围取头部 bounds（PMTiles 不记录逐层范围）"""
+        f = self.file
+        starts = [((1 << (2 * z)) - 1) // 3 for z in range(f.max_zoom + 2)]
+        zooms = {}
+        for tile_id, run, length in f.iter_entries():
+            z = bisect_right(starts, tile_id) - 1
+            info = zooms.setdefault(z, {'count': 0, 'bytes': 0})
+            info['count'] += run
+            info['bytes'] += length
+        west, south, east, north = f.bounds
+        inset = 1e-6  # 头部以 1e-7 度存储，向内收一点避免边界落到相邻瓦片
+        out = {}
+        for z in sorted(zooms):
+            x_min, y_min = lonlat_to_tile(west + inset, north - inset, z)
+            x_max, y_max = lonlat_to_tile(east - inset, south + inset, z)
+            out[str(z)] = dict(zooms[z], formats={f.format: zooms[z]['count']},
+                               bounds=list(f.bounds), tile_range=[x_min, x_max, y_min, y_max])
+        return out
+
+
+SOURCE_TYPES = {'.mbtiles': MBTilesSource, '.pmtiles': PMTilesSource}
+
+
+def open_archive(path, poll=SOURCE_POLL_SECONDS):
+    """按扩展名打开单文件来源"""
+    cls = SOURCE_TYPES.get(Path(path).suffix.lower())
+    if cls is None:
+        raise ValueError(f'未知的瓦片来源类型: {path}（支持 {", ".join(SOURCE_TYPES)}）')
+    return cls(path, poll)
+
+
+# ---------------------------------------------------------------------------
+# 打包 out/ → MBTiles / PMTiles
+# ---------------------------------------------------------------------------
+
+def iter_loose_tiles(input_dir, zooms=None):
+    """遍历 {z}/{x}/{y}.{ext}，同一瓦片多种格式时按 PREFERRED_EXTS 取一个；产出 (z, x, y, path, ext)"""
+    input_dir = Path(input_dir)
+    for z_entry in sorted(os.scandir(input_dir), key=lambda e: e.name):
+        if not z_entry.name.isdigit() or not z_entry.is_dir():
+            continue
+        z = int(z_entry.name)
+        if zooms is not None and z not in zooms:
+            continue
+        for x_entry in os.scandir(z_entry.path):
+            if not x_entry.name.isdigit() or not x_entry.is_dir():
+                continue
+            best = {}
+            for entry in os.scandir(x_entry.path):
+                stem, dot, ext = entry.name.partition('.')
+                ext = ext.lower()
+                if not dot or not stem.isdigit() or ext not in PREFERRED_EXTS:
+                    continue
+                y = int(stem)
+                if y not in best or PREFERRED_EXTS.index(ext) < PREFERRED_EXTS.index(best[y][1]):
+                    best[y] = (entry.path, ext)
+            for y, (path, ext) in best.items():
+                yield z, int(x_entry.name), y, path, ext
+
+
+def tile_bytes(path, ext, fmt):
+    """读取瓦片；格式与目标不同时转码"""
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    if PIL_FORMATS[ext] == PIL_FORMATS[fmt]:
+        return data
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert('RGB' if PIL_FORMATS[fmt] == 'JPEG' else 'RGBA')
+        buf = io.BytesIO()
+        img.save(buf, PIL_FORMATS[fmt], quality=90)
+        return buf.getvalue()
+
+
+def _dominant_format(tiles):
+    counts = {}
+    for t in tiles:
+        ext = 'jpg' if t[4] == 'jpeg' else t[4]
+        counts[ext] = counts.get(ext, 0) + 1
+    return max(counts, key=counts.get) if counts else 'png'
+
+
+def _overall_bounds(tiles):
+    top = max(t[0] for t in tiles)
+    xs = [t[1] for t in tiles if t[0] == top]
+    ys = [t[2] for t in tiles if t[0] == top]
+    return tile_range_bounds(top, min(xs), max(xs), min(ys), max(ys))
+
+
+def pack_mbtiles(tiles, output, fmt, name):
+    bounds = _overall_bounds(tiles)
+    zs = [t[0] for t in tiles]
+    tmp = Path(str(output) + '.part')
+    if tmp.exists():
+        tmp.unlink()
+    conn = sqlite3.connect(str(tmp))
+    conn.executescript('''
+        CREATE TABLE metadata (name TEXT, value TEXT);
+        CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+    ''')
+    conn.executemany('INSERT INTO metadata VALUES (?, ?)', [
+        ('name', name), ('format', fmt), ('type', 'baselayer'),
+        ('bounds', ','.join(f'{v:.6f}' for v in bounds)),
+        ('minzoom', str(min(zs))), ('maxzoom', str(max(zs))),
+    ])
+    conn.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?)',
+                     ((z, x, (1 << z) - 1 - y, tile_bytes(path, ext, fmt)) for z, x, y, path, ext in tiles))
+    conn.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+    conn.commit()
+    conn.close()
+    os.replace(tmp, output)
+
+
+def _build_directories(entries):
+    """根目录放不下时把条目切成叶目录，叶目录大小逐步加倍直到根目录不超过 16 KiB"""
+    root = serialize_directory(entries)
+    if len(root) <= PMTILES_ROOT_MAX - PMTILES_HEADER.size:
+        return root, b''
+    leaf_size = 4096
+    while True:
+        leaves = bytearray()
+        root_entries = []
+        for i in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[i:i + leaf_size])
+            root_entries.append((entries[i][0], len(leaves), len(leaf), 0))
+            leaves += leaf
+        root = serialize_directory(root_entries)
+        if len(root) <= PMTILES_ROOT_MAX - PMTILES_HEADER.size:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+def pack_pmtiles(tiles, output, fmt, name):
+    """按瓦片 ID 顺序写数据区（clustered），内容相同的瓦片只存一份，连续相同内容合并为 run"""
+    bounds = _overall_bounds(tiles)
+    zs = [t[0] for t in tiles]
+    ordered = sorted((zxy_to_tileid(z, x, y), path, ext) for z, x, y, path, ext in tiles)
+    entries = []
+    seen = {}
+    size = 0
+    output = Path(output)
+    with tempfile.TemporaryFile(dir=output.parent) as data_fh:
+        for tile_id, path, ext in ordered:
+            data = tile_bytes(path, ext, fmt)
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            offset = seen.get(digest)
+            if offset is None:
+                offset = seen[digest] = size
+                data_fh.write(data)
+                size += len(data)
+            last = entries[-1] if entries else None
+            if last and last[1] == offset and last[0] + last[3] == tile_id:
+                entries[-1] = (last[0], last[1], last[2], last[3] + 1)
+            else:
+                entries.append((tile_id, offset, len(data), 1))
+
+        root, leaves = _build_directories(entries)
+        meta = gzip.compress(json.dumps({'name': name, 'format': fmt}).encode(), mtime=0)
+        root_offset = PMTILES_HEADER.size
+        meta_offset = root_offset + len(root)
+        leaf_offset = meta_offset + len(meta)
+        data_offset = leaf_offset + len(leaves)
+        min_lon, min_lat, max_lon, max_lat = bounds
+        header = PMTILES_HEADER.pack(
+            b'PMTiles', 3, root_offset, len(root), meta_offset, len(meta), leaf_offset, len(leaves),
+            data_offset, size, len(ordered), len(entries), len(seen), 1,
+            COMPRESSION_GZIP, COMPRESSION_NONE, PMTILES_TYPE_CODES[fmt], min(zs), max(zs),
+            round(min_lon * 1e7), round(min_lat * 1e7), round(max_lon * 1e7), round(max_lat * 1e7),
+            max(zs), round((min_lon + max_lon) / 2 * 1e7), round((min_lat + max_lat) / 2 * 1e7))
+
+        tmp = Path(str(output) + '.part')
+        with open(tmp, 'wb') as out:
+            out.write(header + root + meta + leaves)
+            data_fh.seek(0)
+            while True:
+                chunk = data_fh.read(1 << 20)
+                if not chunk:
+                    break
+                out.write(chunk)
+        os.replace(tmp, output)
+
+
+def parse_zooms(text):
+    zooms = set()
+    for part in text.split(','):
+        lo, _, hi = part.partition('-')
+        zooms.update(range(int(lo), int(hi or lo) + 1))
+    return zooms
+
+
+def main():
+    parser = argparse.ArgumentParser(description='将 out/ 瓦片目录打包为 MBTiles 或 PMTiles 单文件')
+    parser.add_argument('input_dir', help='瓦片目录（{z}/{x}/{y}.ext）')
+    parser.add_argument('output', help='输出文件，扩展名 .mbtiles 或 .pmtiles')
+    parser.add_argument('--zoom', type=str, help='只打包这些层级，例如 8-12 或 9,11')
+    parser.add_argument('--format', choices=['png', 'jpg', 'webp'], help='瓦片格式（默认取目录中最多的格式，其余转码）')
+    parser.add_argument('--name', type=str, help='元数据中的名称（默认取输出文件名）')
+    args = parser.parse_args()
+
+    suffix = Path(args.output).suffix.lower()
+    if suffix not in SOURCE_TYPES:
+        parser.error('输出文件扩展名必须是 .mbtiles 或 .pmtiles')
+    started = time.time()
+    tiles = list(iter_loose_tiles(args.input_dir, parse_zooms(args.zoom) if args.zoom else None))
+    if not tiles:
+        print(f'❌ {args.input_dir} 中没有瓦片')
+        return
+    fmt = args.format or _dominant_format(tiles)
+    name = args.name or Path(args.output).stem
+    print(f'📦 打包 {len(tiles)} 个瓦片（{fmt}）→ {args.output}')
+    if suffix == '.mbtiles':
+        pack_mbtiles(tiles, args.output, fmt, name)
+    else:
+        pack_pmtiles(tiles, args.output, fmt, name)
+    print(f'✅ 完成：{os.path.getsize(args.output) / 1e6:.1f} MB，用时 {time.time() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()